@@ -24,7 +24,7 @@ import yaml
 import PIL.Image
 
 import tf2onnx
-from tf2onnx.optimizer.transpose_optimizer import TransposeOptimizer
+from tf2onnx.optimizer import optimize_graph
 from tf2onnx.tfonnx import process_tf_graph
 
 # pylint: disable=broad-except,logging-not-lazy,unused-argument
@@ -173,10 +173,10 @@ class Test(object):
         return result
 
     @staticmethod
-    def to_onnx(tf_graph, opset=None, shape_override=None):
+    def to_onnx(tf_graph, opset=None, shape_override=None, output_names=None):
         """Convert graph to tensorflow."""
         return process_tf_graph(tf_graph, continue_on_error=True, verbose=True, opset=opset,
-                                target=Test.target, shape_override=shape_override)
+                                target=Test.target, shape_override=shape_override, output_names=output_names)
 
     def run_caffe2(self, name, model_proto, inputs):
         """Run test again caffe2 backend."""
@@ -307,9 +307,9 @@ class Test(object):
             model_proto = None
             try:
                 # convert model to onnx
-                onnx_graph = self.to_onnx(sess.graph, opset=opset, shape_override=shape_override)
-                optimizer = TransposeOptimizer(onnx_graph, debug)
-                optimizer.optimize()
+                onnx_graph = self.to_onnx(sess.graph, opset=opset, shape_override=shape_override,
+                                          output_names=self.output_names)
+                optimize_graph(onnx_graph, self.output_names, debug)
 
                 model_proto = onnx_graph.make_model("test", self.output_names)
                 print("\tto_onnx", "OK")
@@ -998,6 +998,37 @@ class BackendTests(Tf2OnnxBackendTestBase):
         assert output.op.type == "Div"
         self._run_test_case([_OUTPUT], {_INPUT: x_val, _INPUT1: y_val})
 
+    def test_cond_constant_predicate(self):
+        x_val = np.array([1.0, 2.0, -3.0, -4.0], dtype=np.float32).reshape((2, 2))
+        x = tf.placeholder(tf.float32, [2, 2], name=_TFINPUT)
+        is_training = tf.constant(False, name="is_training")
+        x_ = tf.cond(is_training, lambda: tf.nn.dropout(x, 0.5), lambda: x * 2. + 1.)
+        _ = tf.identity(x_, name=_TFOUTPUT)
+        self._run_test_case([_OUTPUT], {_INPUT: x_val})
+
+    def test_cond(self):
+        x_val = np.array([1.0, 2.0, -3.0, -4.0], dtype=np.float32).reshape((2, 2))
+        x = tf.placeholder(tf.float32, [2, 2], name=_TFINPUT)
+        pred = tf.reduce_sum(x) > 0.
+        x_ = tf.cond(pred, lambda: x * 2. + 1., lambda: tf.abs(x) - 1.)
+        _ = tf.identity(x_, name=_TFOUTPUT)
+        self._run_test_case([_OUTPUT], {_INPUT: x_val})
+
+    def test_while_loop(self):
+        x_val = np.array([1.0, 2.0, -3.0, -4.0], dtype=np.float32).reshape((2, 2))
+        x = tf.placeholder(tf.float32, [2, 2], name=_TFINPUT)
+        i = tf.constant(0)
+        _, x_ = tf.while_loop(lambda i, x: i < 3, lambda i, x: (i + 1, x * 2. + 1.), [i, x])
+        _ = tf.identity(x_, name=_TFOUTPUT)
+        self._run_test_case([_OUTPUT], {_INPUT: x_val})
+
+    def test_while_loop_tensor_array(self):
+        x_val = np.array([1.0, 2.0, -3.0, -4.0, 5.0, 6.0], dtype=np.float32).reshape((3, 2))
+        x = tf.placeholder(tf.float32, [3, 2], name=_TFINPUT)
+        x_ = tf.map_fn(lambda row: row * 3. + 1., x)
+        _ = tf.identity(x_, name=_TFOUTPUT)
+        self._run_test_case([_OUTPUT], {_INPUT: x_val})
+
 
 if __name__ == '__main__':
     Tf2OnnxBackendTestBase.trigger(BackendTests)
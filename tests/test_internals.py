@@ -8,18 +8,39 @@ from __future__ import print_function
 
 
 import os
+import shutil
+import tempfile
 import unittest
 from collections import namedtuple
 
 import graphviz as gv
-from onnx import TensorProto
-from onnx import helper
+import numpy as np
+from onnx import ModelProto, TensorProto
+from onnx import checker, helper, numpy_helper
 
 import tensorflow as tf
 import tf2onnx
 import tf2onnx.utils
+from tf2onnx.batch_variants import save_batch_variants
+from tf2onnx.checkpoint import save_graph, load_graph
+from tf2onnx.dtype_inference import infer_dtypes
+from tf2onnx.float16 import convert_float16
 from tf2onnx.graph import Node, Graph
 from tf2onnx.graph_matcher import OpTypePattern, GraphMatcher
+from tf2onnx.graph_validator import GraphValidator
+from tf2onnx.optimizer.algebraic_optimizer import AlgebraicOptimizer
+from tf2onnx.optimizer.const_fold_optimizer import ConstFoldOptimizer
+from tf2onnx.optimizer.conv_fold_optimizer import ConvFoldOptimizer
+from tf2onnx.optimizer.cse_optimizer import CseOptimizer
+from tf2onnx.optimizer.gemm_optimizer import GemmOptimizer
+from tf2onnx.optimizer.initializer_dedup_optimizer import InitializerDedupOptimizer
+from tf2onnx.optimizer.pad_fold_optimizer import PadFoldOptimizer
+from tf2onnx.optimizer.peephole_optimizer import PeepholeOptimizer
+from tf2onnx.optimizer.reshape_optimizer import ReshapeOptimizer
+from tf2onnx.partition import split_graph
+from tf2onnx.quantization import calibrate, quantize_static, quantize_weights
+from tf2onnx.shape_inference import infer_shapes
+from tf2onnx.tfonnx import tf_fold_constants
 
 # pylint: disable=missing-docstring
 
@@ -172,6 +193,371 @@ class Tf2OnnxInternalTests(unittest.TestCase):
         match_results = list(matcher.match_ops(ops))
         self.assertEqual(1, len(match_results))
 
+    def test_graph_validator(self):
+        model_proto = self.sample_net()
+        nodes = model_proto.node
+        g = Graph(nodes, output_shapes={"n5:0": [2, 2]}, dtypes={"n5:0": TensorProto.FLOAT})
+        g.add_model_input("input", model_proto.input[0])
+        validator = GraphValidator(g)
+        self.assertEqual([], validator.validate(["n5:0"]))
+
+        # incremental check only looks at the changed node
+        n4 = g.get_node_by_name("n4")
+        n4.input[1] = "missing:0"
+        errors = validator.validate(incremental=True)
+        self.assertEqual(["input missing:0 of node n4 is not connected"], errors)
+
+        # cycle and duplicate output
+        n4.input[1] = "n5:0"
+        g.get_node_by_name("n3").output[0] = "n2:0"
+        errors = validator.validate(incremental=True)
+        self.assertTrue(any("cycle" in e for e in errors))
+        self.assertTrue(any("output n2:0 is produced by" in e for e in errors))
+        self.assertRaises(ValueError, validator.check)
+
+        # the back edge of a tensorflow while loop is not a cycle
+        n1 = helper.make_node("Merge", ["input", "n3:0"], ["n1:0"], name="n1")
+        n2 = helper.make_node("Add", ["n1:0", "n1:0"], ["n2:0"], name="n2")
+        n3 = helper.make_node("NextIteration", ["n2:0"], ["n3:0"], name="n3")
+        g = Graph([n1, n2, n3], output_shapes={}, dtypes={})
+        g.add_model_input("input", model_proto.input[0])
+        self.assertEqual([], GraphValidator(g).validate())
+
+    def test_make_model_keeps_initializers(self):
+        n1 = helper.make_node("Transpose", ["input"], ["n1:0"], name="n1", perm=[0, 1])
+        n2 = helper.make_node("Add", ["n1:0", "w"], ["n2:0"], name="n2")
+        g = Graph([n1, n2], output_shapes={"input": [2, 2], "n2:0": [2, 2]},
+                  dtypes={"input": TensorProto.FLOAT, "n2:0": TensorProto.FLOAT})
+        g.add_model_input("input", helper.make_tensor_value_info("input", TensorProto.FLOAT, [2, 2]))
+        g.make_const("w", np.ones((2, 2), dtype=np.float32))
+        model_proto = g.make_model("test", ["n2:0"], optimizer_passes=["eliminate_nop_transpose"])
+        self.assertEqual(["Add"], [n.op_type for n in model_proto.graph.node])
+        self.assertEqual(["w"], [i.name for i in model_proto.graph.initializer])
+
+    def test_make_model_initializer_passes(self):
+        n1 = helper.make_node("Conv", ["input", "w"], ["n1:0"], name="n1")
+        n2 = helper.make_node("BatchNormalization", ["n1:0", "scale", "bias", "mean", "var"], ["n2:0"], name="n2")
+        g = Graph([n1, n2], output_shapes={"input": [1, 1, 3, 3], "n2:0": [1, 2, 3, 3]},
+                  dtypes={"input": TensorProto.FLOAT, "n2:0": TensorProto.FLOAT}, opset=7)
+        g.add_model_input("input", helper.make_tensor_value_info("input", TensorProto.FLOAT, [1, 1, 3, 3]))
+        g.make_const("w", np.ones((2, 1, 1, 1), dtype=np.float32))
+        for name in ["scale", "bias", "mean", "var"]:
+            g.make_const(name, np.ones((2,), dtype=np.float32))
+        # fuse_bn_into_conv needs the values of the weights, the optimizer gets the model with its initializers
+        seen = []
+        optimize = tf2onnx.graph.optimizer.optimize
+
+        def count_initializers(model_proto, passes):
+            seen.append(len(model_proto.graph.initializer))
+            return optimize(model_proto, passes)
+
+        tf2onnx.graph.optimizer.optimize = count_initializers
+        try:
+            model_proto = g.make_model("test", ["n2:0"], optimizer_passes=["fuse_bn_into_conv"])
+            self.assertEqual([5], seen)
+            g.make_model("test", ["n2:0"], optimizer_passes=["eliminate_nop_transpose"])
+            self.assertEqual([5, 0], seen)
+        finally:
+            tf2onnx.graph.optimizer.optimize = optimize
+        checker.check_model(model_proto)
+        used = set(i for n in model_proto.graph.node for i in n.input)
+        used -= set(o for n in model_proto.graph.node for o in n.output) | {"input"}
+        self.assertEqual(used, set(i.name for i in model_proto.graph.initializer))
+
+    def test_checkpoint_roundtrip(self):
+        model_proto = self.sample_net()
+        g = Graph(model_proto.node, output_shapes={"n5:0": [2, 2]}, dtypes={"n5:0": TensorProto.FLOAT})
+        g.add_model_input("input", model_proto.input[0])
+        w = np.arange(6, dtype=np.float32).reshape((2, 3))
+        ops = g.get_nodes()
+        ops.append(g.make_const("w", w, skip_conversion=True))
+        g.set_nodes(ops)
+        g.get_node_by_name("n1").data_format = "NHWC"
+        path = tempfile.mkdtemp()
+        try:
+            save_graph(g, path, "rewrite")
+            g2, phase = load_graph(path)
+            self.assertEqual("rewrite", phase)
+            self.assertEqual(onnx_to_graphviz(g), onnx_to_graphviz(g2))
+            self.assertEqual([2, 3], g2.get_shape("w"))
+            self.assertTrue(g2.is_model_input("input"))
+            self.assertTrue(g2.get_node_by_name("w").need_skip())
+            self.assertEqual("NHWC", g2.get_node_by_name("n1").data_format)
+            self.assertTrue(np.array_equal(w, g2.get_node_by_name("w").get_tensor_value()))
+            self.assertTrue(np.array_equal(w, numpy_helper.to_array(g2.get_initializer("w"))))
+        finally:
+            shutil.rmtree(path)
+
+    def test_checkpoint_body_graph(self):
+        n1 = helper.make_node("Loop", ["", "cond", "input"], ["n1:0"], name="n1")
+        g = Graph([n1], output_shapes={}, dtypes={"n1:0": TensorProto.FLOAT})
+        body = Graph([helper.make_node("Neg", ["x"], ["neg:0"], name="neg")], output_shapes={},
+                     dtypes={"neg:0": TensorProto.FLOAT})
+        for name, dtype in [("i", TensorProto.INT64), ("c", TensorProto.BOOL), ("x", TensorProto.FLOAT)]:
+            body.add_model_input(name, helper.make_tensor_value_info(name, dtype, []))
+        g.get_node_by_name("n1").set_body_graph_as_attr("body", body, ["i", "c", "x"], ["c", "neg:0"])
+        path = tempfile.mkdtemp()
+        try:
+            save_graph(g, path, "mapping")
+            g2, _ = load_graph(path)
+            body2, input_names, output_names = g2.get_node_by_name("n1").get_body_graphs()["body"]
+            self.assertEqual(["i", "c", "x"], input_names)
+            self.assertEqual(["c", "neg:0"], output_names)
+            self.assertEqual(["Neg"], [n.type for n in body2.get_nodes()])
+            self.assertTrue(body2.is_model_input("x"))
+        finally:
+            shutil.rmtree(path)
+
+    def test_const_fold(self):
+        n1 = helper.make_node("Transpose", ["w"], ["n1:0"], name="n1", perm=[1, 0])
+        n2 = helper.make_node("Reshape", ["n1:0", "shape"], ["n2:0"], name="n2")
+        n3 = helper.make_node("Cast", ["n2:0"], ["n3:0"], name="n3", to=TensorProto.INT32)
+        n4 = helper.make_node("Add", ["input", "n3:0"], ["n4:0"], name="n4")
+        g = Graph([n1, n2, n3, n4], output_shapes={}, dtypes={}, opset=7)
+        w = np.arange(6, dtype=np.float32).reshape((2, 3))
+        g.make_const("w", w)
+        g.make_const("shape", np.array([0, -1], dtype=np.int64))
+        folded = ConstFoldOptimizer(g, output_names=["n4:0"]).optimize()
+        self.assertEqual(3, folded)
+        self.assertEqual(["Add"], [n.type for n in g.get_nodes()])
+        result = numpy_helper.to_array(g.get_initializer("n3:0"))
+        self.assertEqual(np.int32, result.dtype)
+        self.assertTrue(np.array_equal(w.T.astype(np.int32), result))
+
+    def test_const_fold_static_shapes(self):
+        n1 = helper.make_node("Shape", ["input"], ["n1:0"], name="n1")
+        n2 = helper.make_node("Gather", ["n1:0", "idx"], ["n2:0"], name="n2", axis=0)
+        n3 = helper.make_node("Size", ["input"], ["n3:0"], name="n3")
+        n4 = helper.make_node("Unsqueeze", ["n3:0"], ["n4:0"], name="n4", axes=[0])
+        n5 = helper.make_node("Concat", ["n2:0", "n4:0"], ["n5:0"], name="n5", axis=0)
+        n6 = helper.make_node("Reshape", ["input", "n5:0"], ["n6:0"], name="n6")
+        g = Graph([n1, n2, n3, n4, n5, n6], output_shapes={"input": [2, 3]}, dtypes={}, opset=7)
+        g.make_const("idx", np.array([0], dtype=np.int64))
+        ConstFoldOptimizer(g, output_names=["n6:0"]).optimize()
+        self.assertEqual(6, len(g.get_nodes()))
+        ConstFoldOptimizer(g, output_names=["n6:0"], static_shapes=True).optimize()
+        self.assertEqual(["Reshape"], [n.type for n in g.get_nodes()])
+        self.assertEqual([2, 6], list(numpy_helper.to_array(g.get_initializer("n5:0"))))
+
+    def test_cse(self):
+        n1 = helper.make_node("Transpose", ["input"], ["n1:0"], name="n1", perm=[1, 0])
+        n2 = helper.make_node("Transpose", ["input"], ["n2:0"], name="n2", perm=[1, 0])
+        n3 = helper.make_node("Add", ["n1:0", "w1"], ["n3:0"], name="n3")
+        n4 = helper.make_node("Add", ["n2:0", "w2"], ["n4:0"], name="n4")
+        n5 = helper.make_node("Transpose", ["input"], ["n5:0"], name="n5", perm=[0, 1])
+        n6 = helper.make_node("Sum", ["n3:0", "n4:0", "n5:0"], ["n6:0"], name="n6")
+        g = Graph([n1, n2, n3, n4, n5, n6], output_shapes={}, dtypes={}, opset=7)
+        g.make_const("w1", np.ones((2, 2), dtype=np.float32))
+        g.make_const("w2", np.ones((2, 2), dtype=np.float32))
+        self.assertEqual(3, CseOptimizer(g, output_names=["n6:0"]).optimize())
+        self.assertEqual(["n1", "n3", "n5", "n6"], [n.name for n in g.get_nodes()])
+        self.assertEqual(["n3:0", "n3:0", "n5:0"], g.get_node_by_name("n6").input)
+
+    def test_algebraic_simplification(self):
+        n1 = helper.make_node("Mul", ["one", "input"], ["n1:0"], name="n1")
+        n2 = helper.make_node("Pow", ["n1:0", "two"], ["n2:0"], name="n2")
+        n3 = helper.make_node("Neg", ["n2:0"], ["n3:0"], name="n3")
+        n4 = helper.make_node("Neg", ["n3:0"], ["n4:0"], name="n4")
+        n5 = helper.make_node("Mul", ["n4:0", "three"], ["n5:0"], name="n5")
+        n6 = helper.make_node("Div", ["n5:0", "two"], ["n6:0"], name="n6")
+        # rsqrt
+        n7 = helper.make_node("Sqrt", ["input"], ["n7:0"], name="n7")
+        n8 = helper.make_node("Reciprocal", ["n7:0"], ["n8:0"], name="n8")
+        n9 = helper.make_node("Mul", ["n6:0", "n8:0"], ["n9:0"], name="n9")
+        g = Graph([n1, n2, n3, n4, n5, n6, n7, n8, n9], output_shapes={}, dtypes={}, opset=7)
+        g.make_const("one", np.array(1, dtype=np.float32))
+        g.make_const("two", np.array(2, dtype=np.float32))
+        g.make_const("three", np.array(3, dtype=np.float32))
+        self.assertEqual(6, AlgebraicOptimizer(g, output_names=["n9:0"]).optimize())
+        self.assertEqual(["n2", "n6", "n7", "n9"], [n.name for n in g.get_nodes()])
+        n2 = g.get_node_by_name("n2")
+        self.assertEqual(("Mul", ["input", "input"]), (n2.type, n2.input))
+        n6 = g.get_node_by_name("n6")
+        self.assertEqual(("Mul", "n2:0", 1.5), (n6.type, n6.input[0],
+                                                 numpy_helper.to_array(g.get_initializer(n6.input[1])).item()))
+        n9 = g.get_node_by_name("n9")
+        self.assertEqual(("Div", ["n6:0", "n7:0"]), (n9.type, n9.input))
+
+    def test_conv_fold(self):
+        n1 = helper.make_node("Conv", ["input", "w", "b"], ["n1:0"], name="n1", group=2)
+        n2 = helper.make_node("BatchNormalization", ["n1:0", "scale", "offset", "mean", "var"], ["n2:0"],
+                              name="n2", epsilon=1.0)
+        n3 = helper.make_node("Transpose", ["n2:0"], ["n3:0"], name="n3", perm=[0, 2, 3, 1])
+        n4 = helper.make_node("Mul", ["n3:0", "m"], ["n4:0"], name="n4")
+        n5 = helper.make_node("Add", ["a", "n4:0"], ["n5:0"], name="n5")
+        n6 = helper.make_node("Relu", ["n5:0"], ["n6:0"], name="n6")
+        g = Graph([n1, n2, n3, n4, n5, n6], output_shapes={}, dtypes={}, opset=7)
+        # depthwise conv with bias
+        g.make_const("w", np.array([2, 3], dtype=np.float32).reshape((2, 1, 1, 1)))
+        g.make_const("b", np.array([1, 1], dtype=np.float32))
+        g.make_const("scale", np.array([1, 2], dtype=np.float32))
+        g.make_const("offset", np.array([0, 1], dtype=np.float32))
+        g.make_const("mean", np.array([1, 0], dtype=np.float32))
+        g.make_const("var", np.array([3, 0], dtype=np.float32))
+        g.make_const("m", np.array([2, 3], dtype=np.float32))
+        g.make_const("a", np.ones((1, 1, 1, 2), dtype=np.float32))
+        self.assertEqual(3, ConvFoldOptimizer(g, output_names=["n6:0"]).optimize())
+        self.assertEqual(["n1", "n3", "n6"], [n.name for n in g.get_nodes()])
+        self.assertEqual(["n3:0"], g.get_node_by_name("n6").input)
+        conv = g.get_node_by_name("n1")
+        w = numpy_helper.to_array(g.get_initializer(conv.input[1]))
+        b = numpy_helper.to_array(g.get_initializer(conv.input[2]))
+        self.assertEqual([2, 18], w.reshape(-1).tolist())
+        self.assertEqual([1, 10], b.tolist())
+
+    def test_conv_fold_decomposed_batchnorm(self):
+        n1 = helper.make_node("Conv", ["input", "w"], ["n1:0"], name="n1")
+        n2 = helper.make_node("Mul", ["n1:0", "m"], ["n2:0"], name="n2")
+        n3 = helper.make_node("Add", ["n2:0", "a"], ["n3:0"], name="n3")
+        n4 = helper.make_node("Relu", ["n3:0"], ["n4:0"], name="n4")
+        g = Graph([n1, n2, n3, n4], output_shapes={}, dtypes={}, opset=7)
+        g.make_const("w", np.array([2, 3], dtype=np.float32).reshape((2, 1, 1, 1)))
+        g.make_const("m", np.array([2, 3], dtype=np.float32).reshape((1, 2, 1, 1)))
+        g.make_const("a", np.array([1, 2], dtype=np.float32).reshape((1, 2, 1, 1)))
+        # Mul and Add both fold into the convolution without bias
+        self.assertEqual(2, ConvFoldOptimizer(g, output_names=["n4:0"]).optimize())
+        self.assertEqual(["n1", "n4"], [n.name for n in g.get_nodes()])
+        self.assertEqual(["n1:0"], g.get_node_by_name("n4").input)
+        conv = g.get_node_by_name("n1")
+        self.assertEqual([4, 9], numpy_helper.to_array(g.get_initializer(conv.input[1])).reshape(-1).tolist())
+        self.assertEqual([1, 2], numpy_helper.to_array(g.get_initializer(conv.input[2])).tolist())
+
+    def test_gemm_fusion(self):
+        n1 = helper.make_node("Transpose", ["w"], ["n1:0"], name="n1", perm=[1, 0])
+        n2 = helper.make_node("MatMul", ["input", "n1:0"], ["n2:0"], name="n2")
+        n3 = helper.make_node("Add", ["n2:0", "b"], ["n3:0"], name="n3")
+        n4 = helper.make_node("MatMul", ["n3:0", "w2"], ["n4:0"], name="n4")
+        # the bias would broadcast the output to [-1, 3, 3]
+        n5 = helper.make_node("Add", ["n4:0", "b2"], ["n5:0"], name="n5")
+        g = Graph([n1, n2, n3, n4, n5], output_shapes={"input": [-1, 2], "n1:0": [2, 3], "n3:0": [-1, 3]},
+                  dtypes={"input": TensorProto.FLOAT}, opset=7)
+        g.make_const("w", np.ones((3, 2), dtype=np.float32))
+        g.make_const("b", np.ones((3,), dtype=np.float32))
+        g.make_const("w2", np.ones((3, 3), dtype=np.float32))
+        g.make_const("b2", np.ones((3, 1, 3), dtype=np.float32))
+        self.assertEqual(1, GemmOptimizer(g, output_names=["n5:0"]).optimize())
+        self.assertEqual(["n3", "n4", "n5"], [n.name for n in g.get_nodes()])
+        gemm = g.get_node_by_name("n3")
+        self.assertEqual("Gemm", gemm.type)
+        self.assertEqual(["input", "w", "b"], gemm.input)
+        self.assertEqual(0, gemm.get_attr("transA").i)
+        self.assertEqual(1, gemm.get_attr("transB").i)
+
+    def test_pad_fold(self):
+        # nhwc input padded on h and w
+        n1 = helper.make_node("Pad", ["input"], ["n1:0"], name="n1", pads=[0, 1, 2, 0, 0, 3, 4, 0])
+        n2 = helper.make_node("Transpose", ["n1:0"], ["n2:0"], name="n2", perm=[0, 3, 1, 2])
+        n3 = helper.make_node("Conv", ["n2:0", "w"], ["n3:0"], name="n3", pads=[1, 1, 1, 1])
+        # zero pad in front of MaxPool is only the same as the pool pads for non-negative inputs
+        n4 = helper.make_node("Pad", ["n3:0"], ["n4:0"], name="n4", pads=[0, 0, 1, 1, 0, 0, 1, 1])
+        n5 = helper.make_node("MaxPool", ["n4:0"], ["n5:0"], name="n5", kernel_shape=[2, 2])
+        g = Graph([n1, n2, n3, n4, n5], output_shapes={"n2:0": [1, 3, 7, 9]}, dtypes={}, opset=7)
+        g.make_const("w", np.ones((2, 3, 1, 1), dtype=np.float32))
+        self.assertEqual(1, PadFoldOptimizer(g, output_names=["n5:0"]).optimize())
+        self.assertEqual(["n2", "n3", "n4", "n5"], [n.name for n in g.get_nodes()])
+        self.assertEqual("input", g.get_node_by_name("n2").input[0])
+        self.assertEqual([2, 3, 4, 5], g.get_node_by_name("n3").get_attr("pads").ints)
+        self.assertEqual([1, 3, 3, 3], g.get_shape("n2:0"))
+
+    def test_reshape_chain(self):
+        n1 = helper.make_node("Unsqueeze", ["input"], ["n1:0"], name="n1", axes=[1])
+        n2 = helper.make_node("Squeeze", ["n1:0"], ["n2:0"], name="n2", axes=[1])
+        n3 = helper.make_node("Unsqueeze", ["n2:0"], ["n3:0"], name="n3", axes=[2])
+        n4 = helper.make_node("Reshape", ["n3:0", "shape"], ["n4:0"], name="n4")
+        n5 = helper.make_node("Relu", ["n4:0"], ["n5:0"], name="n5")
+        shapes = {"input": ["N", 8], "n1:0": ["N", 1, 8], "n2:0": ["N", 8], "n3:0": ["N", 8, 1], "n4:0": ["N", 4, 2]}
+        g = Graph([n1, n2, n3, n4, n5], output_shapes={k: [-1] + v[1:] for k, v in shapes.items()},
+                  dtypes={"input": TensorProto.FLOAT}, opset=7)
+        for k, v in shapes.items():
+            g.set_symbolic_shape(k, v)
+        g.make_const("shape", np.array([-1, 4, 2], dtype=np.int64))
+        # Unsqueeze -> Squeeze does nothing, Unsqueeze -> Reshape is one Reshape
+        self.assertEqual(2, ReshapeOptimizer(g, output_names=["n5:0"]).optimize())
+        self.assertEqual(["n4", "n5"], [n.name for n in g.get_nodes()])
+        n4 = g.get_node_by_name("n4")
+        self.assertEqual("input", n4.input[0])
+        self.assertEqual([0, 4, 2], numpy_helper.to_array(g.get_initializer(n4.input[1])).tolist())
+        # with unknown model outputs a Reshape that does nothing stays, it might make a model output
+        n1 = helper.make_node("Reshape", ["input", "shape"], ["n1:0"], name="n1")
+        g = Graph([n1], output_shapes={"input": [2, 3], "n1:0": [2, 3]}, dtypes={"input": TensorProto.FLOAT},
+                  opset=7)
+        g.make_const("shape", np.array([2, 3], dtype=np.int64))
+        self.assertEqual(0, ReshapeOptimizer(g).optimize())
+        self.assertEqual(["n1"], [n.name for n in g.get_nodes()])
+
+    def test_peephole(self):
+        n1 = helper.make_node("Identity", ["input"], ["n1:0"], name="n1")
+        n2 = helper.make_node("Cast", ["n1:0"], ["n2:0"], name="n2", to=TensorProto.INT32)
+        n3 = helper.make_node("Cast", ["n2:0"], ["n3:0"], name="n3", to=TensorProto.INT64)
+        n4 = helper.make_node("Cast", ["n3:0"], ["n4:0"], name="n4", to=TensorProto.INT32)
+        n5 = helper.make_node("Transpose", ["n4:0"], ["n5:0"], name="n5", perm=[1, 0])
+        n6 = helper.make_node("Transpose", ["n5:0"], ["n6:0"], name="n6", perm=[1, 0])
+        n7 = helper.make_node("Add", ["n6:0", "n6:0"], ["n7:0"], name="n7")
+        dtypes = {"input": TensorProto.INT32, "n1:0": TensorProto.INT32, "n2:0": TensorProto.INT32,
+                  "n3:0": TensorProto.INT64, "n4:0": TensorProto.INT32}
+        g = Graph([n1, n2, n3, n4, n5, n6, n7], output_shapes={}, dtypes=dtypes, opset=7)
+        self.assertEqual(4, PeepholeOptimizer(g, output_names=["n7:0"]).optimize())
+        self.assertEqual(["n7"], [n.name for n in g.get_nodes()])
+        self.assertEqual(["input", "input"], g.get_node_by_name("n7").input)
+
+        # without the model outputs the Cast might produce one, it is bypassed but kept
+        n1 = helper.make_node("Cast", ["input"], ["n1:0"], name="n1", to=TensorProto.INT32)
+        n2 = helper.make_node("Add", ["n1:0", "n1:0"], ["n2:0"], name="n2")
+        g = Graph([n1, n2], output_shapes={}, dtypes={"input": TensorProto.INT32}, opset=7)
+        self.assertEqual(1, PeepholeOptimizer(g).optimize())
+        self.assertEqual(["n1", "n2"], [n.name for n in g.get_nodes()])
+        self.assertEqual(["input", "input"], g.get_node_by_name("n2").input)
+
+    def test_initializer_dedup(self):
+        n1 = helper.make_node("Add", ["input", "b1"], ["n1:0"], name="n1")
+        n2 = helper.make_node("Add", ["n1:0", "b2"], ["n2:0"], name="n2")
+        n3 = helper.make_node("Reshape", ["n2:0", "s1"], ["n3:0"], name="n3")
+        n4 = helper.make_node("Add", ["n3:0", "b3"], ["n4:0"], name="n4")
+        g = Graph([n1, n2, n3, n4], output_shapes={}, dtypes={}, opset=7)
+        g.make_const("b1", np.zeros((4,), dtype=np.float32))
+        g.make_const("b2", np.zeros((4,), dtype=np.float32))
+        # same bytes but different type or shape
+        g.make_const("s1", np.zeros((4,), dtype=np.int32))
+        g.make_const("b3", np.zeros((2, 2), dtype=np.float32))
+        dedup = InitializerDedupOptimizer(g)
+        self.assertEqual(1, dedup.optimize())
+        self.assertEqual(16, dedup.bytes_saved)
+        self.assertEqual(["n1:0", "b1"], g.get_node_by_name("n2").input)
+        self.assertFalse(g.is_initializer("b2"))
+        self.assertEqual(["b1", "b3", "s1"], sorted(g.initializers))
+
+    def test_shape_inference(self):
+        n1 = helper.make_node("MatMul", ["input", "w"], ["n1:0"], name="n1")
+        n2 = helper.make_node("Relu", ["n1:0"], ["n2:0"], name="n2")
+        n3 = helper.make_node("Reshape", ["n2:0", "shape"], ["n3:0"], name="n3")
+        n4 = helper.make_node("Conv", ["n3:0", "k"], ["n4:0"], name="n4", strides=[2, 2], pads=[1, 1, 1, 1])
+        g = Graph([n1, n2, n3, n4], output_shapes={"input": [-1, 3], "n3:0": []}, dtypes={}, opset=7)
+        g.make_const("w", np.zeros((3, 8), dtype=np.float32))
+        g.make_const("shape", np.array([-1, 2, 2, 2], dtype=np.int64))
+        g.make_const("k", np.zeros((4, 2, 3, 3), dtype=np.float32))
+        infer_shapes(g)
+        self.assertEqual([-1, 8], g.get_shape("n2:0"))
+        self.assertEqual([-1, 2, 2, 2], g.get_shape("n3:0"))
+        self.assertEqual([-1, 4, 1, 1], g.get_shape("n4:0"))
+        # the batch dim is the same symbol all the way through
+        batch = g.get_symbolic_shape("input")[0]
+        self.assertEqual(batch, g.get_symbolic_shape("n4:0")[0])
+
+    def test_dtype_inference(self):
+        n1 = helper.make_node("Shape", ["input"], ["n1:0"], name="n1")
+        n2 = helper.make_node("Gather", ["n1:0", "idx"], ["n2:0"], name="n2")
+        n3 = helper.make_node("Cast", ["n2:0"], ["n3:0"], name="n3", to=TensorProto.FLOAT)
+        n4 = helper.make_node("Greater", ["n3:0", "input"], ["n4:0"], name="n4")
+        # tensorflow told us int32 for the shape
+        g = Graph([n1, n2, n3, n4], output_shapes={}, dtypes={"n1:0": TensorProto.INT32}, opset=7)
+        g.add_model_input("input", helper.make_tensor_value_info("input", TensorProto.FLOAT, [2]))
+        g.make_const("idx", np.array([0], dtype=np.int32))
+        self.assertEqual(4, infer_dtypes(g))
+        self.assertEqual(TensorProto.INT64, g.get_dtype("n1:0"))
+        self.assertEqual(TensorProto.INT64, g.get_dtype("n2:0"))
+        self.assertEqual(TensorProto.FLOAT, g.get_dtype("n3:0"))
+        self.assertEqual(TensorProto.BOOL, g.get_dtype("n4:0"))
+
     def test_cmdarg_parse(self):
         arg = "input/V-1_2:0,input/X:0[1,2,3],Y:1[4,5],Z:3,A:1,B"
         expected_inputs = ['input/V-1_2:0', 'input/X:0', 'Y:1', 'Z:3', 'A:1', 'B']
@@ -180,6 +566,224 @@ class Tf2OnnxInternalTests(unittest.TestCase):
         self.assertEqual(expected_inputs, inputs)
         self.assertEqual(expected_shape, shape_override)
 
+    def test_float16(self):
+        n1 = helper.make_node("MatMul", ["input", "w"], ["n1:0"], name="n1")
+        n2 = helper.make_node("Softmax", ["n1:0"], ["n2:0"], name="n2")
+        n3 = helper.make_node("Add", ["n2:0", "b"], ["n3:0"], name="n3")
+        dtypes = {"n1:0": TensorProto.FLOAT, "n2:0": TensorProto.FLOAT, "n3:0": TensorProto.FLOAT}
+        g = Graph([n1, n2, n3], output_shapes={}, dtypes=dtypes, opset=7)
+        g.add_model_input("input", helper.make_tensor_value_info("input", TensorProto.FLOAT, [2, 3]))
+        g.make_const("w", np.ones((3, 3), dtype=np.float32))
+        g.make_const("b", np.ones((3,), dtype=np.float32))
+        # Softmax stays in float32, model input and output too
+        self.assertEqual(4, convert_float16(g, ["n3:0"], keep_io_types=True))
+        self.assertEqual(["Cast", "MatMul", "Cast", "Softmax", "Cast", "Add", "Cast"],
+                         [n.type for n in g.get_nodes()])
+        self.assertEqual(TensorProto.FLOAT16, g.get_initializer("w").data_type)
+        self.assertEqual(TensorProto.FLOAT16, g.get_dtype("n1:0"))
+        self.assertEqual(TensorProto.FLOAT, g.get_dtype("n2:0"))
+        self.assertEqual(["n3:0"], g.get_nodes()[-1].output)
+        self.assertEqual(TensorProto.FLOAT, g.get_dtype("n3:0"))
+
+    def test_float16_subgraph(self):
+        n1 = helper.make_node("Relu", ["input"], ["n1:0"], name="n1")
+        n2 = helper.make_node("If", ["cond"], ["n2:0"], name="n2")
+        n3 = helper.make_node("Add", ["n2:0", "b"], ["n3:0"], name="n3")
+        dtypes = {"n1:0": TensorProto.FLOAT, "n2:0": TensorProto.FLOAT, "n3:0": TensorProto.FLOAT}
+        g = Graph([n1, n2, n3], output_shapes={}, dtypes=dtypes, opset=7)
+        g.add_model_input("input", helper.make_tensor_value_info("input", TensorProto.FLOAT, [2, 3]))
+        g.add_model_input("cond", helper.make_tensor_value_info("cond", TensorProto.BOOL, []))
+        g.make_const("b", np.ones((3,), dtype=np.float32))
+        for attr_name, op_type in [("then_branch", "Identity"), ("else_branch", "Neg")]:
+            body = Graph([helper.make_node(op_type, ["n1:0"], [attr_name + ":0"], name=attr_name)],
+                         output_shapes={}, dtypes={attr_name + ":0": TensorProto.FLOAT}, opset=7)
+            g.get_node_by_name("n2").set_body_graph_as_attr(attr_name, body, [], [attr_name + ":0"])
+        # If and its branches stay in float32, the branches read a float32 cast of n1:0
+        self.assertEqual(2, convert_float16(g, ["n3:0"]))
+        self.assertEqual(["Relu", "Cast", "If", "Cast", "Add"], [n.type for n in g.get_nodes()])
+        cast = g.get_nodes()[1]
+        self.assertEqual(TensorProto.FLOAT, g.get_dtype(cast.output[0]))
+        for body, _, _ in g.get_node_by_name("n2").get_body_graphs().values():
+            self.assertEqual([cast.output[0]], body.get_nodes()[0].input)
+        self.assertEqual(TensorProto.FLOAT16, g.get_dtype("n1:0"))
+        self.assertEqual(TensorProto.FLOAT, g.get_dtype("n2:0"))
+        self.assertEqual(TensorProto.FLOAT16, g.get_dtype("n3:0"))
+
+    def test_make_model_subgraph_initializer(self):
+        n1 = helper.make_node("If", ["cond"], ["n1:0"], name="n1")
+        g = Graph([n1], output_shapes={}, dtypes={"n1:0": TensorProto.FLOAT}, opset=7)
+        g.add_model_input("cond", helper.make_tensor_value_info("cond", TensorProto.BOOL, []))
+        g.make_const("c", np.ones((3,), dtype=np.float32))
+        for attr_name, op_type in [("then_branch", "Identity"), ("else_branch", "Neg")]:
+            body = Graph([helper.make_node(op_type, ["c"], [attr_name + ":0"], name=attr_name)],
+                         output_shapes={}, dtypes={attr_name + ":0": TensorProto.FLOAT}, opset=7)
+            g.get_node_by_name("n1").set_body_graph_as_attr(attr_name, body, [], [attr_name + ":0"])
+        # only the branches read c, it must stay an initializer of the model
+        model_proto = g.make_model("test", ["n1:0"], optimize=False)
+        self.assertEqual(["c"], [i.name for i in model_proto.graph.initializer])
+
+    def test_quantize_weights(self):
+        n1 = helper.make_node("MatMul", ["input", "w"], ["n1:0"], name="n1")
+        n2 = helper.make_node("Gemm", ["n1:0", "w"], ["n2:0"], name="n2", transB=1)
+        g = Graph([n1, n2], output_shapes={}, dtypes={}, opset=7)
+        w = np.array([[1, -0.5], [0.25, 0.5]], dtype=np.float32)
+        g.make_const("w", w)
+        report = quantize_weights(g, min_elements=4)
+        # the weight is used along two channel axes
+        self.assertEqual(2, report["weights"])
+        self.assertEqual(32, report["bytes_before"])
+        self.assertEqual(2 * (4 + 8), report["bytes_after"])
+        self.assertLess(report["max_error"], 0.5 / 127)
+        self.assertEqual(["Cast", "Mul", "Cast", "Mul", "MatMul", "Gemm"], [n.type for n in g.get_nodes()])
+        scale = numpy_helper.to_array(g.get_initializer(g.get_nodes()[1].input[1]))
+        self.assertTrue(np.allclose([[1. / 127, 0.5 / 127]], scale))
+
+    def test_quantize_static(self):
+        n1 = helper.make_node("Transpose", ["input"], ["n1:0"], name="n1", perm=[0, 3, 1, 2])
+        n2 = helper.make_node("Conv", ["n1:0", "w"], ["n2:0"], name="n2")
+        g = Graph([n1, n2], output_shapes={"n1:0": [1, 2, 4, 4]}, dtypes={"n1:0": TensorProto.FLOAT}, opset=10)
+        g.make_const("w", np.ones((3, 2, 1, 1), dtype=np.float32))
+        feeds = [{"input": np.array([-1.])}, {"input": np.array([3.])}]
+        seen = []
+
+        def run(names, feed):
+            seen.append(names)
+            return {name: feed[name] for name in names}
+
+        # the range is taken from the tensor before the layout op
+        path = tempfile.mkdtemp()
+        try:
+            cache_path = os.path.join(path, "ranges.json")
+            self.assertEqual({"input": [-1., 3.]}, calibrate(g, feeds, run, cache_path))
+            # the second run reads the cache
+            self.assertEqual({"input": [-1., 3.]}, calibrate(g, feeds, run, cache_path))
+            self.assertEqual(2, len(seen))
+        finally:
+            shutil.rmtree(path)
+        self.assertEqual(1, quantize_static(g, {"input": [-1., 3.]}))
+        self.assertEqual(["DequantizeLinear", "Transpose", "QuantizeLinear", "DequantizeLinear", "Conv"],
+                         [n.type for n in g.get_nodes()])
+        zero_point = numpy_helper.to_array(g.get_initializer(g.get_nodes()[2].input[2]))
+        self.assertEqual(64, zero_point)
+
+    def test_batch_variants(self):
+        n1 = helper.make_node("MatMul", ["input", "w"], ["n1:0"], name="n1")
+        g = Graph([n1], output_shapes={"n1:0": [-1, 256]}, dtypes={"n1:0": TensorProto.FLOAT}, opset=7)
+        g.add_model_input("input", helper.make_tensor_value_info("input", TensorProto.FLOAT, [-1, 4]))
+        g.set_shape("input", [-1, 4])
+        g.set_symbolic_shape("input", ["N", 4])
+        g.set_symbolic_shape("n1:0", ["N", 256])
+        g.make_const("w", np.ones((4, 256), dtype=np.float32))
+        path = tempfile.mkdtemp()
+        try:
+            paths = save_batch_variants(g, ["n1:0"], [1, 8], os.path.join(path, "model.onnx"), optimize=False)
+            self.assertEqual(["model_batch1.onnx", "model_batch8.onnx"], [os.path.basename(p) for p in paths])
+            # the weight is written once
+            self.assertEqual(4 * 256 * 4, os.path.getsize(os.path.join(path, "model.weights")))
+            for batch_size, model_path in zip([1, 8], paths):
+                model_proto = ModelProto()
+                with open(model_path, "rb") as f:
+                    model_proto.ParseFromString(f.read())
+                dims = [d.dim_value for d in model_proto.graph.output[0].type.tensor_type.shape.dim]
+                self.assertEqual([batch_size, 256], dims)
+                initializer = model_proto.graph.initializer[0]
+                self.assertEqual(TensorProto.EXTERNAL, initializer.data_location)
+                self.assertEqual({"location": "model.weights", "offset": "0", "length": "4096"},
+                                 {e.key: e.value for e in initializer.external_data})
+        finally:
+            shutil.rmtree(path)
+        # the graph keeps its unknown batch dimension
+        self.assertEqual([-1, 256], g.get_shape("n1:0"))
+
+    def test_extract(self):
+        n1 = helper.make_node("Abs", ["input"], ["n1:0"], name="n1")
+        n2 = helper.make_node("Add", ["n1:0", "c"], ["n2:0"], name="n2")
+        n3 = helper.make_node("Mul", ["n2:0", "n1:0"], ["n3:0"], name="n3")
+        shapes = {"input": [2, 3], "n1:0": [2, 3], "n2:0": [2, 3], "n3:0": [2, 3]}
+        dtypes = {name: TensorProto.FLOAT for name in shapes}
+        g = Graph([n1, n2, n3], output_shapes=shapes, dtypes=dtypes, opset=7)
+        g.add_model_input("input", helper.make_tensor_value_info("input", TensorProto.FLOAT, [2, 3]))
+        g.make_const("c", np.ones((2, 3), dtype=np.float32))
+        g2 = g.extract(["n1:0"], ["n2:0"])
+        self.assertEqual(["n2"], [n.name for n in g2.get_nodes()])
+        self.assertEqual(["n1:0"], list(g2.model_inputs))
+        self.assertEqual(["c"], list(g2.initializers))
+        self.assertEqual([2, 3], g2.get_shape("n2:0"))
+        # n3 also needs n1:0 which is computed from the model input
+        g3 = g.extract(["n2:0"], ["n3:0"])
+        self.assertEqual(["n1", "n3"], [n.name for n in g3.get_nodes()])
+        self.assertEqual(["input", "n2:0"], list(g3.model_inputs))
+
+        # the skip connection n1:0 is passed on to the last partition
+        parts = split_graph(g, ["n2:0"], ["n3:0"])
+        self.assertEqual(["n2:0", "n1:0"], parts[0][2])
+        self.assertEqual((["n2:0", "n1:0"], ["n3:0"]), parts[1][1:])
+        self.assertEqual(["n1", "n2"], [n.name for n in parts[0][0].get_nodes()])
+        self.assertEqual(["input"], list(parts[0][0].model_inputs))
+        with self.assertRaises(ValueError):
+            split_graph(g, ["n2:0", "n1:0"], ["n3:0"])
+
+    def test_split_graph_subgraph(self):
+        n1 = helper.make_node("Abs", ["input"], ["n1:0"], name="n1")
+        n2 = helper.make_node("Relu", ["n1:0"], ["n2:0"], name="n2")
+        n3 = helper.make_node("If", ["cond"], ["n3:0"], name="n3")
+        dtypes = {"n1:0": TensorProto.FLOAT, "n2:0": TensorProto.FLOAT, "n3:0": TensorProto.FLOAT}
+        g = Graph([n1, n2, n3], output_shapes={}, dtypes=dtypes, opset=7)
+        g.add_model_input("input", helper.make_tensor_value_info("input", TensorProto.FLOAT, [2, 3]))
+        g.add_model_input("cond", helper.make_tensor_value_info("cond", TensorProto.BOOL, []))
+        for attr_name, op_type, name in [("then_branch", "Identity", "n1:0"), ("else_branch", "Neg", "n2:0")]:
+            body = Graph([helper.make_node(op_type, [name], [attr_name + ":0"], name=attr_name)],
+                         output_shapes={}, dtypes={attr_name + ":0": TensorProto.FLOAT}, opset=7)
+            g.get_node_by_name("n3").set_body_graph_as_attr(attr_name, body, [], [attr_name + ":0"])
+        # the branches read n1:0 and n2:0, the If has only the cond as input
+        parts = split_graph(g, ["n2:0"], ["n3:0"])
+        self.assertEqual(["n1", "n2"], [n.name for n in parts[0][0].get_nodes()])
+        self.assertEqual(["n1:0", "n2:0"], sorted(parts[0][2]))
+        self.assertEqual(["n1:0", "n2:0"], parts[1][1])
+        self.assertEqual(["n3"], [n.name for n in parts[1][0].get_nodes()])
+        self.assertEqual(["cond", "n1:0", "n2:0"], sorted(parts[1][0].model_inputs))
+
+    def test_tf_fold_constants(self):
+        with tf.Graph().as_default() as tf_graph:
+            x = tf.placeholder(tf.float32, [2], name="input")
+            c = tf.add(tf.constant([1., 2.]), tf.constant([3., 4.]), name="c")
+            parts = tf.split(tf.constant([1., 2., 3., 4.]), 2, name="split")
+            shape = tf.cast(tf.shape(x, name="shape"), tf.float32, name="shape_float")
+            r = tf.random_uniform([2], name="r")
+            _ = tf.identity(x * c + parts[1] + shape + r, name="output")
+        graph_def = tf_fold_constants(tf_graph.as_graph_def(), ["input:0"], ["output:0"])
+        nodes = {n.name: n for n in graph_def.node}
+        self.assertEqual("Const", nodes["c"].op)
+        self.assertEqual([4., 6.], tf.make_ndarray(nodes["c"].attr["value"].tensor).tolist())
+        # the shape of the placeholder is static
+        self.assertEqual([2.], tf.make_ndarray(nodes["shape_float"].attr["value"].tensor).tolist())
+        # split has two outputs, the used one gets a new Const
+        self.assertEqual([], [n.name for n in graph_def.node if "split:1" in n.input])
+        # random ops are never folded
+        self.assertIn("RandomUniform", [n.op for n in graph_def.node])
+        self.assertNotEqual("Const", nodes["r"].op)
+        self.assertEqual("Placeholder", nodes["input"].op)
+
+    def test_cmdarg_parse_named_dims(self):
+        arg = "X:0[N,224,224,3],Y:0[N,-1]"
+        inputs, shape_override = tf2onnx.utils.split_nodename_and_shape(arg)
+        self.assertEqual(["X:0", "Y:0"], inputs)
+        self.assertEqual({"X:0": ["N", 224, 224, 3], "Y:0": ["N", -1]}, shape_override)
+
+    def test_symbolic_dims_in_model(self):
+        n1 = helper.make_node("Concat", ["x", "y"], ["n1:0"], name="n1", axis=1)
+        n2 = helper.make_node("Relu", ["n1:0"], ["n2:0"], name="n2")
+        g = Graph([n1, n2], output_shapes={"x": [-1, 3], "y": [-1, 3]},
+                  dtypes={"n2:0": TensorProto.FLOAT}, opset=7)
+        g.set_symbolic_shape("x", ["N", 3])
+        for name in ["x", "y"]:
+            g.add_model_input(name, helper.make_tensor_value_info(name, TensorProto.FLOAT, g.get_onnx_shape(name)))
+        infer_shapes(g)
+        model_proto = g.make_model("test", ["n2:0"], optimize=False)
+        dims = [i.type.tensor_type.shape.dim[0].dim_param for i in model_proto.graph.input]
+        dims.append(model_proto.graph.output[0].type.tensor_type.shape.dim[0].dim_param)
+        self.assertEqual(["N", "N", "N"], dims)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -7,7 +7,11 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 
-__all__ = ["utils", "graph_matcher", "graph", "tfonnx"]
+__all__ = ["utils", "graph_matcher", "graph", "graph_validator", "checkpoint", "shape_inference", "dtype_inference",
+           "float16", "quantization", "batch_variants",
+           "partition", "tfonnx"]
 
 from .version import version as __version__
-from tf2onnx import tfonnx, utils, graph, graph_matcher  # pylint: disable=wrong-import-order
+# pylint: disable=wrong-import-order
+from tf2onnx import tfonnx, utils, graph, graph_matcher, graph_validator, checkpoint, shape_inference, \
+    dtype_inference, float16, quantization, batch_variants, partition
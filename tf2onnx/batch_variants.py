@@ -0,0 +1,157 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+"""
+tf2onnx.batch_variants - save one converted graph as models for fixed batch sizes that share one weight file
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import hashlib
+import logging
+import os
+
+from onnx import helper, numpy_helper, onnx_pb
+
+from tf2onnx.shape_inference import infer_shapes
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.batch_variants")
+
+# smaller initializers stay in the model
+DEFAULT_SIZE_THRESHOLD = 1024
+
+_DATA_FIELDS = ["raw_data", "float_data", "int32_data", "int64_data", "double_data", "uint64_data"]
+
+
+def batch_shape_override(g, batch_size):
+    """shape_override that sets the unknown first dim of all model inputs to batch_size."""
+    shape_override = {}
+    for name in g.model_inputs:
+        shape = g.get_shape(name)
+        symbolic = g.get_symbolic_shape(name)
+        if not shape:
+            continue
+        if shape[0] == -1 or symbolic and len(symbolic) == len(shape) and isinstance(symbolic[0], str):
+            shape_override[name] = [batch_size] + list(shape[1:])
+    if not shape_override:
+        raise ValueError("no model input has an unknown batch dimension")
+    return shape_override
+
+
+def specialize_shapes(g, shape_override):
+    """Give the model inputs in shape_override static shapes.
+    An unknown input dim that becomes known is replaced in all tensors sharing its symbol, shape inference then
+    passes the new dims on to the rest of the graph.
+    """
+    values = {}
+    for name, new_shape in shape_override.items():
+        if not g.is_model_input(name):
+            raise ValueError("{} is not a model input".format(name))
+        shape = list(g.get_shape(name) or [])
+        if len(shape) != len(new_shape):
+            raise ValueError("shape {} doesn't fit the shape {} of {}".format(new_shape, shape, name))
+        symbolic = g.get_symbolic_shape(name) or [None] * len(shape)
+        for d, s, new in zip(shape, symbolic, new_shape):
+            if d != -1 and d != new:
+                raise ValueError("shape {} doesn't fit the shape {} of {}".format(new_shape, shape, name))
+            if isinstance(s, str):
+                values[s] = new
+        g.set_shape(name, list(new_shape))
+        g.set_symbolic_shape(name, list(new_shape))
+        dtype = g.model_inputs[name].type.tensor_type.elem_type
+        g.model_inputs[name] = helper.make_tensor_value_info(name, dtype, list(new_shape))
+    for name, dims in list(g.symbolic_shapes.items()):
+        if not any(isinstance(d, str) and d in values for d in dims):
+            continue
+        dims = [values.get(d, d) if isinstance(d, str) else d for d in dims]
+        g.set_symbolic_shape(name, dims)
+        shape = g.get_shape(name)
+        if shape and len(shape) == len(dims):
+            g.set_shape(name, [d if isinstance(d, int) else s for d, s in zip(dims, shape)])
+    infer_shapes(g)
+
+
+class _WeightFile(object):
+    """Append only file of tensor payloads, a payload that is already in the file is not written again."""
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self._offsets = {}
+        self._f = open(path, "wb")
+
+    def add(self, data):
+        key = (len(data), hashlib.sha1(data).hexdigest())
+        if key not in self._offsets:
+            self._offsets[key] = self.size
+            self._f.write(data)
+            self.size += len(data)
+        return self._offsets[key]
+
+    def close(self):
+        self._f.close()
+
+
+def _externalize(model_proto, weight_file, size_threshold):
+    """Move the payload of the big initializers of model_proto to weight_file."""
+    location = os.path.basename(weight_file.path)
+    for tensor in model_proto.graph.initializer:
+        if tensor.data_type == onnx_pb.TensorProto.STRING:
+            continue
+        data = tensor.raw_data or numpy_helper.to_array(tensor).tobytes()
+        if len(data) < size_threshold:
+            continue
+        offset = weight_file.add(data)
+        for field in _DATA_FIELDS:
+            tensor.ClearField(field)
+        tensor.data_location = onnx_pb.TensorProto.EXTERNAL
+        del tensor.external_data[:]
+        for key, value in [("location", location), ("offset", str(offset)), ("length", str(len(data)))]:
+            entry = tensor.external_data.add()
+            entry.key = key
+            entry.value = value
+
+
+def save_batch_variants(g, output_names, batch_sizes, output_path, doc="", optimize=True, optimizer_passes=None,
+                        size_threshold=DEFAULT_SIZE_THRESHOLD):
+    """Save the converted graph g as one model per batch size, all models read their weights from one file.
+    For output_path model.onnx the models are model_batch<N>.onnx and the weights are in model.weights next
+    to them. The shapes of g are restored after every variant, g itself doesn't change.
+    Args:
+        g: the Graph, converted with an unknown batch dimension
+        output_names: list of model outputs
+        batch_sizes: list of batch sizes
+        output_path: name the file names are derived from
+        doc, optimize, optimizer_passes: like Graph.make_model()
+        size_threshold: initializers with less bytes stay in the models
+    Returns:
+        list of the model file names
+    """
+    if not hasattr(onnx_pb.TensorProto, "EXTERNAL"):
+        raise ValueError("the installed onnx has no support for external data")
+    base, ext = os.path.splitext(output_path)
+    weight_file = _WeightFile(base + ".weights")
+    paths = []
+    try:
+        for batch_size in batch_sizes:
+            saved = [copy.deepcopy(shapes) for shapes in [g.output_shapes, g.symbolic_shapes, g.model_inputs]]
+            try:
+                specialize_shapes(g, batch_shape_override(g, batch_size))
+                model_proto = g.make_model(doc, output_names, optimize=optimize, optimizer_passes=optimizer_passes)
+            finally:
+                for shapes, old in zip([g.output_shapes, g.symbolic_shapes, g.model_inputs], saved):
+                    shapes.clear()
+                    shapes.update(old)
+            _externalize(model_proto, weight_file, size_threshold)
+            path = "{}_batch{}{}".format(base, batch_size, ext or ".onnx")
+            with open(path, "wb") as f:
+                f.write(model_proto.SerializeToString())
+            paths.append(path)
+    finally:
+        weight_file.close()
+    log.info("saved %d batch variant(s) sharing %d bytes of weights in %s", len(paths), weight_file.size,
+             weight_file.path)
+    return paths
@@ -0,0 +1,207 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+"""
+tf2onnx.checkpoint - save the internal graph after a conversion phase and resume from it
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import json
+import logging
+import os
+
+import numpy as np
+from onnx import helper, numpy_helper, onnx_pb
+
+from tf2onnx.graph import Node, Graph
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.checkpoint")
+
+# phases of process_tf_graph after which the graph can be saved, in the order they run
+PHASES = ["import", "rewrite", "mapping", "final"]
+
+_GRAPH_FILE = "graph.pb"
+_META_FILE = "meta.json"
+_WEIGHTS_FILE = "weights.bin"
+# subgraphs of nodes, like the body of Loop, are saved in numbered subdirectories
+_BODY_DIR = "body{}"
+
+# weights are aligned in the weights file so they can be mapped directly into memory
+_ALIGNMENT = 64
+
+
+def _to_json(obj):
+    """Make shapes (which can be numpy values or protobuf containers) serializable."""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return list(obj)
+
+
+class _WeightsWriter(object):
+    """Write tensor payloads into a single raw file."""
+
+    def __init__(self, path):
+        self._f = open(path, "wb")
+        self._offset = 0
+
+    def add(self, tensor):
+        """Write the payload of tensor, returns the entry for the index or None if it stays in the proto."""
+        if tensor.data_type == onnx_pb.TensorProto.STRING:
+            return None
+        val = numpy_helper.to_array(tensor)
+        padding = -self._offset % _ALIGNMENT
+        self._f.write(b"\0" * padding)
+        self._offset += padding
+        entry = {"dtype": val.dtype.str, "shape": list(val.shape), "offset": self._offset}
+        data = np.ascontiguousarray(val).tobytes()
+        self._f.write(data)
+        self._offset += len(data)
+        return entry
+
+    def close(self):
+        self._f.close()
+
+
+def _make_stub(tensor):
+    """Tensor with name, dtype and dims but without data."""
+    stub = onnx_pb.TensorProto()
+    stub.name = tensor.name
+    stub.data_type = tensor.data_type
+    stub.dims.extend(tensor.dims)
+    return stub
+
+
+def _load_weight(weights, entry, name):
+    val = np.frombuffer(weights, dtype=np.dtype(entry["dtype"]),
+                        count=int(np.prod(entry["shape"])), offset=entry["offset"])
+    return numpy_helper.from_array(val.reshape(entry["shape"]), name)
+
+
+def save_graph(g, path, phase):
+    """Save graph g after the given phase into the directory path."""
+    if phase not in PHASES:
+        raise ValueError("unknown phase " + phase)
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    writer = _WeightsWriter(os.path.join(path, _WEIGHTS_FILE))
+    nodes = []
+    nodes_meta = {}
+    attr_weights = {}
+    bodies = 0
+    for node in g.get_nodes():
+        # keep all attributes, before mapping the tensorflow attributes are still needed
+        onnx_node = helper.make_node(node.type, node.input, node.output, name=node.name)
+        if node.domain:
+            onnx_node.domain = node.domain
+        for a in node.attr.values():
+            if a.name in node.get_body_graphs():
+                continue
+            attr = onnx_node.attribute.add()
+            attr.CopyFrom(a)
+            if attr.type == onnx_pb.AttributeProto.TENSOR:
+                entry = writer.add(attr.t)
+                if entry is not None:
+                    attr_weights.setdefault(node.name, {})[attr.name] = entry
+                    attr.t.CopyFrom(_make_stub(attr.t))
+        nodes.append(onnx_node)
+        nodes_meta[node.name] = {
+            "dtype": node.dtype,
+            "data_format": node.data_format,
+            "inserted_nchw": node.inserted_nchw,
+            "skip_conversion": node.need_skip(),
+        }
+        for attr_name, (body, input_names, output_names) in sorted(node.get_body_graphs().items()):
+            body_dir = _BODY_DIR.format(bodies)
+            bodies += 1
+            save_graph(body, os.path.join(path, body_dir), phase)
+            nodes_meta[node.name].setdefault("body_graphs", {})[attr_name] = [body_dir, input_names, output_names]
+
+    initializers = []
+    initializer_weights = {}
+    for name, tensor in g.initializers.items():
+        entry = writer.add(tensor)
+        if entry is None:
+            initializers.append(tensor)
+        else:
+            initializer_weights[name] = entry
+            initializers.append(_make_stub(tensor))
+    writer.close()
+
+    graph = helper.make_graph(nodes, "tf2onnx", list(g.model_inputs.values()), [], initializer=initializers)
+    with open(os.path.join(path, _GRAPH_FILE), "wb") as f:
+        f.write(graph.SerializeToString())
+
+    extra_opset = g.extra_opset or []
+    meta = {
+        "phase": phase,
+        "opset": g.opset,
+        "target": sorted(g.target),
+        "extra_opset": [[i.domain, i.version] for i in extra_opset],
+        "shapes": g.output_shapes,
+        "symbolic_shapes": g.symbolic_shapes,
+        "dtypes": g.dtypes,
+        "dtypes_override": g.dtypes_override,
+        "nodes": nodes_meta,
+        "initializer_weights": initializer_weights,
+        "attr_weights": attr_weights,
+    }
+    with open(os.path.join(path, _META_FILE), "w") as f:
+        json.dump(meta, f, default=_to_json)
+    log.info("saved graph after phase %s to %s", phase, path)
+
+
+def load_graph(path):
+    """Load a graph saved with save_graph(). Returns the graph and the phase it was saved after."""
+    with open(os.path.join(path, _META_FILE), "r") as f:
+        meta = json.load(f)
+    graph = onnx_pb.GraphProto()
+    with open(os.path.join(path, _GRAPH_FILE), "rb") as f:
+        graph.ParseFromString(f.read())
+
+    weights_path = os.path.join(path, _WEIGHTS_FILE)
+    if os.path.getsize(weights_path) > 0:
+        weights = np.memmap(weights_path, dtype=np.uint8, mode="r")
+    else:
+        weights = np.zeros(0, dtype=np.uint8)
+
+    extra_opset = [helper.make_opsetid(domain, version) for domain, version in meta["extra_opset"]]
+    g = Graph([], meta["shapes"], meta["dtypes"], meta["target"], meta["opset"], extra_opset or None)
+
+    attr_weights = meta["attr_weights"]
+    nodes_meta = meta["nodes"]
+    ops = []
+    for onnx_node in graph.node:
+        for attr in onnx_node.attribute:
+            entry = attr_weights.get(onnx_node.name, {}).get(attr.name)
+            if entry is not None:
+                attr.t.CopyFrom(_load_weight(weights, entry, attr.t.name))
+        node_meta = nodes_meta[onnx_node.name]
+        node = Node(onnx_node, g, skip_conversion=node_meta["skip_conversion"])
+        node.dtype = node_meta["dtype"]
+        node.data_format = node_meta["data_format"]
+        node.inserted_nchw = node_meta["inserted_nchw"]
+        for attr_name, (body_dir, input_names, output_names) in node_meta.get("body_graphs", {}).items():
+            body, _ = load_graph(os.path.join(path, body_dir))
+            node.set_body_graph_as_attr(attr_name, body, input_names, output_names)
+        ops.append(node)
+    g.set_nodes(ops)
+
+    initializer_weights = meta["initializer_weights"]
+    for tensor in graph.initializer:
+        entry = initializer_weights.get(tensor.name)
+        if entry is not None:
+            tensor = _load_weight(weights, entry, tensor.name)
+        g.add_initializer(tensor)
+    for name, shape in meta.get("symbolic_shapes", {}).items():
+        g.set_symbolic_shape(name, shape)
+    for name, dtype in meta["dtypes_override"].items():
+        g.override_dtype(name, dtype)
+    for value_info in graph.input:
+        g.add_model_input(value_info.name, value_info)
+
+    log.info("loaded graph saved after phase %s from %s", meta["phase"], path)
+    return g, meta["phase"]
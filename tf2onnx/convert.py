@@ -16,8 +16,14 @@ from onnx import helper
 import tensorflow as tf
 
 import tf2onnx.utils
-from tf2onnx.optimizer.transpose_optimizer import TransposeOptimizer
-from tf2onnx.tfonnx import process_tf_graph, tf_optimize, DEFAULT_TARGET, POSSIBLE_TARGETS
+from tf2onnx.batch_variants import save_batch_variants
+from tf2onnx.float16 import convert_float16
+from tf2onnx.graph import INITIALIZER_PASSES
+from tf2onnx.optimizer import optimize_graph
+from tf2onnx.optimizer.peephole_optimizer import PeepholeOptimizer
+from tf2onnx.partition import save_partitions
+from tf2onnx.quantization import calibrate, load_calibration_data, quantize_static, quantize_weights, tf_runner
+from tf2onnx.tfonnx import process_tf_graph, tf_optimize, tf_specialize_shapes, DEFAULT_TARGET, POSSIBLE_TARGETS
 
 _TENSORFLOW_DOMAIN = "ai.onnx.converters.tensorflow"
 
@@ -27,7 +33,7 @@ _TENSORFLOW_DOMAIN = "ai.onnx.converters.tensorflow"
 def get_args():
     """Parse commandline."""
     parser = argparse.ArgumentParser()
-    parser.add_argument("--input", required=True, help="input model file")
+    parser.add_argument("--input", help="input model file")
     parser.add_argument("--output", help="output model file")
     parser.add_argument("--inputs", required=True, help="model input_names")
     parser.add_argument("--outputs", required=True, help="model output_names")
@@ -38,19 +44,63 @@ def get_args():
     parser.add_argument("--verbose", help="verbose output", action="store_true")
     parser.add_argument("--fold_const", help="enable tf constant_folding transformation before conversion",
                         action="store_true")
+    parser.add_argument("--onnx-optimizer-passes",
+                        help="comma separated list of onnx optimizer passes to run, the weights are only passed "
+                             "to the optimizer for the passes that fold them: " + ", ".join(INITIALIZER_PASSES))
+    parser.add_argument("--validate-graph", help="debug: validate the internal graph after each rewriter",
+                        action="store_true")
+    parser.add_argument("--specialize-shapes", help="convert for the static input shapes given in --inputs",
+                        action="store_true")
+    parser.add_argument("--checkpoint-dir", help="save the internal graph after conversion phases into this directory")
+    parser.add_argument("--checkpoint-phases", help="comma separated list of phases to save, default is all")
+    parser.add_argument("--resume-from", help="resume the conversion from a saved phase instead of the input model")
+    parser.add_argument("--float16", help="convert float weights and tensors to float16", action="store_true")
+    parser.add_argument("--float16-blacklist", help="comma separated list of ops that stay in float32 with --float16")
+    parser.add_argument("--keep-io-types", help="with --float16 keep model inputs and outputs in float32",
+                        action="store_true")
+    parser.add_argument("--quantize-weights", help="store the weights of MatMul, Gemm, Conv and rnn ops as int8",
+                        action="store_true")
+    parser.add_argument("--calibration-data", help="npz file with input batches, quantize Conv, MatMul and Gemm "
+                                                   "activations to int8 with the ranges seen by tensorflow")
+    parser.add_argument("--calibration-cache", help="json file to read and save the calibrated ranges")
+    parser.add_argument("--batch-sizes", help="comma separated list of batch sizes, save one model per batch size, "
+                                              "the models share one weight file")
+    parser.add_argument("--split-at", help="comma separated list of tensors, save one model per part of the graph "
+                                           "between them")
     # experimental
     parser.add_argument("--inputs-as-nchw", help="transpose inputs as from nhwc to nchw")
     # depreciated, going to be removed some time in the future
     parser.add_argument("--unknown-dim", type=int, default=-1, help="default for unknown dimensions")
     args = parser.parse_args()
+    if not args.input and not args.resume_from:
+        parser.error("one of --input or --resume-from is required")
 
     args.shape_override = None
     if args.inputs:
         args.inputs, args.shape_override = tf2onnx.utils.split_nodename_and_shape(args.inputs)
+    if args.specialize_shapes and (not args.inputs or args.shape_override is None or
+                                   any(i not in args.shape_override for i in args.inputs)):
+        parser.error("--specialize-shapes needs the shape of all inputs, for example --inputs X:0[1,224,224,3]")
     if args.outputs:
         args.outputs = args.outputs.split(",")
     if args.inputs_as_nchw:
         args.inputs_as_nchw = args.inputs_as_nchw.split(",")
+    if args.checkpoint_phases:
+        args.checkpoint_phases = args.checkpoint_phases.split(",")
+    if (args.calibration_data or args.calibration_cache) and (args.float16 or args.quantize_weights):
+        parser.error("calibrated quantization can't be combined with --float16 or --quantize-weights")
+    if args.batch_sizes:
+        if not args.output or args.specialize_shapes:
+            parser.error("--batch-sizes needs --output and can't be combined with --specialize-shapes")
+        args.batch_sizes = [int(i) for i in args.batch_sizes.split(",")]
+    if args.split_at:
+        if not args.output or args.batch_sizes:
+            parser.error("--split-at needs --output and can't be combined with --batch-sizes")
+        args.split_at = args.split_at.split(",")
+    if args.float16_blacklist:
+        args.float16_blacklist = args.float16_blacklist.split(",")
+    if args.onnx_optimizer_passes:
+        args.onnx_optimizer_passes = args.onnx_optimizer_passes.split(",")
     if args.target:
         args.target = args.target.split(",")
         for target in args.target:
@@ -86,30 +136,65 @@ def main():
         custom_ops = {}
         extra_opset = None
 
-    graph_def = tf.GraphDef()
-    with tf.gfile.FastGFile(args.input, 'rb') as f:
-        graph_def.ParseFromString(f.read())
-
-    # todo: consider to enable const folding by default?
-    graph_def = tf_optimize(args.inputs, args.outputs, graph_def, args.fold_const)
-    with tf.Graph().as_default() as tf_graph:
-        tf.import_graph_def(graph_def, name='')
-    with tf.Session(graph=tf_graph):
-        g = process_tf_graph(tf_graph,
-                             continue_on_error=args.continue_on_error,
-                             verbose=args.verbose,
-                             target=args.target,
-                             opset=args.opset,
-                             custom_op_handlers=custom_ops,
-                             extra_opset=extra_opset,
-                             shape_override=args.shape_override)
-
-    optimizer = TransposeOptimizer(g, args.verbose is not None)
-    optimizer.optimize()
-
-    model_proto = g.make_model(
-        "converted from {}".format(args.input), args.outputs,
-        optimize=not args.continue_on_error)
+    process_args = dict(continue_on_error=args.continue_on_error,
+                        verbose=args.verbose,
+                        target=args.target,
+                        opset=args.opset,
+                        custom_op_handlers=custom_ops,
+                        extra_opset=extra_opset,
+                        shape_override=args.shape_override,
+                        validate_graph=args.validate_graph,
+                        checkpoint_dir=args.checkpoint_dir,
+                        checkpoint_phases=args.checkpoint_phases,
+                        output_names=args.outputs)
+
+    tf_graph = None
+    if args.resume_from:
+        # the saved graph already went through tf_optimize and the tensorflow import
+        g = process_tf_graph(None, resume_from=args.resume_from, **process_args)
+    else:
+        graph_def = tf.GraphDef()
+        with tf.gfile.FastGFile(args.input, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        if args.specialize_shapes:
+            graph_def = tf_specialize_shapes(graph_def, args.shape_override)
+        # todo: consider to enable const folding by default?
+        graph_def = tf_optimize(args.inputs, args.outputs, graph_def, args.fold_const)
+        with tf.Graph().as_default() as tf_graph:
+            tf.import_graph_def(graph_def, name='')
+        with tf.Session(graph=tf_graph):
+            g = process_tf_graph(tf_graph, **process_args)
+
+    optimize_graph(g, args.outputs, args.verbose, static_shapes=args.specialize_shapes)
+    if args.float16:
+        convert_float16(g, args.outputs, args.float16_blacklist, args.keep_io_types)
+        # casts at the region boundaries can meet casts that were in the graph
+        PeepholeOptimizer(g, output_names=args.outputs).optimize()
+    if args.quantize_weights:
+        quantize_weights(g)
+    if args.calibration_data or args.calibration_cache:
+        feeds = load_calibration_data(args.calibration_data) if args.calibration_data else []
+        if tf_graph is None:
+            # without the tensorflow graph only the cached ranges are known
+            ranges = calibrate(g, cache_path=args.calibration_cache)
+        else:
+            with tf.Session(graph=tf_graph) as sess:
+                ranges = calibrate(g, feeds, tf_runner(sess), args.calibration_cache)
+        quantize_static(g, ranges)
+
+    doc = "converted from {}".format(args.input or args.resume_from)
+    if args.batch_sizes:
+        save_batch_variants(g, args.outputs, args.batch_sizes, args.output, doc,
+                            optimize=not args.continue_on_error, optimizer_passes=args.onnx_optimizer_passes)
+        return
+    if args.split_at:
+        save_partitions(g, args.split_at, args.outputs, args.output, doc,
+                        optimize=not args.continue_on_error, optimizer_passes=args.onnx_optimizer_passes)
+        return
+
+    model_proto = g.make_model(doc, args.outputs, optimize=not args.continue_on_error,
+                               optimizer_passes=args.onnx_optimizer_passes)
 
     # write onnx graph
     if args.output:
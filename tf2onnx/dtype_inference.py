@@ -0,0 +1,134 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+"""
+tf2onnx.dtype_inference - infer the dtypes of the onnx graph from the op types
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import logging
+
+from onnx import onnx_pb
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.dtype_inference")
+
+# pylint: disable=unused-argument,missing-docstring
+
+_INT64 = onnx_pb.TensorProto.INT64
+_BOOL = onnx_pb.TensorProto.BOOL
+
+
+def _same_as_input(node, dtypes):
+    return [dtypes[0]] * len(node.output)
+
+
+def _first_output_as_input(node, dtypes):
+    return [dtypes[0]]
+
+
+def _int64(node, dtypes):
+    return [_INT64]
+
+
+def _bool(node, dtypes):
+    return [_BOOL]
+
+
+def _cast(node, dtypes):
+    to = node.get_attr("to")
+    if to.type == onnx_pb.AttributeProto.STRING:
+        # before opset 6 the type is given by name
+        return [onnx_pb.TensorProto.DataType.Value(to.s.decode("utf-8"))]
+    return [to.i]
+
+
+def _dtype_attr(node, dtypes):
+    dtype = node.get_attr("dtype")
+    if dtype is None:
+        # like ops take the type of the input, the others default to float
+        return [dtypes[0] if dtypes else onnx_pb.TensorProto.FLOAT]
+    return [dtype.i]
+
+
+def _topk(node, dtypes):
+    return [dtypes[0], _INT64]
+
+
+def _where(node, dtypes):
+    return [dtypes[1]]
+
+
+_SAME_AS_INPUT_OPS = [
+    "Abs", "Add", "AveragePool", "BatchNormalization", "Ceil", "Clip", "Concat", "Conv", "ConvTranspose",
+    "Cos", "DepthToSpace", "Div", "Elu", "Exp", "Expand", "Flatten", "Floor", "Gather", "Gemm",
+    "GlobalAveragePool", "GlobalMaxPool", "HardSigmoid", "Identity", "InstanceNormalization", "LRN",
+    "LeakyRelu", "Log", "LogSoftmax", "MatMul", "Max", "Mean", "Min", "Mul", "Neg", "PRelu", "Pad",
+    "Pow", "Reciprocal", "ReduceL1", "ReduceL2", "ReduceLogSumExp", "ReduceMax", "ReduceMean", "ReduceMin",
+    "ReduceProd", "ReduceSum", "ReduceSumSquare", "Relu", "Reshape", "Selu", "Sigmoid", "Sin", "Slice", "Softmax",
+    "Softplus", "Softsign", "SpaceToDepth", "Split", "Sqrt", "Squeeze", "Sub", "Sum", "Tan", "Tanh",
+    "ThresholdedRelu", "Tile", "Transpose", "Unsqueeze", "Upsample",
+]
+
+_BOOL_OPS = ["And", "Equal", "Greater", "IsNaN", "Less", "Not", "Or", "Xor"]
+
+_RULES = {
+    "ArgMax": _int64,
+    "ArgMin": _int64,
+    "Cast": _cast,
+    "Dropout": _first_output_as_input,
+    # the optional second output has the indices
+    "MaxPool": _first_output_as_input,
+    "NonZero": _int64,
+    "RandomNormal": _dtype_attr,
+    "RandomNormalLike": _dtype_attr,
+    "RandomUniform": _dtype_attr,
+    "RandomUniformLike": _dtype_attr,
+    "Shape": _int64,
+    "Size": _int64,
+    "TopK": _topk,
+    "Where": _where,
+}
+_RULES.update({op: _same_as_input for op in _SAME_AS_INPUT_OPS})
+_RULES.update({op: _bool for op in _BOOL_OPS})
+
+
+def _input_dtype(g, name):
+    if not name:
+        return None
+    if g.is_initializer(name):
+        return g.get_initializer(name).data_type
+    if g.is_model_input(name):
+        return g.model_inputs[name].type.tensor_type.elem_type
+    return g.get_dtype(name)
+
+
+def infer_dtypes(g):
+    """Set the dtype of every output of the onnx graph g that can be derived from the op type.
+    Runs after the ops are mapped to onnx. The result of the op type rules replaces what tensorflow
+    told us, for example the output of Shape is int64 in onnx but int32 in tensorflow.
+    Returns:
+        number of dtypes that changed
+    """
+    changed = 0
+    for node in g.get_nodes():
+        rule = _RULES.get(node.type)
+        if rule is None or node.domain:
+            continue
+        dtypes = [_input_dtype(g, i) for i in node.input]
+        try:
+            outputs = rule(node, dtypes)
+        except (AttributeError, IndexError, ValueError) as ex:
+            log.debug("dtype inference failed for %s: %s", node.name, ex)
+            continue
+        for name, dtype in zip(node.output, outputs):
+            if not name or not dtype:
+                continue
+            if g.get_dtype(name) != dtype:
+                log.debug("dtype of %s changed from %s to %s", name, g.get_dtype(name), dtype)
+                g.set_dtype(name, dtype)
+                changed += 1
+    log.debug("dtype inference changed %d dtype(s)", changed)
+    return changed
@@ -0,0 +1,180 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+"""
+tf2onnx.float16 - convert the float32 parts of the onnx graph to float16
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import logging
+
+import numpy as np
+from onnx import helper, numpy_helper, onnx_pb
+
+from tf2onnx import utils
+from tf2onnx.graph import Node
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.float16")
+
+_FLOAT = onnx_pb.TensorProto.FLOAT
+_FLOAT16 = onnx_pb.TensorProto.FLOAT16
+
+# ops that lose too much precision in float16, they keep running in float32
+DEFAULT_BLACKLIST = [
+    "Exp", "Log", "LogSoftmax", "ReduceL1", "ReduceL2", "ReduceLogSumExp", "ReduceMean", "ReduceProd",
+    "ReduceSum", "ReduceSumSquare", "Softmax",
+]
+
+
+# inputs that are always float32, whatever type the op runs in
+_FLOAT_INPUTS = {
+    "Resize": [1, 2],
+    "Upsample": [1],
+}
+
+
+def _dtype(g, name):
+    if g.is_initializer(name):
+        return g.get_initializer(name).data_type
+    if g.is_model_input(name):
+        return g.model_inputs[name].type.tensor_type.elem_type
+    return g.get_dtype(name)
+
+
+def _make_cast(g, input_name, to, output_name=None):
+    op_name = utils.make_name("Cast")
+    if output_name is None:
+        output_name = utils.port_name(op_name)
+    node = Node(helper.make_node("Cast", [input_name], [output_name], name=op_name, to=to), g)
+    g.set_dtype(output_name, to)
+    g.copy_shape(input_name, output_name)
+    return node
+
+
+def convert_float16(g, output_names=None, blacklist=None, keep_io_types=False):
+    """Run the float32 parts of the onnx graph g in float16.
+    Float32 outputs of all ops except the ones in blacklist, custom ops and ops with subgraphs like Loop
+    and If become float16, float32 initializers used by these ops are converted. Cast nodes are inserted where
+    a tensor crosses from a float16 to a float32 op or back, one per tensor and direction.
+    Args:
+        g: the Graph, after the ops are mapped to onnx
+        output_names: list of model outputs
+        blacklist: op types that stay in float32, default is DEFAULT_BLACKLIST
+        keep_io_types: model inputs and outputs stay float32
+    Returns:
+        number of Cast nodes inserted
+    """
+    if blacklist is None:
+        blacklist = DEFAULT_BLACKLIST
+    blacklist = set(blacklist)
+    output_names = output_names or []
+
+    def in_float16(node):
+        # the subgraphs keep their float32 types
+        return not node.domain and node.type not in blacklist and not node.get_body_graphs()
+
+    nodes = g.get_nodes()
+    consumers = collections.defaultdict(list)
+    for node in nodes:
+        for name in node.input + node.get_implicit_inputs():
+            consumers[name].append(node)
+
+    # outputs of ops that run in float16
+    for node in nodes:
+        if not in_float16(node):
+            continue
+        for name in node.output:
+            if g.get_dtype(name) == _FLOAT:
+                g.set_dtype(name, _FLOAT16)
+        for attr_name in ["to", "dtype"]:
+            attr = node.get_attr(attr_name)
+            if attr is not None and attr.type == onnx_pb.AttributeProto.INT and attr.i == _FLOAT:
+                node.set_attr(attr_name, _FLOAT16)
+
+    if not keep_io_types:
+        for name, value_info in g.model_inputs.items():
+            if value_info.type.tensor_type.elem_type == _FLOAT:
+                value_info.type.tensor_type.elem_type = _FLOAT16
+                g.set_dtype(name, _FLOAT16)
+
+    # weights are converted for the ops that run in float16, a weight shared with a float32 op is copied
+    converted = 0
+    for name, tensor in list(g.initializers.items()):
+        if tensor.data_type != _FLOAT:
+            continue
+        users = [n for n in consumers[name] if in_float16(n) and n.type != "Cast"
+                 and not any(n.input[i] == name for i in _FLOAT_INPUTS.get(n.type, []) if i < len(n.input))]
+        if not users:
+            continue
+        value = numpy_helper.to_array(tensor).astype(np.float16)
+        if len(users) == len(consumers[name]) and name not in output_names:
+            g.update_initializer(name, value)
+        else:
+            new_name = utils.make_name(name)
+            g.make_const(new_name, value)
+            for node in users:
+                g.replace_input(node, name, new_name)
+        converted += 1
+
+    # casts where a tensor crosses between float16 and float32 ops, Cast itself takes any type
+    casts = {}
+    new_nodes = []
+    for node in nodes:
+        if node.type == "Cast":
+            continue
+        op_type = _FLOAT16 if in_float16(node) else _FLOAT
+        for i, name in enumerate(node.input):
+            have = _dtype(g, name)
+            want = _FLOAT if i in _FLOAT_INPUTS.get(node.type, []) else op_type
+            if have not in [_FLOAT, _FLOAT16] or have == want:
+                continue
+            if (name, want) not in casts:
+                cast = _make_cast(g, name, want)
+                casts[(name, want)] = cast.output[0]
+                new_nodes.append(cast)
+            node.input[i] = casts[(name, want)]
+        # the outer tensors the subgraphs use
+        for name in node.get_implicit_inputs():
+            if _dtype(g, name) != _FLOAT16:
+                continue
+            if (name, _FLOAT) not in casts:
+                cast = _make_cast(g, name, _FLOAT)
+                casts[(name, _FLOAT)] = cast.output[0]
+                new_nodes.append(cast)
+            node.replace_implicit_input(name, casts[(name, _FLOAT)])
+
+    if keep_io_types:
+        # the float32 output is made by a cast of the float16 result which gets a new name
+        producers = {name: node for node in nodes for name in node.output}
+        for name in output_names:
+            producer = producers.get(name)
+            if producer is None or g.get_dtype(name) != _FLOAT16:
+                continue
+            half_name = utils.port_name(utils.make_name(utils.node_name(name)))
+            producer.output[producer.output.index(name)] = half_name
+            g.set_dtype(half_name, _FLOAT16)
+            g.copy_shape(name, half_name)
+            g.replace_all_inputs(nodes + new_nodes, name, half_name)
+            new_nodes.append(_make_cast(g, half_name, _FLOAT, output_name=name))
+
+    # a cast goes right after the node making its input, nodes are sorted so the result is sorted too
+    casts_of = collections.defaultdict(list)
+    for cast in new_nodes:
+        casts_of[cast.input[0]].append(cast)
+    ops = []
+    for name in list(g.model_inputs) + list(g.initializers):
+        ops.extend(casts_of.pop(name, []))
+    for node in nodes:
+        ops.append(node)
+        for name in node.output:
+            ops.extend(casts_of.pop(name, []))
+    for rest in casts_of.values():
+        ops.extend(rest)
+    g.set_nodes(ops)
+    g.update_proto()
+    log.info("float16: converted %d initializer(s), inserted %d cast(s)", converted, len(new_nodes))
+    return len(new_nodes)
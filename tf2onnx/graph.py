@@ -16,6 +16,9 @@ from onnx import helper, numpy_helper, optimizer, OperatorSetIdProto
 from tf2onnx import utils, __version__
 from tf2onnx.utils import node_name, port_name, find_opset
 
+# onnx optimizer passes that read the values of initializers, make_model keeps the initializers in the model for them
+INITIALIZER_PASSES = ["fuse_add_bias_into_conv", "fuse_bn_into_conv"]
+
 
 class Node(object):
     """A Node - wrapper around onnx nodes that we use for graph manipulations."""
@@ -31,6 +34,8 @@ class Node(object):
         self._input = [i for i in node.input]
         self._output = [i for i in node.output]
         self._attr = {}
+        # attribute name -> (Graph, input names, output names) of subgraphs like the body of Loop
+        self._body_graphs = {}
         self.inserted_nchw = False
 
         graph.set_node_by_name(self)
@@ -121,6 +126,34 @@ class Node(object):
     def set_attr(self, name, value):
         self.attr[name] = helper.make_attribute(name, value)
 
+    def get_body_graphs(self):
+        """Get the subgraphs of this node, attribute name -> (Graph, input names, output names)."""
+        return self._body_graphs
+
+    def set_body_graph_as_attr(self, attr_name, graph, input_names, output_names):
+        """Use graph as the subgraph attribute attr_name, for example the body of Loop.
+        The attribute is made from graph by Graph.update_proto() so the subgraph can be changed until then.
+        """
+        self._body_graphs[attr_name] = (graph, input_names, output_names)
+
+    def get_implicit_inputs(self):
+        """Get the tensors of the outer graph the subgraphs of this node use."""
+        ret = []
+        for body, _, _ in self._body_graphs.values():
+            produced = {name for node in body.get_nodes() for name in node.output}
+            for node in body.get_nodes():
+                for name in node.input + node.get_implicit_inputs():
+                    if name and name not in produced and name not in ret:
+                        ret.append(name)
+        return ret
+
+    def replace_implicit_input(self, old_input, new_input):
+        """Make the subgraphs of this node use new_input instead of the outer tensor old_input."""
+        for body, _, _ in self._body_graphs.values():
+            for node in body.get_nodes():
+                body.replace_input(node, old_input, new_input)
+                node.replace_implicit_input(old_input, new_input)
+
     def set_deleted(self):
         self.type = "@@DELETED@@"
 
@@ -257,6 +290,8 @@ class Graph(object):
         self._dtypes_override = {}
 
         self._output_shapes = output_shapes
+        # shapes with names for unknown dims, filled in by shape inference
+        self._symbolic_shapes = {}
         ops = [Node(node, self) for node in nodes]
         self.set_nodes(ops)
         self._opset = find_opset(opset)
@@ -270,6 +305,34 @@ class Graph(object):
     def initializers(self):
         return self._initializers
 
+    @property
+    def target(self):
+        return self._target
+
+    @property
+    def extra_opset(self):
+        return self._extra_opset
+
+    @property
+    def model_inputs(self):
+        return self._model_inputs
+
+    @property
+    def output_shapes(self):
+        return self._output_shapes
+
+    @property
+    def symbolic_shapes(self):
+        return self._symbolic_shapes
+
+    @property
+    def dtypes(self):
+        return self._dtypes
+
+    @property
+    def dtypes_override(self):
+        return self._dtypes_override
+
     def is_target(self, name):
         """Return True if target platform is name."""
         return name in self._target
@@ -298,6 +361,8 @@ class Graph(object):
         """Update the onnx protobuf from out internal Node structure."""
         for node in self._nodes:
             node.update_proto()
+            for attr_name, (body, input_names, output_names) in node.get_body_graphs().items():
+                node.set_attr(attr_name, body.make_graph(node.name + "_" + attr_name, input_names, output_names))
 
         # update attributes to proto
         for op in self.get_nodes():
@@ -341,6 +406,10 @@ class Graph(object):
         else:
             raise ValueError("model input already exists")
 
+    def is_model_input(self, name):
+        """Check if name is an input of the model."""
+        return name in self._model_inputs
+
     def add_initializer(self, tensor):
         """Add tensor to initializers."""
         self._initializers[tensor.name] = tensor
@@ -363,6 +432,13 @@ class Graph(object):
         else:
             raise ValueError("no initializer called " + name)
 
+    def remove_initializer(self, name):
+        """Remove initializer, the caller makes sure no node uses it anymore."""
+        if self.is_initializer(name):
+            del self._initializers[name]
+        else:
+            raise ValueError("no initializer called " + name)
+
     def get_dtype(self, name):
         """Get dtype for node."""
         return self._dtypes.get(name)
@@ -375,6 +451,12 @@ class Graph(object):
         """Override dtype for node, the val will be used when build final model"""
         self._dtypes_override[name] = val
 
+    def get_output_dtype(self, name):
+        """Get dtype for a model output, overrides take precedence."""
+        if name in self._dtypes_override:
+            return self._dtypes_override[name]
+        return self.get_dtype(name)
+
     def get_shape(self, name):
         """Get shape for node."""
         assert isinstance(name, str)
@@ -395,6 +477,26 @@ class Graph(object):
             val = val.tolist()
         self._output_shapes[name] = val
 
+    def get_symbolic_shape(self, name):
+        """Get shape with names for unknown dims, None if there is none."""
+        return self._symbolic_shapes.get(name)
+
+    def set_symbolic_shape(self, name, val):
+        """Set shape with names for unknown dims."""
+        self._symbolic_shapes[name] = list(val)
+
+    def get_onnx_shape(self, name):
+        """Get shape for the onnx model, unknown dims use their symbolic name if there is one.
+        None if the rank is unknown.
+        """
+        shape = self.get_shape(name)
+        if shape is None:
+            return None
+        symbolic = self.get_symbolic_shape(name)
+        if symbolic is not None and len(symbolic) == len(shape):
+            shape = [s if d == -1 and isinstance(s, str) else d for d, s in zip(shape, symbolic)]
+        return utils.make_onnx_shape(shape)
+
     def copy_shape(self, input_name, output_name):
         """Copy shape from another node."""
         shape = self.get_shape(input_name)
@@ -454,13 +556,127 @@ class Graph(object):
         ret = [x for _, x in sorted(zip(label, ops))]
         self.set_nodes(ret)
 
-    def make_model(self, doc, output_names, optimize=True):
+    def extract(self, inputs, outputs):
+        """
+        Create a new Graph with the nodes that compute outputs from inputs.
+        Args:
+            inputs: tensor names that become the model inputs of the new graph
+            outputs: tensor names computed by the new graph
+        Model inputs and initializers of this graph the nodes need are taken over. Shapes and dtypes of the
+        tensors are copied, a tensor has the same type as output of one graph and as input of another.
+        """
+        producers = {}
+        for node in self._nodes:
+            for name in node.output:
+                producers[name] = node
+        inputs = list(inputs)
+        needed = set()
+        model_inputs = []
+        initializers = []
+        seen = set()
+        stack = list(outputs)
+        while stack:
+            name = stack.pop()
+            if not name or name in seen:
+                continue
+            seen.add(name)
+            if name in inputs:
+                continue
+            if self.is_initializer(name):
+                initializers.append(name)
+                continue
+            node = producers.get(name)
+            if node is None:
+                if not self.is_model_input(name):
+                    raise ValueError("{} can't be computed from the inputs {}".format(name, inputs))
+                model_inputs.append(name)
+                continue
+            if node.name not in needed:
+                needed.add(node.name)
+                stack.extend(node.input + node.get_implicit_inputs())
+
+        ops = []
+        for node in self._nodes:
+            if node.name not in needed:
+                continue
+            onnx_node = helper.make_node(node.type, node.input, node.output, name=node.name)
+            if node.domain:
+                onnx_node.domain = node.domain
+            onnx_node.attribute.extend(node.attr.values())
+            ops.append(onnx_node)
+        tensors = seen | set(outputs) | {name for node in ops for name in node.output}
+        g = Graph(ops, output_shapes={}, dtypes={}, target=list(self._target), opset=self._opset,
+                  extra_opset=self._extra_opset)
+        for node in g.get_nodes():
+            old = self._nodes_by_name[node.name]
+            node.data_format = old.data_format
+            node.inserted_nchw = old.inserted_nchw
+            node.get_body_graphs().update(old.get_body_graphs())
+        for name in tensors:
+            if name in self._output_shapes:
+                g.set_shape(name, list(self._output_shapes[name]))
+            if name in self._symbolic_shapes:
+                g.set_symbolic_shape(name, self._symbolic_shapes[name])
+            if name in self._dtypes:
+                g.set_dtype(name, self._dtypes[name])
+            if name in self._dtypes_override:
+                g.override_dtype(name, self._dtypes_override[name])
+        for name in initializers:
+            g.add_initializer(self._initializers[name])
+        for name in model_inputs:
+            g.add_model_input(name, self._model_inputs[name])
+        for name in inputs:
+            dtype = self.get_output_dtype(name)
+            if not dtype:
+                raise ValueError("cannot found the dtype for " + name)
+            g.add_model_input(name, helper.make_tensor_value_info(name, dtype, self.get_onnx_shape(name)))
+        return g
+
+    def make_graph(self, graph_name, input_names, output_names, doc=""):
+        """
+        Create a GraphProto for the subgraph attribute of a node, like the body of Loop.
+        Args:
+            graph_name: name of the GraphProto
+            input_names: model inputs of this graph in the order the node passes them
+            output_names: outputs in the order the node expects them
+        The inputs of a subgraph are fixed by the op, initializers are therefore turned into Constant nodes.
+        """
+        self.update_proto()
+        all_inputs = set()
+        for op in self.get_nodes():
+            # subgraphs of nested nodes read initializers of this graph too
+            all_inputs |= set(op.input + op.get_implicit_inputs())
+        ops = []
+        for tensor in self._initializers.values():
+            if tensor.name in all_inputs:
+                ops.append(helper.make_node("Constant", [], [tensor.name], name=utils.make_name(tensor.name),
+                                            value=tensor))
+        ops.extend(op.op for op in self.get_nodes())
+
+        inputs = []
+        for name in input_names:
+            if name not in self._model_inputs:
+                raise ValueError("{} is not an input of graph {}".format(name, graph_name))
+            value_info = self._model_inputs[name]
+            inputs.append(helper.make_tensor_value_info(name, value_info.type.tensor_type.elem_type,
+                                                        self.get_onnx_shape(name)))
+        outputs = []
+        for name in output_names:
+            dtype = self.get_output_dtype(name)
+            if not dtype:
+                raise ValueError("cannot found the output dtype for " + name)
+            outputs.append(helper.make_tensor_value_info(name, dtype, self.get_onnx_shape(name)))
+        return helper.make_graph(ops, graph_name, inputs, outputs, doc_string=doc)
+
+    def make_model(self, doc, output_names, optimize=True, optimizer_passes=None):
         """
         Create final ModelProto for onnx from internal graph.
         Args:
             optimize: optimize graph via onnx
             doc: text for doc string of the model
             output_names: list of model outputs
+            optimizer_passes: list of onnx optimizer passes to run, None runs the default passes.
+                The initializers are only passed to the optimizer if one of INITIALIZER_PASSES is given.
         """
         self.update_proto()
 
@@ -474,20 +690,18 @@ class Graph(object):
         # create output_tensor_values
         output_tensor_values = []
         for name in output_names:
-            if name in self._dtypes_override:
-                dtype = self._dtypes_override[name]
-            else:
-                dtype = self.get_dtype(name)
+            dtype = self.get_output_dtype(name)
             if not dtype:
                 raise ValueError("cannot found the output dtype for " + name)
-            v = helper.make_tensor_value_info(name, dtype, utils.make_onnx_shape(self.get_shape(name)))
+            v = helper.make_tensor_value_info(name, dtype, self.get_onnx_shape(name))
             output_tensor_values.append(v)
 
         # update attributes
         ops = []
         all_inputs = set()
         for op in self.get_nodes():
-            all_inputs |= set(op.input)
+            # subgraphs, like the branches of If, read initializers of the model too
+            all_inputs |= set(op.input + op.get_implicit_inputs())
             onnx_op = op.op
             ops.append(onnx_op)
 
@@ -504,13 +718,22 @@ class Graph(object):
                                                 utils.make_onnx_shape(initializer.dims))
             input_with_initializers.append(val)
 
-        input_with_initializers.extend(list(self._model_inputs.values()))
-
-        # create model proto
+        for name, value_info in self._model_inputs.items():
+            if self.get_symbolic_shape(name) is not None and self.get_shape(name):
+                # shape inference might have merged the names of unknown dims since the input was added
+                value_info = helper.make_tensor_value_info(name, value_info.type.tensor_type.elem_type,
+                                                           self.get_onnx_shape(name))
+            input_with_initializers.append(value_info)
+
+        # create model proto. The initializers are attached after the onnx optimizer ran since the optimizer
+        # serializes the model to c++ and parses the result back which copies every weight twice.
+        # The graph inputs carry shape and dtype of the initializers so the optimizer still sees a complete graph.
+        # Passes that fold weights need the values though.
+        keep_initializers = optimize and optimizer_passes and any(p in INITIALIZER_PASSES for p in optimizer_passes)
         graph = helper.make_graph(ops, "tf2onnx",
                                   input_with_initializers,
                                   output_tensor_values,
-                                  initializer=initializers,
+                                  initializer=initializers if keep_initializers else None,
                                   doc_string=doc)
 
         kwargs = {"producer_name": "tf2onnx",
@@ -526,7 +749,15 @@ class Graph(object):
 
         # optimize the model proto
         if optimize:
-            model_proto = optimizer.optimize(model_proto)
+            if optimizer_passes is None:
+                model_proto = optimizer.optimize(model_proto)
+            else:
+                model_proto = optimizer.optimize(model_proto, optimizer_passes)
+
+        if not keep_initializers:
+            # reattach initializers by name, skip those the optimizer found to be unused
+            graph_inputs = set(i.name for i in model_proto.graph.input)
+            model_proto.graph.initializer.extend([i for i in initializers if i.name in graph_inputs])
         return model_proto
 
     def dump_graph(self):
@@ -619,6 +850,13 @@ class Graph(object):
                 nodes.append(node)
         return nodes
 
+    def get_subgraph_inputs(self):
+        """Find the tensors the subgraphs of the nodes use, like the branches of If."""
+        ret = []
+        for node in self.get_nodes():
+            ret.extend(name for name in node.get_implicit_inputs() if name not in ret)
+        return ret
+
     @staticmethod
     def replace_all_inputs(ops, old_input, new_input):
         """Replace all inputs pointing to old_input with new_input."""
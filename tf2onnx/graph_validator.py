@@ -0,0 +1,166 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+"""
+tf2onnx.graph_validator - validate the internal graph without serializing it to onnx
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import logging
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.graph_validator")
+
+# pylint: disable=missing-docstring
+
+
+class GraphValidator(object):
+    """Validate a Graph() directly on its internal structures.
+
+    onnx.checker needs the full serialized ModelProto which is slow for large models. The checks here
+    only look at the node list, the shape and dtype tables and the initializers of the graph.
+    """
+
+    def __init__(self, graph):
+        self._g = graph
+        # signature of each node seen on the last validation, used for incremental checks
+        self._signatures = {}
+
+    @staticmethod
+    def _signature(node):
+        return node.type, tuple(node.input), tuple(node.output)
+
+    def validate(self, output_names=None, incremental=False):
+        """Validate the graph.
+        Args:
+            output_names: list of model outputs, if given outputs are checked for dtype and shape
+            incremental: only check nodes that were added or changed since the last validation
+        Returns:
+            list of problems found, empty if the graph is valid
+        """
+        g = self._g
+        nodes = [n for n in g.get_nodes() if not n.is_deleted()]
+        errors = []
+
+        # duplicate names and outputs are cheap to find so we always check the full graph
+        producers = {}
+        names = set()
+        for node in nodes:
+            if node.name in names:
+                errors.append("node name {} is used more than once".format(node.name))
+            names.add(node.name)
+            for output_name in node.output:
+                if not output_name:
+                    continue
+                if output_name in producers:
+                    errors.append("output {} is produced by {} and {}".format(
+                        output_name, producers[output_name].name, node.name))
+                else:
+                    producers[output_name] = node
+
+        signatures = {node.name: self._signature(node) for node in nodes}
+        if incremental and self._signatures:
+            # outputs of nodes that changed or went away - consumers of those need to be checked again
+            stale_outputs = set()
+            for name, signature in self._signatures.items():
+                if signatures.get(name) != signature:
+                    stale_outputs.update(signature[2])
+            to_check = [node for node in nodes
+                        if self._signatures.get(node.name) != signatures[node.name]
+                        or any(i in stale_outputs for i in node.input)]
+        else:
+            to_check = nodes
+        self._signatures = signatures
+
+        errors.extend(self._check_inputs(to_check, producers))
+        errors.extend(self._check_cycles(to_check, producers))
+        errors.extend(self._check_initializers(to_check, incremental))
+        if output_names:
+            errors.extend(self._check_outputs(output_names, producers))
+        log.debug("validated %d of %d nodes, %d problem(s)", len(to_check), len(nodes), len(errors))
+        return errors
+
+    def check(self, output_names=None, incremental=False):
+        """Validate the graph and raise if there is any problem."""
+        errors = self.validate(output_names, incremental)
+        if errors:
+            raise ValueError("graph validation failed:\n  " + "\n  ".join(errors))
+
+    def _check_inputs(self, nodes, producers):
+        g = self._g
+        errors = []
+        for node in nodes:
+            for input_name in node.input:
+                # empty names are used for omitted optional inputs
+                if not input_name or input_name in producers:
+                    continue
+                if g.is_initializer(input_name) or g.is_model_input(input_name):
+                    continue
+                errors.append("input {} of node {} is not connected".format(input_name, node.name))
+        return errors
+
+    @staticmethod
+    def _check_cycles(nodes, producers):
+        """Depth first search towards the inputs of the given nodes.
+        Any new cycle must contain a changed node so we only need to start the search from those.
+        The back edge of a tensorflow while loop, NextIteration -> Merge, is not a cycle.
+        """
+        errors = []
+        visiting, done = 1, 2
+        state = {}
+        for start in nodes:
+            if start.name in state:
+                continue
+            stack = [(start, iter(start.input))]
+            state[start.name] = visiting
+            while stack:
+                node, inputs = stack[-1]
+                parent = None
+                for input_name in inputs:
+                    candidate = producers.get(input_name)
+                    if candidate is None or candidate.type == "NextIteration":
+                        continue
+                    candidate_state = state.get(candidate.name)
+                    if candidate_state == visiting:
+                        errors.append("graph has a cycle through node {}".format(candidate.name))
+                    elif candidate_state is None:
+                        parent = candidate
+                        break
+                if parent is None:
+                    state[node.name] = done
+                    stack.pop()
+                else:
+                    state[parent.name] = visiting
+                    stack.append((parent, iter(parent.input)))
+        return errors
+
+    def _check_initializers(self, nodes, incremental):
+        g = self._g
+        if incremental:
+            names = set()
+            for node in nodes:
+                names.update(i for i in node.input if g.is_initializer(i))
+        else:
+            names = g.initializers.keys()
+        errors = []
+        for name in names:
+            tensor = g.get_initializer(name)
+            shape = g.get_shape(name)
+            if shape is not None and list(shape) != list(tensor.dims):
+                errors.append("initializer {} has dims {} but shape {} is recorded".format(
+                    name, list(tensor.dims), shape))
+        return errors
+
+    def _check_outputs(self, output_names, producers):
+        g = self._g
+        errors = []
+        for name in output_names:
+            if name not in producers and not g.is_initializer(name) and not g.is_model_input(name):
+                errors.append("output {} is not produced by any node".format(name))
+            if not g.get_output_dtype(name):
+                errors.append("output {} has no dtype".format(name))
+            if g.get_shape(name) is None:
+                errors.append("output {} has no shape".format(name))
+        return errors
@@ -5,4 +5,40 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-__all__ = ["transpose_optimizer"]
+from tf2onnx.optimizer.algebraic_optimizer import AlgebraicOptimizer
+from tf2onnx.optimizer.const_fold_optimizer import ConstFoldOptimizer
+from tf2onnx.optimizer.conv_fold_optimizer import ConvFoldOptimizer
+from tf2onnx.optimizer.cse_optimizer import CseOptimizer
+from tf2onnx.optimizer.gemm_optimizer import GemmOptimizer
+from tf2onnx.optimizer.initializer_dedup_optimizer import InitializerDedupOptimizer
+from tf2onnx.optimizer.pad_fold_optimizer import PadFoldOptimizer
+from tf2onnx.optimizer.peephole_optimizer import PeepholeOptimizer
+from tf2onnx.optimizer.reshape_optimizer import ReshapeOptimizer
+from tf2onnx.optimizer.transpose_optimizer import TransposeOptimizer
+
+__all__ = ["algebraic_optimizer", "const_fold_optimizer", "conv_fold_optimizer", "cse_optimizer", "gemm_optimizer",
+           "initializer_dedup_optimizer", "pad_fold_optimizer", "peephole_optimizer", "reshape_optimizer",
+           "transpose_optimizer", "optimize_graph"]
+
+
+def optimize_graph(graph, output_names=None, debug=False, static_shapes=False):
+    """Run the graph optimizers on a converted graph.
+    Args:
+        static_shapes: the graph was converted for fixed input shapes, fold all shape computations
+    """
+    if output_names is not None:
+        # the optimizers only see the inputs of nodes, the tensors subgraphs use must stay as they are
+        output_names = list(output_names) + graph.get_subgraph_inputs()
+    ConstFoldOptimizer(graph, debug, output_names, static_shapes=static_shapes).optimize()
+    AlgebraicOptimizer(graph, debug, output_names).optimize()
+    ReshapeOptimizer(graph, debug, output_names).optimize()
+    CseOptimizer(graph, debug, output_names).optimize()
+    PadFoldOptimizer(graph, debug, output_names).optimize()
+    ConvFoldOptimizer(graph, debug, output_names).optimize()
+    GemmOptimizer(graph, debug, output_names).optimize()
+    TransposeOptimizer(graph, debug).optimize()
+    # the transpose optimizer can leave Transpose pairs behind
+    PeepholeOptimizer(graph, debug, output_names).optimize()
+    # the folding passes write new weights which can be equal
+    InitializerDedupOptimizer(graph, debug, output_names).optimize()
+    return graph
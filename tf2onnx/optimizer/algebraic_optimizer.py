@@ -0,0 +1,250 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+"""Rule based algebraic simplification of the converted onnx graph."""
+
+import collections
+import logging
+
+import numpy as np
+from onnx import numpy_helper
+
+from tf2onnx import utils
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.optimizer.algebraic_optimizer")
+
+# pylint: disable=missing-docstring
+
+_COMMUTATIVE_OPS = ["Add", "Mul"]
+
+
+class AlgebraicOptimizer(object):
+    """Simplify arithmetic with constants.
+
+    Rules:
+        x * 1, x / 1, x + 0, x - 0, x ^ 1 -> x
+        0 - x -> -x, -(-x) -> x
+        x ^ 2 -> x * x, x ^ 0.5 -> sqrt(x), x ^ -1 -> 1 / x
+        a * reciprocal(b) -> a / b
+        (x * c1) / c2 -> x * (c1 / c2) and the same for Add and Sub
+    A constant operand of Add and Mul is moved to the second input so equal expressions look the same.
+    A rule that would let a constant broadcast the other operand to a bigger shape is not applied.
+    """
+
+    def __init__(self, graph, debug=False, output_names=None):
+        self._g = graph
+        self._debug = debug
+        self._output_names = set(output_names or [])
+        self._consumers = collections.defaultdict(list)
+        self._producers = {}
+        self._removed = set()
+        self._handlers = {
+            "Add": self._add_handler,
+            "Div": self._div_handler,
+            "Mul": self._mul_handler,
+            "Neg": self._neg_handler,
+            "Pow": self._pow_handler,
+            "Sub": self._sub_handler,
+        }
+
+    def _const(self, name):
+        if self._g.is_initializer(name):
+            return numpy_helper.to_array(self._g.get_initializer(name))
+        return None
+
+    def _keeps_shape(self, value, name):
+        """True if broadcasting value against name gives the shape of name."""
+        if value.ndim == 0:
+            return True
+        g = self._g
+        shape = list(g.get_initializer(name).dims) if g.is_initializer(name) else g.get_shape(name)
+        if not shape or value.ndim > len(shape):
+            return False
+        return all(v == 1 or v == s and s != -1 for v, s in zip(reversed(value.shape), reversed(shape)))
+
+    def _producer(self, name, op_type):
+        node = self._producers.get(name)
+        if node is None or node.type != op_type or node.name in self._removed:
+            return None
+        return node
+
+    def _single_consumer(self, name):
+        consumers = self._consumers[name]
+        if len(consumers) != 1 or name in self._output_names:
+            return None
+        return consumers[0]
+
+    def _set_input(self, node, i, new_input):
+        self._consumers[node.input[i]].remove(node)
+        node.input[i] = new_input
+        self._consumers[new_input].append(node)
+
+    def _set_inputs(self, node, inputs):
+        for name in node.input:
+            self._consumers[name].remove(node)
+        node.input[:] = inputs
+        for name in inputs:
+            self._consumers[name].append(node)
+
+    def _remove(self, node):
+        self._removed.add(node.name)
+        for name in node.input:
+            self._consumers[name].remove(node)
+
+    def _remove_if_dead(self, node):
+        if not self._consumers[node.output[0]] and node.output[0] not in self._output_names:
+            self._remove(node)
+
+    def _bypass(self, node, new_input):
+        output_name = node.output[0]
+        if output_name in self._output_names:
+            return False
+        for consumer in list(self._consumers[output_name]):
+            for i, name in enumerate(consumer.input):
+                if name == output_name:
+                    self._set_input(consumer, i, new_input)
+        self._remove(node)
+        return True
+
+    def _make_const(self, node, value):
+        name = utils.make_name(node.name)
+        self._g.make_const(name, value)
+        return name
+
+    def _normalize(self, node):
+        if node.type in _COMMUTATIVE_OPS and self._g.is_initializer(node.input[0]) \
+                and not self._g.is_initializer(node.input[1]):
+            self._set_inputs(node, [node.input[1], node.input[0]])
+            return True
+        return False
+
+    def _fold_chain(self, node, family):
+        """(x op1 c1) op2 c2 -> x op (c1 op c2) for ops in the same family."""
+        c2 = self._const(node.input[1])
+        if c2 is None:
+            return False
+        producer = self._producers.get(node.input[0])
+        if producer is None or producer.type not in family or producer.name in self._removed \
+                or producer.get_attr("axis") is not None:
+            return False
+        if self._single_consumer(producer.output[0]) is not node:
+            return False
+        c1 = self._const(producer.input[1])
+        if c1 is None or self._g.is_initializer(producer.input[0]):
+            return False
+        if family == ["Mul", "Div"]:
+            if not np.issubdtype(c1.dtype, np.floating):
+                # integer division truncates
+                return False
+            value = (c1 if producer.type == "Mul" else 1 / c1) * (c2 if node.type == "Mul" else 1 / c2)
+            new_type = "Mul"
+        else:
+            value = (c1 if producer.type == "Add" else -c1) + (c2 if node.type == "Add" else -c2)
+            new_type = "Add"
+        node.type = new_type
+        self._set_inputs(node, [producer.input[0], self._make_const(node, value.astype(c2.dtype))])
+        self._remove_if_dead(producer)
+        return True
+
+    def _identity_const(self, node, identity):
+        """Bypass node if the second input is a constant that does nothing to the first."""
+        value = self._const(node.input[1])
+        other = node.input[0]
+        if value is None or not np.all(value == identity) or not self._keeps_shape(value, other):
+            return False
+        return self._bypass(node, other)
+
+    def _add_handler(self, node):
+        return self._normalize(node) or self._identity_const(node, 0) or self._fold_chain(node, ["Add", "Sub"])
+
+    def _sub_handler(self, node):
+        if self._identity_const(node, 0):
+            return True
+        value = self._const(node.input[0])
+        if value is not None and np.all(value == 0) and self._keeps_shape(value, node.input[1]):
+            node.type = "Neg"
+            self._set_inputs(node, [node.input[1]])
+            return True
+        return self._fold_chain(node, ["Add", "Sub"])
+
+    def _mul_handler(self, node):
+        if self._normalize(node) or self._identity_const(node, 1):
+            return True
+        for i in range(2):
+            reciprocal = self._producer(node.input[i], "Reciprocal")
+            if reciprocal is not None and self._single_consumer(reciprocal.output[0]) is node:
+                node.type = "Div"
+                self._set_inputs(node, [node.input[1 - i], reciprocal.input[0]])
+                self._remove_if_dead(reciprocal)
+                return True
+        return self._fold_chain(node, ["Mul", "Div"])
+
+    def _div_handler(self, node):
+        return self._identity_const(node, 1) or self._fold_chain(node, ["Mul", "Div"])
+
+    def _neg_handler(self, node):
+        producer = self._producer(node.input[0], "Neg")
+        if producer is None:
+            return False
+        changed = self._bypass(node, producer.input[0])
+        self._remove_if_dead(producer)
+        return changed
+
+    def _pow_handler(self, node):
+        value = self._const(node.input[1])
+        x = node.input[0]
+        if value is None or value.size != 1 or not self._keeps_shape(value, x):
+            return False
+        exponent = value.flatten()[0]
+        if exponent == 1:
+            return self._bypass(node, x)
+        if exponent == 2:
+            node.type = "Mul"
+            self._set_inputs(node, [x, x])
+        elif exponent == 0.5:
+            node.type = "Sqrt"
+            self._set_inputs(node, [x])
+        elif exponent == -1:
+            node.type = "Reciprocal"
+            self._set_inputs(node, [x])
+        else:
+            return False
+        return True
+
+    def _sweep(self):
+        nodes = [n for n in self._g.get_nodes() if n.name not in self._removed]
+        self._consumers.clear()
+        self._producers.clear()
+        for node in nodes:
+            for name in node.input:
+                self._consumers[name].append(node)
+            for name in node.output:
+                self._producers[name] = node
+        changes = 0
+        for node in nodes:
+            handler = self._handlers.get(node.type)
+            if handler is None or node.domain or node.name in self._removed:
+                continue
+            # nodes with the broadcast axis of opset < 7 are left alone
+            if node.get_attr("axis") is not None:
+                continue
+            if handler(node):
+                changes += 1
+        self._g.set_nodes([n for n in nodes if n.name not in self._removed])
+        return changes
+
+    def optimize(self):
+        g = self._g
+        if self._debug:
+            g.dump_node_statistics("before algebraic simplification")
+        changes = 0
+        while True:
+            sweep_changes = self._sweep()
+            if not sweep_changes:
+                break
+            changes += sweep_changes
+        g.update_proto()
+        log.debug("algebraic simplification: %d change(s)", changes)
+        if self._debug:
+            g.dump_node_statistics("after algebraic simplification")
+        return changes
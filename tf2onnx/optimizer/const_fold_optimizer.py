@@ -0,0 +1,247 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+"""Constant folding of the converted onnx graph."""
+
+import logging
+
+import numpy as np
+from onnx import numpy_helper, onnx_pb
+
+from tf2onnx import utils
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.optimizer.const_fold_optimizer")
+
+# pylint: disable=missing-docstring,unused-argument
+
+# results larger than this (in bytes) are only folded if they don't grow the model
+DEFAULT_MAX_FOLD_BYTES = 1 << 20
+
+
+def _attr_ints(node, name, default=None):
+    attr = node.get_attr(name)
+    if attr is None:
+        return default
+    return list(attr.ints)
+
+
+def _attr_int(node, name, default=None):
+    attr = node.get_attr(name)
+    if attr is None:
+        return default
+    return attr.i
+
+
+def _fold_identity(g, node, inputs):
+    return inputs[0]
+
+
+def _fold_transpose(g, node, inputs):
+    return np.transpose(inputs[0], _attr_ints(node, "perm"))
+
+
+def _fold_reshape(g, node, inputs):
+    if len(inputs) > 1:
+        shape = list(inputs[1])
+    else:
+        shape = _attr_ints(node, "shape")
+    # in onnx 0 means copy the dimension from the input
+    shape = [inputs[0].shape[i] if d == 0 else d for i, d in enumerate(shape)]
+    return np.reshape(inputs[0], shape)
+
+
+def _fold_cast(g, node, inputs):
+    to = node.get_attr("to")
+    if to.type == onnx_pb.AttributeProto.STRING:
+        # before opset 6 the type is given by name
+        to = onnx_pb.TensorProto.DataType.Value(to.s.decode("utf-8"))
+    else:
+        to = to.i
+    if to not in utils.ONNX_TO_NUMPY_DTYPE:
+        return None
+    return inputs[0].astype(utils.ONNX_TO_NUMPY_DTYPE[to])
+
+
+def _fold_concat(g, node, inputs):
+    return np.concatenate(inputs, axis=_attr_int(node, "axis"))
+
+
+def _fold_unsqueeze(g, node, inputs):
+    val = inputs[0]
+    for axis in sorted(_attr_ints(node, "axes")):
+        val = np.expand_dims(val, axis)
+    return val
+
+
+def _fold_squeeze(g, node, inputs):
+    axes = _attr_ints(node, "axes")
+    if axes is None:
+        return np.squeeze(inputs[0])
+    return np.squeeze(inputs[0], axis=tuple(axes))
+
+
+def _fold_binary(np_op):
+    def fold(g, node, inputs):
+        if g.opset < 7 and node.get_attr("axis") is not None:
+            # legacy broadcast along an axis is not numpy broadcasting
+            return None
+        return np_op(inputs[0], inputs[1]).astype(inputs[0].dtype)
+    return fold
+
+
+def _int_divide(a, b):
+    """Integer division in onnx truncates towards zero, numpy rounds towards -inf."""
+    q = np.floor_divide(a, b)
+    return q + ((np.remainder(a, b) != 0) & ((a < 0) != (b < 0)))
+
+
+def _fold_div(g, node, inputs):
+    if np.issubdtype(inputs[0].dtype, np.integer):
+        return _fold_binary(_int_divide)(g, node, inputs)
+    return _fold_binary(np.true_divide)(g, node, inputs)
+
+
+def _fold_neg(g, node, inputs):
+    return np.negative(inputs[0])
+
+
+def _fold_slice(g, node, inputs):
+    val = inputs[0]
+    if len(inputs) > 1:
+        starts, ends = inputs[1], inputs[2]
+        axes = inputs[3] if len(inputs) > 3 else range(len(starts))
+        steps = inputs[4] if len(inputs) > 4 else [1] * len(starts)
+    else:
+        starts, ends = _attr_ints(node, "starts"), _attr_ints(node, "ends")
+        axes = _attr_ints(node, "axes", range(len(starts)))
+        steps = [1] * len(starts)
+    slices = [slice(None)] * val.ndim
+    for start, end, axis, step in zip(starts, ends, axes, steps):
+        slices[axis] = slice(int(start), int(end), int(step))
+    return val[tuple(slices)]
+
+
+def _fold_gather(g, node, inputs):
+    return np.take(inputs[0], inputs[1], axis=_attr_int(node, "axis", 0))
+
+
+def _fold_shape(g, node, inputs):
+    return np.array(inputs[0].shape, dtype=np.int64)
+
+
+def _fold_size(g, node, inputs):
+    return np.array(inputs[0].size, dtype=np.int64)
+
+
+_FOLD_FUNCS = {
+    "Add": _fold_binary(np.add),
+    "Cast": _fold_cast,
+    "Concat": _fold_concat,
+    "Div": _fold_div,
+    "Gather": _fold_gather,
+    "Identity": _fold_identity,
+    "Mul": _fold_binary(np.multiply),
+    "Neg": _fold_neg,
+    "Reshape": _fold_reshape,
+    "Shape": _fold_shape,
+    "Size": _fold_size,
+    "Slice": _fold_slice,
+    "Squeeze": _fold_squeeze,
+    "Sub": _fold_binary(np.subtract),
+    "Transpose": _fold_transpose,
+    "Unsqueeze": _fold_unsqueeze,
+}
+
+
+class ConstFoldOptimizer(object):
+    """Replace nodes that only consume initializers with the computed initializer."""
+
+    def __init__(self, graph, debug=False, output_names=None, max_fold_bytes=DEFAULT_MAX_FOLD_BYTES,
+                 static_shapes=False):
+        """Create the optimizer.
+        Args:
+            static_shapes: the shapes in the graph are for fixed input shapes, Shape and Size of any
+                tensor with a fully known shape can be folded
+        """
+        self._g = graph
+        self._debug = debug
+        self._output_names = set(output_names or [])
+        self._max_fold_bytes = max_fold_bytes
+        self._static_shapes = static_shapes
+
+    def _get_static_shape(self, name):
+        shape = self._g.get_shape(name)
+        # an empty shape can be a scalar or an unknown rank
+        if not shape or any(d is None or d < 0 for d in shape):
+            return None
+        return shape
+
+    def _fold_shape_node(self, node):
+        """Replace Shape or Size of a tensor with known shape by an initializer."""
+        if node.type not in ["Shape", "Size"] or node.output[0] in self._output_names:
+            return False
+        shape = self._get_static_shape(node.input[0])
+        if shape is None:
+            return False
+        val = np.array(shape, dtype=np.int64)
+        if node.type == "Size":
+            val = np.array(np.prod(val), dtype=np.int64)
+        tensor = numpy_helper.from_array(val, node.output[0])
+        self._g.add_initializer(tensor)
+        self._g.set_dtype(node.output[0], tensor.data_type)
+        return True
+
+    def _can_fold(self, node):
+        if node.type not in _FOLD_FUNCS or node.domain or len(node.output) != 1:
+            return False
+        if node.output[0] in self._output_names:
+            # keep model outputs produced by a node
+            return False
+        inputs = [i for i in node.input if i]
+        return inputs and all(self._g.is_initializer(i) for i in inputs)
+
+    def _fold(self, node):
+        """Fold the node into an initializer, returns False if it can't be done."""
+        g = self._g
+        inputs = [numpy_helper.to_array(g.get_initializer(i)) for i in node.input if i]
+        try:
+            val = _FOLD_FUNCS[node.type](g, node, inputs)
+        except Exception as ex:  # pylint: disable=broad-except
+            log.debug("can't fold %s: %s", node.name, ex)
+            return False
+        if val is None:
+            return False
+        val = np.asarray(val)
+        input_bytes = sum(i.nbytes for i in inputs)
+        if val.nbytes > self._max_fold_bytes and val.nbytes > input_bytes:
+            log.debug("not folding %s, result has %d bytes", node.name, val.nbytes)
+            return False
+        output_name = node.output[0]
+        tensor = numpy_helper.from_array(val, output_name)
+        g.add_initializer(tensor)
+        g.set_dtype(output_name, tensor.data_type)
+        return True
+
+    def optimize(self):
+        if self._debug:
+            self._g.dump_node_statistics("before const folding")
+        folded = 0
+        changed = True
+        while changed:
+            changed = False
+            # nodes are sorted so chains of foldable nodes are handled in a single pass,
+            # the loop only repeats if a producer was listed after its consumer
+            keep = []
+            for node in self._g.get_nodes():
+                if (self._can_fold(node) and self._fold(node)) or \
+                        (self._static_shapes and self._fold_shape_node(node)):
+                    folded += 1
+                    changed = True
+                else:
+                    keep.append(node)
+            self._g.set_nodes(keep)
+        log.debug("folded %d node(s)", folded)
+        self._g.update_proto()
+        if self._debug:
+            self._g.dump_node_statistics("after const folding")
+        return folded
@@ -0,0 +1,194 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+"""Fold BatchNormalization and per-channel Mul/Add that follow a convolution into its weights and bias."""
+
+import collections
+import logging
+
+import numpy as np
+from onnx import numpy_helper, onnx_pb
+
+from tf2onnx import utils
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.optimizer.conv_fold_optimizer")
+
+# pylint: disable=missing-docstring
+
+_FLOAT_TYPES = [onnx_pb.TensorProto.FLOAT, onnx_pb.TensorProto.FLOAT16, onnx_pb.TensorProto.DOUBLE]
+
+
+class ConvFoldOptimizer(object):
+    """Fold BatchNormalization, Mul and Add with per-channel constants into a preceding Conv or ConvTranspose.
+
+    The folded node can follow the convolution directly or through a Transpose, which is what NHWC models
+    look like: Conv -> Transpose(0, 2, 3, 1) -> Mul.
+    The convolution and every node between it and the folded node must have no other consumers.
+    """
+
+    def __init__(self, graph, debug=False, output_names=None):
+        self._g = graph
+        self._debug = debug
+        self._output_names = set(output_names or [])
+        self._consumers = collections.defaultdict(list)
+        self._removed = set()
+
+    def _const(self, name):
+        if self._g.is_initializer(name):
+            return numpy_helper.to_array(self._g.get_initializer(name))
+        return None
+
+    def _single_consumer(self, name):
+        consumers = self._consumers[name]
+        if len(consumers) != 1 or name in self._output_names:
+            return None
+        return consumers[0]
+
+    @staticmethod
+    def _channel_scale(value, rank, axis, channels):
+        """Per-channel vector of a constant that broadcasts along axis of a rank-dim tensor, None if it doesn't."""
+        if value.ndim > rank:
+            return None
+        shape = [1] * (rank - value.ndim) + list(value.shape)
+        if any(d != 1 for i, d in enumerate(shape) if i != axis) or shape[axis] not in [1, channels]:
+            return None
+        return np.broadcast_to(value.reshape(-1), [channels])
+
+    def _affine(self, node, rank, axis, channels):
+        """Return (scale, bias) per channel for the node following the convolution, None if it can't be folded."""
+        if node.type == "BatchNormalization":
+            spatial = node.get_attr("spatial")
+            if axis != 1 or spatial is not None and spatial.i != 1:
+                return None
+            if any(self._consumers[o] or o in self._output_names for o in node.output[1:] if o):
+                # training outputs are in use
+                return None
+            params = [self._const(i) for i in node.input[1:5]]
+            if len(params) != 4 or any(p is None or p.shape != (channels,) for p in params):
+                return None
+            scale, bias, mean, var = [p.astype(np.float64) for p in params]
+            epsilon = node.get_attr("epsilon")
+            epsilon = epsilon.f if epsilon is not None else 1e-5
+            scale = scale / np.sqrt(var + epsilon)
+            return scale, bias - mean * scale
+
+        if node.type in ["Mul", "Add"]:
+            if len(node.input) != 2 or node.get_attr("axis") is not None:
+                return None
+            # the constant can be either input
+            value = self._const(node.input[1])
+            if value is None:
+                value = self._const(node.input[0])
+            if value is None:
+                return None
+            vector = self._channel_scale(value, rank, axis, channels)
+            if vector is None:
+                return None
+            vector = vector.astype(np.float64)
+            if node.type == "Mul":
+                return vector, np.zeros([channels])
+            return np.ones([channels]), vector
+        return None
+
+    def _fold(self, conv):
+        """Try to fold the node after conv, return True if it was folded."""
+        g = self._g
+        if len(conv.input) < 2 or conv.output[0] in self._output_names:
+            return False
+        weight = self._const(conv.input[1])
+        bias = self._const(conv.input[2]) if len(conv.input) > 2 else None
+        if weight is None or len(conv.input) > 2 and bias is None:
+            return False
+        if g.get_initializer(conv.input[1]).data_type not in _FLOAT_TYPES:
+            return False
+        group = conv.get_attr("group")
+        group = group.i if group is not None else 1
+        if conv.type == "Conv":
+            channels = weight.shape[0]
+        else:
+            # ConvTranspose weights are [C, M / group, ...]
+            channels = weight.shape[1] * group
+        rank = weight.ndim
+
+        node = self._single_consumer(conv.output[0])
+        if node is None:
+            return False
+        transpose = None
+        axis = 1
+        if node.type == "Transpose":
+            perm = node.get_attr("perm")
+            if perm is None or len(perm.ints) != rank:
+                return False
+            transpose = node
+            axis = list(perm.ints).index(1)
+            node = self._single_consumer(transpose.output[0])
+            if node is None:
+                return False
+        folded_input = transpose.output[0] if transpose else conv.output[0]
+        if node.input[0] != folded_input and node.type == "BatchNormalization":
+            return False
+        if node.output[0] in self._output_names:
+            return False
+
+        affine = self._affine(node, rank, axis, channels)
+        if affine is None:
+            return False
+        scale, shift = affine
+
+        # w' = w * scale, b' = b * scale + shift, along the output channels
+        if conv.type == "Conv":
+            new_weight = weight * scale.reshape([channels] + [1] * (rank - 1))
+        else:
+            grouped = weight.reshape([group, weight.shape[0] // group] + list(weight.shape[1:]))
+            grouped = grouped * scale.reshape([group, 1, channels // group] + [1] * (rank - 2))
+            new_weight = grouped.reshape(weight.shape)
+        if bias is None:
+            bias = np.zeros([channels], dtype=weight.dtype)
+        new_bias = bias * scale + shift
+
+        # weights might be shared, always make new ones. The old ones are dropped if unused.
+        weight_name = utils.make_name(conv.name + "_weight")
+        bias_name = utils.make_name(conv.name + "_bias")
+        g.make_const(weight_name, new_weight.astype(weight.dtype))
+        g.make_const(bias_name, new_bias.astype(weight.dtype))
+        for old in conv.input[1:3]:
+            self._consumers[old].remove(conv)
+        conv.input[1:3] = [weight_name, bias_name]
+        # the next fold into this convolution replaces them again
+        self._consumers[weight_name].append(conv)
+        self._consumers[bias_name].append(conv)
+
+        # the consumers of the folded node read the convolution (or the transpose) instead
+        for consumer in self._consumers.pop(node.output[0], []):
+            for i, name in enumerate(consumer.input):
+                if name == node.output[0]:
+                    consumer.input[i] = folded_input
+                    self._consumers[folded_input].append(consumer)
+        for name in node.input:
+            if node in self._consumers[name]:
+                self._consumers[name].remove(node)
+        self._removed.add(node.name)
+        log.debug("folded %s %s into %s", node.type, node.name, conv.name)
+        return True
+
+    def optimize(self):
+        g = self._g
+        if self._debug:
+            g.dump_node_statistics("before conv folding")
+        nodes = g.get_nodes()
+        for node in nodes:
+            for name in node.input:
+                self._consumers[name].append(node)
+        folded = 0
+        for node in nodes:
+            if node.type not in ["Conv", "ConvTranspose"] or node.name in self._removed:
+                continue
+            # a convolution can be followed by several foldable nodes, like Mul and Add
+            while self._fold(node):
+                folded += 1
+        g.set_nodes([n for n in nodes if n.name not in self._removed])
+        g.update_proto()
+        log.debug("folded %d node(s) into convolutions", folded)
+        if self._debug:
+            g.dump_node_statistics("after conv folding")
+        return folded
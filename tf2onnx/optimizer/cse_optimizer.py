@@ -0,0 +1,64 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+"""Common subexpression elimination on the converted onnx graph."""
+
+import logging
+
+from tf2onnx import utils
+from tf2onnx.optimizer.initializer_dedup_optimizer import InitializerDedupOptimizer
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.optimizer.cse_optimizer")
+
+# pylint: disable=missing-docstring
+
+# ops that give a different result each time they run
+_NONDETERMINISTIC_OPS = ["Multinomial", "RandomNormal", "RandomNormalLike", "RandomUniform", "RandomUniformLike"]
+
+
+class CseOptimizer(object):
+    """Merge nodes with the same op type, inputs and attributes and initializers with the same content."""
+
+    def __init__(self, graph, debug=False, output_names=None):
+        self._g = graph
+        self._debug = debug
+        self._output_names = set(output_names or [])
+
+    @staticmethod
+    def _node_key(node):
+        attrs = tuple(sorted((name, a.SerializeToString()) for name, a in node.attr.items()
+                             if name in utils.ONNX_VALID_ATTRIBUTES))
+        return node.type, node.domain, tuple(node.input), attrs
+
+    def optimize(self):
+        if self._debug:
+            self._g.dump_node_statistics("before cse")
+        # nodes reading equal initializers become equal
+        merged_initializers = InitializerDedupOptimizer(self._g, output_names=self._output_names).optimize()
+        renames = {}
+        seen = {}
+        keep = []
+        merged_nodes = 0
+        # nodes are sorted, renaming the inputs while we sweep merges whole duplicated chains in one pass
+        for node in self._g.get_nodes():
+            for i, name in enumerate(node.input):
+                if name in renames:
+                    node.input[i] = renames[name]
+            if node.type in _NONDETERMINISTIC_OPS or any(o in self._output_names for o in node.output):
+                keep.append(node)
+                continue
+            key = self._node_key(node)
+            other = seen.get(key)
+            if other is None or len(other.output) != len(node.output):
+                seen[key] = node
+                keep.append(node)
+                continue
+            for old, new in zip(node.output, other.output):
+                renames[old] = new
+            merged_nodes += 1
+        self._g.set_nodes(keep)
+        self._g.update_proto()
+        log.debug("merged %d node(s) and %d initializer(s)", merged_nodes, merged_initializers)
+        if self._debug:
+            self._g.dump_node_statistics("after cse")
+        return merged_nodes + merged_initializers
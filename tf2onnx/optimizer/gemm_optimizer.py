@@ -0,0 +1,141 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+"""Fuse MatMul and a following bias Add into Gemm."""
+
+import collections
+import logging
+
+from onnx import onnx_pb
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.optimizer.gemm_optimizer")
+
+# pylint: disable=missing-docstring
+
+_FLOAT_TYPES = [onnx_pb.TensorProto.FLOAT, onnx_pb.TensorProto.FLOAT16, onnx_pb.TensorProto.DOUBLE]
+
+
+class GemmOptimizer(object):
+    """Turn MatMul -> Add into a single Gemm.
+
+    Both MatMul inputs must be 2-dim and the other Add input must broadcast to the MatMul output
+    without changing its shape. A 2-dim Transpose on a MatMul input becomes transA or transB, for
+    constant weights this means the transpose is gone from the graph.
+    Needs opset 7, before that the bias of Gemm only broadcasts with an attribute.
+    """
+
+    def __init__(self, graph, debug=False, output_names=None):
+        self._g = graph
+        self._debug = debug
+        self._output_names = set(output_names or [])
+        self._consumers = collections.defaultdict(list)
+        self._producers = {}
+        self._removed = set()
+
+    def _shape(self, name):
+        g = self._g
+        if g.is_initializer(name):
+            return list(g.get_initializer(name).dims)
+        return g.get_shape(name)
+
+    def _dtype(self, name):
+        g = self._g
+        if g.is_initializer(name):
+            return g.get_initializer(name).data_type
+        if g.is_model_input(name):
+            return g.model_inputs[name].type.tensor_type.elem_type
+        return g.get_dtype(name)
+
+    def _single_consumer(self, name):
+        consumers = self._consumers[name]
+        if len(consumers) != 1 or name in self._output_names:
+            return None
+        return consumers[0]
+
+    def _transposed_input(self, matmul, i):
+        """If input i of matmul is a 2-dim transpose only used by matmul return the transpose."""
+        transpose = self._producers.get(matmul.input[i])
+        if transpose is None or transpose.type != "Transpose" or transpose.name in self._removed:
+            return None
+        perm = transpose.get_attr("perm")
+        # no perm means reversed dims
+        if perm is not None and list(perm.ints) != [1, 0]:
+            return None
+        if self._single_consumer(transpose.output[0]) is not matmul:
+            return None
+        if len(self._shape(transpose.input[0]) or []) != 2:
+            return None
+        return transpose
+
+    @staticmethod
+    def _bias_fits(bias_shape, output_shape):
+        """Gemm only broadcasts the bias one way, it must not change the shape of the output."""
+        if bias_shape is None or len(bias_shape) > 2:
+            return False
+        padded = [1] * (2 - len(bias_shape)) + list(bias_shape)
+        return all(b == 1 or b == o and o != -1 for b, o in zip(padded, output_shape))
+
+    def _fuse(self, matmul):
+        if matmul.output[0] in self._output_names:
+            return False
+        a_shape, b_shape = self._shape(matmul.input[0]), self._shape(matmul.input[1])
+        if a_shape is None or b_shape is None or len(a_shape) != 2 or len(b_shape) != 2:
+            return False
+        if self._dtype(matmul.input[0]) not in _FLOAT_TYPES:
+            return False
+        add = self._single_consumer(matmul.output[0])
+        if add is None or add.type != "Add" or len(add.input) != 2 or add.input[0] == add.input[1]:
+            return False
+        bias = add.input[1] if add.input[0] == matmul.output[0] else add.input[0]
+        bias_shape = self._shape(bias)
+        if not bias_shape and not self._g.is_initializer(bias):
+            # an empty shape is only a scalar for constants, otherwise the rank is unknown
+            return False
+        if not self._bias_fits(bias_shape, [a_shape[0], b_shape[1]]):
+            return False
+
+        inputs = list(matmul.input)
+        trans = [0, 0]
+        for i in range(2):
+            transpose = self._transposed_input(matmul, i)
+            if transpose is not None:
+                inputs[i] = transpose.input[0]
+                trans[i] = 1
+                self._removed.add(transpose.name)
+                self._consumers[transpose.input[0]].remove(transpose)
+
+        # the Add becomes the Gemm so its output name and consumers stay the same
+        for name in add.input:
+            self._consumers[name].remove(add)
+        add.type = "Gemm"
+        add.input[:] = inputs + [bias]
+        for name in add.input:
+            self._consumers[name].append(add)
+        add.set_attr("transA", trans[0])
+        add.set_attr("transB", trans[1])
+        self._removed.add(matmul.name)
+        log.debug("fused %s and %s into Gemm", matmul.name, add.name)
+        return True
+
+    def optimize(self):
+        g = self._g
+        if g.opset < 7:
+            return 0
+        if self._debug:
+            g.dump_node_statistics("before gemm fusion")
+        nodes = g.get_nodes()
+        for node in nodes:
+            for name in node.input:
+                self._consumers[name].append(node)
+            for name in node.output:
+                self._producers[name] = node
+        fused = 0
+        for node in nodes:
+            if node.type == "MatMul" and not node.domain and self._fuse(node):
+                fused += 1
+        g.set_nodes([n for n in nodes if n.name not in self._removed])
+        g.update_proto()
+        log.debug("fused %d MatMul and Add pair(s) into Gemm", fused)
+        if self._debug:
+            g.dump_node_statistics("after gemm fusion")
+        return fused
@@ -0,0 +1,65 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+"""Merge initializers with the same content."""
+
+import hashlib
+import logging
+
+from onnx import numpy_helper
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.optimizer.initializer_dedup_optimizer")
+
+# pylint: disable=missing-docstring
+
+
+def _payload(tensor):
+    return tensor.raw_data or numpy_helper.to_array(tensor).tobytes()
+
+
+class InitializerDedupOptimizer(object):
+    """Find initializers with byte-identical content, point their consumers to one copy and drop the others.
+
+    After optimize() bytes_saved has the size of the dropped payloads.
+    """
+
+    def __init__(self, graph, debug=False, output_names=None):
+        self._g = graph
+        self._debug = debug
+        self._output_names = set(output_names or [])
+        self.bytes_saved = 0
+
+    def duplicates(self):
+        """Map the name of every duplicated initializer to the name of the copy that is kept."""
+        renames = {}
+        # hash -> list of (name, payload) kept so far, the payload is compared in case of a collision
+        seen = {}
+        for name, tensor in self._g.initializers.items():
+            if name in self._output_names:
+                continue
+            data = _payload(tensor)
+            key = (tensor.data_type, tuple(tensor.dims), hashlib.sha1(data).hexdigest())
+            candidates = seen.setdefault(key, [])
+            for kept, kept_data in candidates:
+                if kept_data == data:
+                    renames[name] = kept
+                    break
+            else:
+                candidates.append((name, data))
+        return renames
+
+    def optimize(self):
+        g = self._g
+        renames = self.duplicates()
+        for node in g.get_nodes():
+            for i, name in enumerate(node.input):
+                if name in renames:
+                    node.input[i] = renames[name]
+        self.bytes_saved = 0
+        for name in renames:
+            self.bytes_saved += len(_payload(g.get_initializer(name)))
+            g.remove_initializer(name)
+        g.update_proto()
+        if renames:
+            log.info("merged %d duplicated initializer(s), saved %d bytes", len(renames), self.bytes_saved)
+        return len(renames)
@@ -0,0 +1,147 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+"""Merge explicit Pad nodes into the pads of the following Conv, MaxPool or AveragePool."""
+
+import collections
+import logging
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.optimizer.pad_fold_optimizer")
+
+# pylint: disable=missing-docstring
+
+# ops that produce values >= 0, a zero pad in front of MaxPool can't win against them
+_NON_NEGATIVE_OPS = ["Relu", "Sigmoid", "Softmax", "Abs", "Exp"]
+
+
+class PadFoldOptimizer(object):
+    """Merge a constant Pad that only pads the spatial axes into the pads of the following Conv or pool.
+
+    The Pad can be in front of a Transpose, which is how NHWC models look:
+    Pad -> Transpose(0, 3, 1, 2) -> Conv. The pads are mapped through the permutation.
+    A zero pad changes the result of MaxPool, which pads with -inf, unless the padded input is non-negative.
+    AveragePool is told to count the pads, onnx leaves them out by default.
+    """
+
+    def __init__(self, graph, debug=False, output_names=None):
+        self._g = graph
+        self._debug = debug
+        self._output_names = set(output_names or [])
+        self._consumers = collections.defaultdict(list)
+        self._producers = {}
+        self._removed = set()
+
+    def _single_consumer(self, name):
+        consumers = self._consumers[name]
+        if len(consumers) != 1 or name in self._output_names:
+            return None
+        return consumers[0]
+
+    def _producer(self, name, op_type):
+        node = self._producers.get(name)
+        if node is None or node.type != op_type or node.name in self._removed:
+            return None
+        return node
+
+    def _pad_value_allowed(self, pad, node):
+        mode = pad.get_attr("mode")
+        if mode is not None and mode.s.decode("utf-8") != "constant":
+            return False
+        value = pad.get_attr("value")
+        value = value.f if value is not None else 0.
+        if node.type == "MaxPool":
+            if value == float("-inf"):
+                return True
+            producer = self._producers.get(pad.input[0])
+            return value <= 0 and producer is not None and producer.type in _NON_NEGATIVE_OPS
+        return value == 0
+
+    def _fold(self, node):
+        g = self._g
+        auto_pad = node.get_attr("auto_pad")
+        if auto_pad is not None and auto_pad.s.decode("utf-8") != "NOTSET":
+            return False
+        if node.type == "MaxPool" and len(node.output) > 1:
+            # the indices would be relative to the padded tensor
+            return False
+
+        transpose = self._producer(node.input[0], "Transpose")
+        if transpose is not None:
+            if self._single_consumer(transpose.output[0]) is not node:
+                return False
+            pad = self._producer(transpose.input[0], "Pad")
+            if pad is None or self._single_consumer(pad.output[0]) is not transpose:
+                return False
+            perm = transpose.get_attr("perm")
+            if perm is None:
+                return False
+            perm = list(perm.ints)
+        else:
+            pad = self._producer(node.input[0], "Pad")
+            if pad is None or self._single_consumer(pad.output[0]) is not node:
+                return False
+            perm = None
+
+        pads = pad.get_attr("pads")
+        if pads is None or len(pad.input) != 1 or not self._pad_value_allowed(pad, node):
+            return False
+        pads = list(pads.ints)
+        rank = len(pads) // 2
+        begin, end = pads[:rank], pads[rank:]
+        if perm is not None:
+            if len(perm) != rank:
+                return False
+            # axis i of the node is axis perm[i] of the pad
+            begin = [begin[p] for p in perm]
+            end = [end[p] for p in perm]
+        if any(begin[:2]) or any(end[:2]) or any(p < 0 for p in pads):
+            # only pad spatial axes, negative pads crop
+            return False
+
+        old_pads = node.get_attr("pads")
+        spatial = rank - 2
+        old_pads = list(old_pads.ints) if old_pads is not None else [0] * spatial * 2
+        if node.type == "AveragePool":
+            count_include_pad = node.get_attr("count_include_pad")
+            count_include_pad = count_include_pad.i if count_include_pad is not None else 0
+            if not count_include_pad and (any(old_pads) or g.opset < 7):
+                # can't mix counted and not counted pads
+                return False
+            node.set_attr("count_include_pad", 1)
+        new_pads = [p + q for p, q in zip(old_pads, begin[2:] + end[2:])]
+        node.set_attr("pads", new_pads)
+
+        # drop the pad, the transpose reads the unpadded tensor
+        if transpose is not None:
+            transpose.input[0] = pad.input[0]
+            shape = g.get_shape(transpose.output[0])
+            if shape:
+                g.set_shape(transpose.output[0], [d - b - e if d != -1 else d for d, b, e in zip(shape, begin, end)])
+        else:
+            node.input[0] = pad.input[0]
+        self._consumers[pad.input[0]].remove(pad)
+        self._consumers[pad.input[0]].append(transpose if transpose is not None else node)
+        self._removed.add(pad.name)
+        log.debug("merged %s into %s", pad.name, node.name)
+        return True
+
+    def optimize(self):
+        g = self._g
+        if self._debug:
+            g.dump_node_statistics("before pad folding")
+        nodes = g.get_nodes()
+        for node in nodes:
+            for name in node.input:
+                self._consumers[name].append(node)
+            for name in node.output:
+                self._producers[name] = node
+        folded = 0
+        for node in nodes:
+            if node.type in ["Conv", "MaxPool", "AveragePool"] and not node.domain and self._fold(node):
+                folded += 1
+        g.set_nodes([n for n in nodes if n.name not in self._removed])
+        g.update_proto()
+        log.debug("merged %d Pad node(s)", folded)
+        if self._debug:
+            g.dump_node_statistics("after pad folding")
+        return folded
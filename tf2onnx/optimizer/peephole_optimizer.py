@@ -0,0 +1,191 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+"""Remove redundant Identity, Cast and Transpose nodes from the onnx graph."""
+
+import collections
+import logging
+
+from onnx import onnx_pb
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.optimizer.peephole_optimizer")
+
+# pylint: disable=missing-docstring
+
+_TP = onnx_pb.TensorProto
+
+# dtypes that can hold every value of the key dtype exactly
+_LOSSLESS_CASTS = {
+    _TP.BOOL: {_TP.INT8, _TP.UINT8, _TP.INT16, _TP.UINT16, _TP.INT32, _TP.UINT32, _TP.INT64, _TP.UINT64,
+               _TP.FLOAT16, _TP.FLOAT, _TP.DOUBLE},
+    _TP.INT8: {_TP.INT16, _TP.INT32, _TP.INT64, _TP.FLOAT16, _TP.FLOAT, _TP.DOUBLE},
+    _TP.UINT8: {_TP.INT16, _TP.UINT16, _TP.INT32, _TP.UINT32, _TP.INT64, _TP.UINT64, _TP.FLOAT16, _TP.FLOAT,
+                _TP.DOUBLE},
+    _TP.INT16: {_TP.INT32, _TP.INT64, _TP.FLOAT, _TP.DOUBLE},
+    _TP.UINT16: {_TP.INT32, _TP.UINT32, _TP.INT64, _TP.UINT64, _TP.FLOAT, _TP.DOUBLE},
+    _TP.INT32: {_TP.INT64, _TP.DOUBLE},
+    _TP.UINT32: {_TP.INT64, _TP.UINT64, _TP.DOUBLE},
+    _TP.FLOAT16: {_TP.FLOAT, _TP.DOUBLE},
+    _TP.FLOAT: {_TP.DOUBLE},
+}
+
+
+def _cast_to(node):
+    to = node.get_attr("to")
+    if to.type == onnx_pb.AttributeProto.STRING:
+        # before opset 6 the type is given by name
+        return _TP.DataType.Value(to.s.decode("utf-8"))
+    return to.i
+
+
+def _perm(node):
+    perm = node.get_attr("perm")
+    return list(perm.ints) if perm is not None else None
+
+
+class PeepholeOptimizer(object):
+    """Remove Identity nodes, Casts to the same dtype, lossless Cast chains and Transpose pairs.
+
+    All nodes go on a worklist once, when a node is changed its consumers go back on the list since
+    they might now match a pattern.
+    If output_names is None the model outputs are unknown: Identity nodes are kept and a bypassed node
+    is only removed if it had consumers.
+    """
+
+    def __init__(self, graph, debug=False, output_names=None):
+        self._g = graph
+        self._debug = debug
+        self._output_names = set(output_names) if output_names is not None else None
+        self._consumers = collections.defaultdict(list)
+        self._producers = {}
+        self._removed = set()
+        self._worklist = collections.deque()
+        self._queued = set()
+        self._handlers = {
+            "Cast": self._cast_handler,
+            "Identity": self._identity_handler,
+            "Transpose": self._transpose_handler,
+        }
+
+    def _dtype(self, name):
+        g = self._g
+        if g.is_initializer(name):
+            return g.get_initializer(name).data_type
+        if g.is_model_input(name):
+            return g.model_inputs[name].type.tensor_type.elem_type
+        return g.get_dtype(name)
+
+    def _push(self, node):
+        if node.name not in self._queued:
+            self._queued.add(node.name)
+            self._worklist.append(node)
+
+    def _is_model_output(self, name):
+        return self._output_names is not None and name in self._output_names
+
+    def _set_input(self, node, i, new_input):
+        self._consumers[node.input[i]].remove(node)
+        node.input[i] = new_input
+        self._consumers[new_input].append(node)
+        self._push(node)
+
+    def _remove_if_dead(self, node):
+        output_name = node.output[0]
+        if self._output_names is None:
+            # without the model outputs any tensor might be one, keep the node
+            return False
+        if self._consumers[output_name] or self._is_model_output(output_name):
+            return False
+        self._removed.add(node.name)
+        for input_name in node.input:
+            self._consumers[input_name].remove(node)
+            producer = self._producers.get(input_name)
+            if producer is not None and producer.name not in self._removed:
+                # the producer might be dead now
+                self._push(producer)
+        return True
+
+    def _bypass(self, node, new_input):
+        """Make all consumers of the node use new_input instead."""
+        output_name = node.output[0]
+        if self._is_model_output(output_name):
+            return False
+        consumers = list(self._consumers[output_name])
+        for consumer in consumers:
+            for i, input_name in enumerate(consumer.input):
+                if input_name == output_name:
+                    self._set_input(consumer, i, new_input)
+        return self._remove_if_dead(node) or bool(consumers)
+
+    def _identity_handler(self, node):
+        if self._output_names is None:
+            return False
+        return self._bypass(node, node.input[0])
+
+    def _cast_handler(self, node):
+        to = _cast_to(node)
+        input_dtype = self._dtype(node.input[0])
+        if input_dtype == to:
+            return self._bypass(node, node.input[0])
+        producer = self._producers.get(node.input[0])
+        if producer is None or producer.type != "Cast" or producer.name in self._removed:
+            return False
+        # x:A -> Cast(B) -> Cast(C) is the same as x:A -> Cast(C) if B holds all values of A
+        first_dtype = self._dtype(producer.input[0])
+        if first_dtype is None or _cast_to(producer) not in _LOSSLESS_CASTS.get(first_dtype, set()):
+            return False
+        if first_dtype == to:
+            changed = self._bypass(node, producer.input[0])
+            self._remove_if_dead(producer)
+            return changed
+        self._set_input(node, 0, producer.input[0])
+        self._remove_if_dead(producer)
+        return True
+
+    def _transpose_handler(self, node):
+        producer = self._producers.get(node.input[0])
+        if producer is None or producer.type != "Transpose" or producer.name in self._removed:
+            return False
+        perm1, perm2 = _perm(producer), _perm(node)
+        if perm1 is None or perm2 is None or len(perm1) != len(perm2):
+            return False
+        perm = [perm1[i] for i in perm2]
+        if perm == list(range(len(perm))):
+            changed = self._bypass(node, producer.input[0])
+        else:
+            # two transposes are one transpose
+            node.set_attr("perm", perm)
+            self._set_input(node, 0, producer.input[0])
+            changed = True
+        self._remove_if_dead(producer)
+        return changed
+
+    def optimize(self):
+        g = self._g
+        if self._debug:
+            g.dump_node_statistics("before peephole optimization")
+        nodes = g.get_nodes()
+        for node in nodes:
+            for input_name in node.input:
+                self._consumers[input_name].append(node)
+            for output_name in node.output:
+                self._producers[output_name] = node
+            self._push(node)
+        changes = 0
+        while self._worklist:
+            node = self._worklist.popleft()
+            self._queued.discard(node.name)
+            if node.name in self._removed:
+                continue
+            handler = self._handlers.get(node.type)
+            if handler is not None and handler(node):
+                changes += 1
+            elif node.type in self._handlers and self._output_names is not None:
+                # nodes left without consumers by other rewrites
+                self._remove_if_dead(node)
+        g.set_nodes([n for n in nodes if n.name not in self._removed])
+        g.update_proto()
+        log.debug("peephole optimizer: %d change(s), removed %d node(s)", changes, len(self._removed))
+        if self._debug:
+            g.dump_node_statistics("after peephole optimization")
+        return changes
@@ -0,0 +1,169 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+"""Collapse chains of Reshape, Flatten, Squeeze and Unsqueeze and remove reshapes that do nothing."""
+
+import collections
+import logging
+
+import numpy as np
+from onnx import onnx_pb
+
+from tf2onnx import utils
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.optimizer.reshape_optimizer")
+
+# pylint: disable=missing-docstring
+
+_SHAPE_OPS = ["Flatten", "Reshape", "Squeeze", "Unsqueeze"]
+
+# attributes of the shape ops that Reshape doesn't have
+_SHAPE_ATTRS = ["axes", "axis", "shape"]
+
+_FLOAT_TYPES = [onnx_pb.TensorProto.FLOAT, onnx_pb.TensorProto.FLOAT16, onnx_pb.TensorProto.DOUBLE]
+
+
+class ReshapeOptimizer(object):
+    """Merge consecutive shape-only ops into one Reshape and drop the ones whose output shape is the input shape.
+
+    A chain can be merged if the shape at its end can be written as Reshape shape: known dims, dims that are
+    the same symbol as the dim of the chain input at the same index (Reshape copies them for 0) and at most
+    one other unknown dim (-1).
+    """
+
+    def __init__(self, graph, debug=False, output_names=None):
+        self._g = graph
+        self._debug = debug
+        self._output_names = set(output_names) if output_names is not None else None
+        self._consumers = collections.defaultdict(list)
+        self._producers = {}
+        self._removed = set()
+
+    def _is_model_output(self, name):
+        return self._output_names is not None and name in self._output_names
+
+    def _symbolic(self, name):
+        """Shape with symbols for unknown dims, None if a dim is not known at all."""
+        g = self._g
+        shape = g.get_shape(name)
+        if not shape:
+            # scalar or unknown rank
+            return None
+        symbolic = g.get_symbolic_shape(name)
+        if symbolic is None or len(symbolic) != len(shape):
+            symbolic = [None] * len(shape)
+        ret = [d if d != -1 else s for d, s in zip(shape, symbolic)]
+        if any(d is None for d in ret):
+            return None
+        return ret
+
+    def _set_input(self, node, i, new_input):
+        self._consumers[node.input[i]].remove(node)
+        node.input[i] = new_input
+        self._consumers[new_input].append(node)
+
+    def _bypass(self, node):
+        output_name = node.output[0]
+        if self._output_names is None or self._is_model_output(output_name):
+            # with unknown model outputs a bypass could rename one
+            return False
+        for consumer in list(self._consumers[output_name]):
+            for i, name in enumerate(consumer.input):
+                if name == output_name:
+                    self._set_input(consumer, i, node.input[0])
+        self._remove(node)
+        return True
+
+    def _remove(self, node):
+        self._removed.add(node.name)
+        for name in node.input:
+            self._consumers[name].remove(node)
+
+    def _reshape_shape(self, source, output_name):
+        """Reshape shape that turns source into output_name, None if there is none."""
+        source_dims = self._symbolic(source) or []
+        dims = self._symbolic(output_name)
+        if dims is None:
+            return None
+        shape = []
+        for i, d in enumerate(dims):
+            if isinstance(d, int):
+                if d == 0:
+                    # 0 has a special meaning for Reshape
+                    return None
+                shape.append(d)
+            elif i < len(source_dims) and source_dims[i] == d:
+                shape.append(0)
+            else:
+                shape.append(-1)
+        if shape.count(-1) > 1:
+            return None
+        return shape
+
+    def _to_reshape(self, node, source, shape):
+        g = self._g
+        for name in _SHAPE_ATTRS:
+            if name in node.attr:
+                del node.attr[name]
+        node.type = "Reshape"
+        for name in node.input[1:]:
+            self._consumers[name].remove(node)
+        del node.input[1:]
+        self._set_input(node, 0, source)
+        if g.opset < 5:
+            node.set_attr("shape", shape)
+        else:
+            shape_name = utils.make_name(node.name + "_shape")
+            g.make_const(shape_name, np.array(shape, dtype=np.int64))
+            node.input.append(shape_name)
+            self._consumers[shape_name].append(node)
+
+    def _collapse(self, node):
+        producer = self._producers.get(node.input[0])
+        if producer is None or producer.type not in _SHAPE_OPS or producer.name in self._removed:
+            return False
+        source = producer.input[0]
+        if self._g.opset < 8 and node.type != "Reshape" and self._g.get_dtype(source) not in _FLOAT_TYPES:
+            # before opset 8 Reshape is only defined for float types
+            return False
+        shape = self._reshape_shape(source, node.output[0])
+        if shape is None:
+            return False
+        self._to_reshape(node, source, shape)
+        if not self._consumers[producer.output[0]] and not self._is_model_output(producer.output[0]) \
+                and self._output_names is not None:
+            self._remove(producer)
+        return True
+
+    def _is_noop(self, node):
+        in_dims, out_dims = self._symbolic(node.input[0]), self._symbolic(node.output[0])
+        return in_dims is not None and in_dims == out_dims
+
+    def optimize(self):
+        g = self._g
+        if self._debug:
+            g.dump_node_statistics("before reshape optimizer")
+        nodes = g.get_nodes()
+        for node in nodes:
+            for name in node.input:
+                self._consumers[name].append(node)
+            for name in node.output:
+                self._producers[name] = node
+        changes = 0
+        # nodes are sorted, a chain collapses from the front to the back
+        for node in nodes:
+            if node.type not in _SHAPE_OPS or node.domain or node.name in self._removed:
+                continue
+            if self._is_noop(node) and self._bypass(node):
+                changes += 1
+            elif self._collapse(node):
+                changes += 1
+                # like Unsqueeze -> Squeeze
+                if self._is_noop(node):
+                    self._bypass(node)
+        g.set_nodes([n for n in nodes if n.name not in self._removed])
+        g.update_proto()
+        log.debug("reshape optimizer: %d change(s)", changes)
+        if self._debug:
+            g.dump_node_statistics("after reshape optimizer")
+        return changes
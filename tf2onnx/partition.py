@@ -0,0 +1,90 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+"""
+tf2onnx.partition - split the converted graph into consecutive onnx models at cut tensors
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import os
+
+from tf2onnx.optimizer.initializer_dedup_optimizer import InitializerDedupOptimizer
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.partition")
+
+
+def split_graph(g, cuts, output_names):
+    """Split g at the cut tensors.
+    Partition 0 computes everything before the first cut, partition i everything that depends on cut i but on
+    no later cut. A partition has the tensors of earlier partitions it reads as inputs and the tensors later
+    partitions read as outputs, so the outputs of one partition feed the next ones by name.
+    Args:
+        g: the Graph, nodes must be sorted
+        cuts: list of tensor names in the order they are computed
+        output_names: list of model outputs
+    Returns:
+        list of (Graph, input names, output names), one more than there are cuts
+    """
+    cut_stage = {name: i + 1 for i, name in enumerate(cuts)}
+    stage = {}
+    node_stage = {}
+    for node in g.get_nodes():
+        s = 0
+        for name in node.input + node.get_implicit_inputs():
+            s = max(s, cut_stage.get(name, stage.get(name, 0)))
+        node_stage[node.name] = s
+        for name in node.output:
+            stage[name] = s
+    for name, i in cut_stage.items():
+        if name not in stage:
+            raise ValueError("cut {} is not computed by a node".format(name))
+        if stage[name] >= i:
+            raise ValueError("cut {} depends on a later cut, cuts must be given in the order they are computed"
+                             .format(name))
+
+    partitions = []
+    for k in range(len(cuts) + 1):
+        inputs = []
+        outputs = []
+        for node in g.get_nodes():
+            # the subgraphs of a node, like the branches of If, read tensors of the outer graph too
+            node_inputs = node.input + node.get_implicit_inputs()
+            if node_stage[node.name] == k:
+                for name in node_inputs:
+                    if name in stage and stage[name] < k and name not in inputs:
+                        inputs.append(name)
+            elif node_stage[node.name] > k:
+                for name in node_inputs:
+                    if stage.get(name) == k and name not in outputs:
+                        outputs.append(name)
+        for name in output_names:
+            if stage.get(name) == k and name not in outputs:
+                outputs.append(name)
+        if not outputs:
+            raise ValueError("partition {} computes nothing, check the cuts {}".format(k, cuts))
+        partitions.append((g.extract(inputs, outputs), inputs, outputs))
+    return partitions
+
+
+def save_partitions(g, cuts, output_names, output_path, doc="", optimize=True, optimizer_passes=None):
+    """Save g as one model per partition, see split_graph().
+    For output_path model.onnx the models are model_part0.onnx, model_part1.onnx, ... Every model holds
+    the initializers it uses, duplicated initializers are merged.
+    Returns:
+        list of the model file names
+    """
+    base, ext = os.path.splitext(output_path)
+    paths = []
+    for i, (part, inputs, outputs) in enumerate(split_graph(g, cuts, output_names)):
+        InitializerDedupOptimizer(part, output_names=outputs).optimize()
+        model_proto = part.make_model(doc, outputs, optimize=optimize, optimizer_passes=optimizer_passes)
+        path = "{}_part{}{}".format(base, i, ext or ".onnx")
+        with open(path, "wb") as f:
+            f.write(model_proto.SerializeToString())
+        log.info("partition %d: %d node(s), inputs %s, outputs %s", i, len(part.get_nodes()), inputs, outputs)
+        paths.append(path)
+    return paths
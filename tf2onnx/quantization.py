@@ -0,0 +1,349 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+"""
+tf2onnx.quantization - int8 weights and calibrated int8 activations for the onnx graph
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import logging
+import os
+
+import numpy as np
+from onnx import helper, numpy_helper, onnx_pb
+
+from tf2onnx import utils
+from tf2onnx.graph import Node
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.quantization")
+
+# pylint: disable=unused-argument
+
+# weights with fewer elements are not worth the dequantize ops
+DEFAULT_MIN_ELEMENTS = 1024
+
+
+def _matmul_axes(node):
+    # B is [K, N], one scale per output column
+    return [1], [1]
+
+
+def _gemm_axes(node):
+    trans_b = node.get_attr("transB")
+    return [1], ([0] if trans_b is not None and trans_b.i else [1])
+
+
+def _conv_axes(node):
+    # W is [M, C / group, ...], one scale per output channel
+    return [1], [0]
+
+
+def _rnn_axes(node):
+    # W and R are [num_directions, gates * hidden_size, ...], one scale per direction and row
+    return [1, 2], [0, 1]
+
+
+# op type -> function returning (weight input indices, channel axes of the weight)
+_WEIGHT_INPUTS = {
+    "Conv": _conv_axes,
+    "GRU": _rnn_axes,
+    "Gemm": _gemm_axes,
+    "LSTM": _rnn_axes,
+    "MatMul": _matmul_axes,
+    "RNN": _rnn_axes,
+}
+
+
+# inputs that get a QuantizeLinear/DequantizeLinear pair with static quantization
+_ACTIVATION_INPUTS = {
+    "Conv": [0],
+    "Gemm": [0],
+    "MatMul": [0, 1],
+}
+
+# ops that move values around without changing them, the range of their output is the range of their input
+_RANGE_PRESERVING_OPS = ["Flatten", "Identity", "Reshape", "Squeeze", "Transpose", "Unsqueeze"]
+
+
+def _quantize(value, channel_axes):
+    """Symmetric int8 quantization with one scale per channel, returns (int8 value, float scale)."""
+    reduce_axes = tuple(i for i in range(value.ndim) if i not in channel_axes)
+    scale = np.max(np.abs(value), axis=reduce_axes, keepdims=True) / 127.
+    # all zero channels
+    scale[scale == 0] = 1.
+    quantized = np.clip(np.round(value / scale), -127, 127).astype(np.int8)
+    return quantized, scale.astype(value.dtype)
+
+
+def _dequantize_nodes(g, name, quantized, scale, channel_axes):
+    """Nodes that turn the int8 weight back into float, returns (nodes, output name)."""
+    q_name = utils.make_name(utils.node_name(name) + "_quantized")
+    g.make_const(q_name, quantized)
+    op_name = utils.make_name(utils.node_name(name) + "_dequantize")
+    output_name = utils.port_name(op_name)
+    if g.opset >= 13 and len(channel_axes) == 1 or g.opset >= 10 and not channel_axes:
+        # DequantizeLinear came with opset 10, per axis with opset 13
+        scale_name = utils.make_name(utils.node_name(name) + "_scale")
+        zero_point_name = utils.make_name(utils.node_name(name) + "_zero_point")
+        attr = {}
+        if channel_axes:
+            attr["axis"] = channel_axes[0]
+            g.make_const(scale_name, scale.reshape(-1))
+            g.make_const(zero_point_name, np.zeros(scale.size, dtype=np.int8))
+        else:
+            g.make_const(scale_name, scale.reshape(()))
+            g.make_const(zero_point_name, np.zeros((), dtype=np.int8))
+        node = Node(helper.make_node("DequantizeLinear", [q_name, scale_name, zero_point_name], [output_name],
+                                     name=op_name, **attr), g)
+        nodes = [node]
+    else:
+        scale_name = utils.make_name(utils.node_name(name) + "_scale")
+        g.make_const(scale_name, scale)
+        cast_name = utils.make_name(op_name)
+        cast = Node(helper.make_node("Cast", [q_name], [utils.port_name(cast_name)], name=cast_name,
+                                     to=onnx_pb.TensorProto.FLOAT), g)
+        g.set_dtype(cast.output[0], onnx_pb.TensorProto.FLOAT)
+        g.set_shape(cast.output[0], list(quantized.shape))
+        node = Node(helper.make_node("Mul", [cast.output[0], scale_name], [output_name], name=op_name), g)
+        nodes = [cast, node]
+    g.set_dtype(output_name, onnx_pb.TensorProto.FLOAT)
+    g.set_shape(output_name, list(quantized.shape))
+    return nodes, output_name
+
+
+def quantize_weights(g, min_elements=DEFAULT_MIN_ELEMENTS):
+    """Store the float32 constant weights of MatMul, Gemm, Conv and the recurrent ops as int8.
+    Every weight gets one scale per output channel and is turned back into float by dequantize ops at the
+    start of the graph, the ops themselves still compute in float.
+    Args:
+        g: the Graph, after the ops are mapped to onnx
+        min_elements: smaller weights are left alone
+    Returns:
+        dict with the number of quantized weights, their size before and after in bytes and the largest
+        absolute error of a dequantized weight
+    """
+    report = {"weights": 0, "bytes_before": 0, "bytes_after": 0, "max_error": 0.}
+    dequantized = {}
+    new_nodes = []
+    for node in g.get_nodes():
+        rule = _WEIGHT_INPUTS.get(node.type)
+        if rule is None or node.domain:
+            continue
+        indices, channel_axes = rule(node)
+        for i in indices:
+            if i >= len(node.input) or not g.is_initializer(node.input[i]):
+                continue
+            name = node.input[i]
+            tensor = g.get_initializer(name)
+            if tensor.data_type != onnx_pb.TensorProto.FLOAT or np.prod(tensor.dims) < min_elements:
+                continue
+            key = (name, tuple(channel_axes))
+            if key not in dequantized:
+                value = numpy_helper.to_array(tensor)
+                if value.ndim <= max(channel_axes):
+                    continue
+                quantized, scale = _quantize(value, channel_axes)
+                nodes, output_name = _dequantize_nodes(g, name, quantized, scale, channel_axes)
+                new_nodes.extend(nodes)
+                dequantized[key] = output_name
+                report["weights"] += 1
+                report["bytes_before"] += value.nbytes
+                report["bytes_after"] += quantized.nbytes + scale.nbytes
+                error = np.max(np.abs(value - quantized.astype(value.dtype) * scale))
+                report["max_error"] = max(report["max_error"], float(error))
+            node.input[i] = dequantized[key]
+
+    # the dequantize nodes only read initializers
+    g.set_nodes(new_nodes + g.get_nodes())
+    g.update_proto()
+    log.info("quantized %d weight(s) from %d to %d bytes, max error %g", report["weights"],
+             report["bytes_before"], report["bytes_after"], report["max_error"])
+    return report
+
+
+def _range_source(producers, name):
+    """The tensor name has the range of, looking through ops that don't change values."""
+    node = producers.get(name)
+    while node is not None and node.type in _RANGE_PRESERVING_OPS and not node.domain:
+        name = node.input[0]
+        node = producers.get(name)
+    return name
+
+
+def calibration_tensors(g):
+    """Map the activations that static quantization needs a range for to the tensor the range is taken from.
+    The source tensor is the activation itself or the input of the layout ops in front of it, which usually
+    is a tensor of the tensorflow graph since the converter keeps tensorflow tensor names.
+    """
+    producers = {name: node for node in g.get_nodes() for name in node.output}
+    ret = {}
+    for node in g.get_nodes():
+        if node.domain:
+            continue
+        for i in _ACTIVATION_INPUTS.get(node.type, []):
+            name = node.input[i]
+            if g.is_initializer(name) or g.get_dtype(name) != onnx_pb.TensorProto.FLOAT:
+                continue
+            ret[name] = _range_source(producers, name)
+    return ret
+
+
+def load_calibration_data(path):
+    """Read calibration batches from a npz file with one array per model input, the first axis is the batch.
+    Returns a list of feed dicts.
+    """
+    data = np.load(path)
+    if not data.files:
+        raise ValueError("no inputs in calibration data " + path)
+    count = min(len(data[k]) for k in data.files)
+    return [{k: data[k][i] for k in data.files} for i in range(count)]
+
+
+def tf_runner(sess):
+    """Evaluator for calibrate() that runs the tensorflow graph of sess."""
+
+    def run(names, feed):
+        known = []
+        for name in names:
+            try:
+                sess.graph.get_tensor_by_name(name)
+                known.append(name)
+            except (KeyError, ValueError):
+                pass
+        values = sess.run(known, feed_dict=feed) if known else []
+        return dict(zip(known, values))
+
+    return run
+
+
+def calibrate(g, feeds=None, run=None, cache_path=None):
+    """Collect the min and max of every tensor static quantization of g needs.
+    Args:
+        g: the Graph, after the ops are mapped to onnx
+        feeds: list of feed dicts, each one is a calibration batch
+        run: function(tensor names, feed dict) returning a dict tensor name -> value for the names it can
+             compute, like tf_runner()
+        cache_path: json file with the ranges of an earlier run, tensors found in it are not computed again
+                    and the new ranges are written back
+    Returns:
+        dict tensor name -> [min, max]
+    """
+    ranges = {}
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            ranges = json.load(f)
+    needed = set(calibration_tensors(g).values())
+    missing = sorted(needed - set(ranges))
+    if missing and run is not None and feeds:
+        for feed in feeds:
+            for name, value in run(missing, feed).items():
+                value = np.asarray(value)
+                if not value.size:
+                    continue
+                low, high = float(np.min(value)), float(np.max(value))
+                if name in ranges:
+                    low, high = min(low, ranges[name][0]), max(high, ranges[name][1])
+                ranges[name] = [low, high]
+        if cache_path:
+            with open(cache_path, "w") as f:
+                json.dump(ranges, f, indent=2, sort_keys=True)
+    log.info("calibration: %d of %d tensor range(s) known", len(needed & set(ranges)), len(needed))
+    return ranges
+
+
+def _activation_params(low, high):
+    """Asymmetric uint8 scale and zero point for the range [low, high], the range always contains 0."""
+    low, high = min(low, 0.), max(high, 0.)
+    scale = (high - low) / 255. or 1.
+    zero_point = int(np.clip(round(-low / scale), 0, 255))
+    return np.array(scale, dtype=np.float32), np.array(zero_point, dtype=np.uint8)
+
+
+def _insert_after_inputs(g, new_nodes):
+    """Put every new node right after the node making its first input, the other inputs are initializers."""
+    readers = collections.defaultdict(list)
+    for node in new_nodes:
+        readers[node.input[0]].append(node)
+    ops = []
+
+    def add(node):
+        ops.append(node)
+        for name in node.output:
+            for reader in readers.pop(name, []):
+                add(reader)
+
+    for name in list(g.model_inputs) + list(g.initializers):
+        for reader in readers.pop(name, []):
+            add(reader)
+    for node in g.get_nodes():
+        add(node)
+    g.set_nodes(ops)
+
+
+def quantize_static(g, ranges):
+    """Run Conv, MatMul and Gemm in int8 with QuantizeLinear/DequantizeLinear pairs.
+    Activations with a range get a uint8 QuantizeLinear followed by DequantizeLinear, the weights of these ops
+    are stored as int8 with DequantizeLinear, per output channel from opset 13. A runtime can fuse the pairs
+    into integer kernels.
+    Args:
+        g: the Graph, after the ops are mapped to onnx
+        ranges: dict tensor name -> [min, max], like calibrate() returns
+    Returns:
+        number of QuantizeLinear nodes inserted
+    """
+    if g.opset < 10:
+        raise ValueError("static quantization needs opset 10 or higher, opset is {}".format(g.opset))
+    sources = calibration_tensors(g)
+    activations = {}
+    weights = {}
+    new_nodes = []
+
+    def quantize_activation(name, low, high):
+        scale, zero_point = _activation_params(low, high)
+        scale_name = utils.make_name(utils.node_name(name) + "_scale")
+        g.make_const(scale_name, scale)
+        zero_point_name = utils.make_name(utils.node_name(name) + "_zero_point")
+        g.make_const(zero_point_name, zero_point)
+        q_name = utils.make_name(utils.node_name(name) + "_quantize")
+        q = Node(helper.make_node("QuantizeLinear", [name, scale_name, zero_point_name],
+                                  [utils.port_name(q_name)], name=q_name), g)
+        g.set_dtype(q.output[0], onnx_pb.TensorProto.UINT8)
+        g.copy_shape(name, q.output[0])
+        dq_name = utils.make_name(utils.node_name(name) + "_dequantize")
+        dq = Node(helper.make_node("DequantizeLinear", [q.output[0], scale_name, zero_point_name],
+                                   [utils.port_name(dq_name)], name=dq_name), g)
+        g.set_dtype(dq.output[0], onnx_pb.TensorProto.FLOAT)
+        g.copy_shape(name, dq.output[0])
+        new_nodes.extend([q, dq])
+        return dq.output[0]
+
+    for node in g.get_nodes():
+        if node.domain or node.type not in _ACTIVATION_INPUTS:
+            continue
+        weight_indices, channel_axes = _WEIGHT_INPUTS[node.type](node)
+        if g.opset < 13:
+            channel_axes = []
+        for i in sorted(set(_ACTIVATION_INPUTS[node.type]) | set(weight_indices)):
+            name = node.input[i]
+            if name in sources and sources[name] in ranges:
+                if name not in activations:
+                    activations[name] = quantize_activation(name, *ranges[sources[name]])
+                node.input[i] = activations[name]
+            elif i in weight_indices and g.is_initializer(name) \
+                    and g.get_initializer(name).data_type == onnx_pb.TensorProto.FLOAT:
+                key = (name, tuple(channel_axes))
+                if key not in weights:
+                    quantized, scale = _quantize(numpy_helper.to_array(g.get_initializer(name)), channel_axes)
+                    nodes, weights[key] = _dequantize_nodes(g, name, quantized, scale, channel_axes)
+                    new_nodes.extend(nodes)
+                node.input[i] = weights[key]
+
+    _insert_after_inputs(g, new_nodes)
+    g.update_proto()
+    log.info("static quantization: %d activation(s), %d weight(s)", len(activations), len(weights))
+    return len(activations)
@@ -5,4 +5,4 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-__all__ = ["gru_rewriter", "lstm_rewriter", "rnn", "rnn_utils", "unit_rewriter_base"]
+__all__ = ["cond_rewriter", "gru_rewriter", "loop_rewriter", "lstm_rewriter", "rnn", "rnn_utils", "unit_rewriter_base"]
@@ -0,0 +1,368 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+"""
+tf2onnx.rewriter.cond_rewriter - rewrite tensorflow conditionals
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import logging
+
+import numpy as np
+from onnx import helper
+
+from tf2onnx import utils
+from tf2onnx.graph import Graph, Node
+from tf2onnx.rewriter.loop_rewriter import copy_node
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.rewriter.cond_rewriter")
+
+# pylint: disable=missing-docstring
+
+_CONTROL_FLOW_OPS = ["Enter", "Exit", "LoopCond", "Merge", "NextIteration", "Switch"]
+
+
+def _const_value(g, name):
+    """Value of a tensor that is a Const, maybe behind Identity nodes, else None."""
+    node = g.get_node_by_name(name)
+    while node is not None and node.type == "Identity":
+        node = g.get_node_by_name(node.input[0])
+    if node is None or not node.is_const():
+        return None
+    return np.array(node.get_tensor_value())
+
+
+def rewrite_constant_switch(g, ops):
+    """Remove the branches of Switch nodes with a constant predicate that are never taken.
+    The taken output of the Switch is replaced by its data input, everything computed from the other output is
+    dead. Like in tensorflow a node is dead if one of its inputs is, a Merge only if all of its inputs are. A
+    Merge left with one live input is replaced by it. Constants that only fed dead nodes are removed as well.
+    """
+    consumers = collections.defaultdict(list)
+    producers = {}
+    nodes = {node.name: node for node in ops}
+    for node in ops:
+        for name in node.input:
+            consumers[name].append(node)
+        for name in node.output:
+            producers[name] = node
+
+    switches = []
+    for node in ops:
+        if node.type != "Switch":
+            continue
+        pred = _const_value(g, node.input[1])
+        if pred is None or pred.size != 1:
+            continue
+        switches.append((node, bool(pred.flatten()[0])))
+    if not switches:
+        return ops
+
+    # propagate the dead outputs
+    dead_tensors = set()
+    dead_nodes = set()
+    stack = []
+    for switch, pred in switches:
+        dead_tensors.add(switch.output[0 if pred else 1])
+        stack.append(switch.output[0 if pred else 1])
+    while stack:
+        name = stack.pop()
+        for node in consumers[name]:
+            if node.name in dead_nodes:
+                continue
+            # the Merge of a while loop is dead with its Enter, the NextIteration input follows
+            if node.type == "Merge" and not all(i in dead_tensors for i in node.input
+                                                if i not in producers or producers[i].type != "NextIteration"):
+                continue
+            dead_nodes.add(node.name)
+            for output in node.output:
+                if output not in dead_tensors:
+                    dead_tensors.add(output)
+                    stack.append(output)
+
+    removed = set(dead_nodes)
+    new_ops = []
+    # the identities tf.cond uses as pivot of a branch have only control outputs
+    pivots = set()
+    for switch, pred in switches:
+        if switch.name not in dead_nodes:
+            live = switch.output[1 if pred else 0]
+            pivots |= {n.name for n in consumers[live] if n.type == "Identity"}
+            g.replace_all_inputs(ops, live, switch.input[0])
+            removed.add(switch.name)
+    for node in ops:
+        if node.type != "Merge" or node.name in removed or not any(i in dead_tensors for i in node.input):
+            continue
+        live = [i for i in node.input if i not in dead_tensors]
+        if any(i in producers and producers[i].type == "NextIteration" for i in node.input):
+            continue
+        if len(live) > 1:
+            # still merges more than one branch
+            node.input[:] = live
+            continue
+        g.replace_all_inputs(ops, node.output[0], live[0])
+        if len(node.output) > 1 and consumers[node.output[1]]:
+            value_index = g.make_const(utils.make_name(node.name + "_value_index"),
+                                       np.array(node.input.index(live[0]), dtype=np.int32))
+            g.replace_all_inputs(ops, node.output[1], value_index.output[0])
+            new_ops.append(value_index)
+        removed.add(node.name)
+
+    # constants that only fed removed nodes
+    ops = [node for node in ops if node.name not in removed] + new_ops
+    used = collections.Counter(i for node in ops for i in node.input)
+    candidates = [producers[i] for name in removed for i in nodes[name].input if i in producers]
+    candidates.extend(nodes[name] for name in pivots)
+    while candidates:
+        node = candidates.pop()
+        if node.name in removed or any(used[o] for o in node.output):
+            continue
+        if not node.is_const() and node.name not in pivots and _const_value(g, node.output[0]) is None:
+            continue
+        removed.add(node.name)
+        for name in node.input:
+            used[name] -= 1
+            if name in producers:
+                candidates.append(producers[name])
+    ops = [node for node in ops if node.name not in removed]
+    log.debug("removed %d node(s) of branches that are never taken", len(removed))
+    return ops
+
+
+def _rename_inputs(nodes, mapping):
+    """Rename the inputs of nodes, also in their subgraphs."""
+    for node in nodes:
+        for i, name in enumerate(node.input):
+            node.input[i] = mapping.get(name, name)
+        for body, _, _ in node.get_body_graphs().values():
+            _rename_inputs(body.get_nodes(), mapping)
+
+
+class CondRewriter(object):
+    """Rewrite the Switch and Merge nodes of a tf.cond into an onnx If.
+
+    The nodes between the Switch outputs of one side and the Merge inputs become the then_branch or the
+    else_branch of the If, one If output per Merge. The branches have no inputs, they use the tensors that went
+    into the Switch nodes from the outer graph.
+    """
+
+    def __init__(self, g):
+        self._g = g
+        self._nodes = {node.name: node for node in g.get_nodes()}
+        self._producers = {}
+        self._consumers = collections.defaultdict(list)
+        for node in g.get_nodes():
+            for name in node.output:
+                self._producers[name] = node
+            for name in node.input + node.get_implicit_inputs():
+                self._consumers[name].append(node)
+
+    def _branch(self, name):
+        """Names of the nodes computing name in a branch and the (Switch name, port) it starts from."""
+        nodes = set()
+        switches = set()
+        stack = [name]
+        while stack:
+            name = stack.pop()
+            node = self._producers.get(name)
+            if node is None:
+                raise ValueError("{} is not computed by a node".format(name))
+            if node.type == "Switch":
+                switches.add((node.name, node.output.index(name)))
+                continue
+            if node.name in nodes:
+                continue
+            if node.type in _CONTROL_FLOW_OPS or node.type == "Placeholder":
+                raise ValueError("{} {} is inside the branch, nested control flow?".format(node.type, node.name))
+            nodes.add(node.name)
+            stack.extend(i for i in node.input + node.get_implicit_inputs() if i)
+        return nodes, switches
+
+    def groups(self):
+        """Lists of (Merge, branches of its inputs), Merge nodes sharing nodes or Switch nodes are one cond."""
+        groups = []
+        for node in self._g.get_nodes():
+            if node.type != "Merge" or any(self._producers.get(i) is not None and
+                                           self._producers[i].type in ["Enter", "NextIteration"] for i in node.input):
+                continue
+            try:
+                branches = [self._branch(name) for name in node.input]
+            except ValueError as ex:
+                log.debug("Merge %s not converted: %s", node.name, ex)
+                continue
+            group = [(node, branches)]
+            members = set().union(*[nodes | {s for s, _ in switches} for nodes, switches in branches])
+            for other, other_members in list(groups):
+                if members & other_members:
+                    groups.remove((other, other_members))
+                    group = other + group
+                    members |= other_members
+            groups.append((group, members))
+        return [group for group, _ in groups]
+
+    def _copy_type(self, name, new_name, graph=None):
+        g = self._g
+        graph = graph or g
+        if g.get_dtype(name):
+            graph.set_dtype(new_name, g.get_dtype(name))
+        if g.get_shape(name) is not None:
+            graph.set_shape(new_name, list(g.get_shape(name)))
+
+    def _make_branch(self, node_names, outputs, mapping):
+        g = self._g
+        branch = Graph([], output_shapes={}, dtypes={}, target=list(g.target), opset=g.opset,
+                       extra_opset=g.extra_opset)
+        ops = [copy_node(node, branch) for node in g.get_nodes() if node.name in node_names]
+        _rename_inputs(ops, mapping)
+        produced = set()
+        for node in ops:
+            for name in node.output:
+                produced.add(name)
+                self._copy_type(name, name, branch)
+        for node in ops:
+            # the shapes of the outer tensors are needed by the handlers
+            for name in node.input + node.get_implicit_inputs():
+                if name not in produced:
+                    self._copy_type(name, name, branch)
+        output_names = []
+        for name in outputs:
+            name = mapping.get(name, name)
+            if name not in produced or name in output_names:
+                # a branch output needs its own name
+                identity_name = utils.make_name(utils.node_name(name) + "_out")
+                identity = Node(helper.make_node("Identity", [name], [utils.port_name(identity_name)],
+                                                 name=identity_name), branch, skip_conversion=True)
+                self._copy_type(name, identity.output[0], branch)
+                ops.append(identity)
+                name = identity.output[0]
+            output_names.append(name)
+        branch.set_nodes(ops)
+        branch.topological_sort(branch.get_nodes())
+        return branch, output_names
+
+    def rewrite(self, group):
+        g = self._g
+        merges = [merge for merge, _ in group]
+        regions = {True: set(), False: set()}
+        outputs = {True: [], False: []}
+        switches = set()
+        for merge, branches in group:
+            if len(merge.input) != 2:
+                raise ValueError("Merge {} has {} inputs".format(merge.name, len(merge.input)))
+            if len(merge.output) > 1 and self._consumers[merge.output[1]]:
+                raise ValueError("value_index of Merge {} is used".format(merge.name))
+            # port 1 of a Switch is the then branch, a branch of constants is the other side
+            sides = []
+            for _, branch_switches in branches:
+                ports = {port for _, port in branch_switches}
+                if len(ports) > 1:
+                    raise ValueError("input of Merge {} is computed from both branches".format(merge.name))
+                sides.append(bool(ports.pop()) if ports else None)
+            if sides[0] is None:
+                sides[0] = sides[1] is False
+            if sides[1] is None:
+                sides[1] = not sides[0]
+            if sides[0] == sides[1]:
+                raise ValueError("both inputs of Merge {} are in one branch".format(merge.name))
+            for (nodes, branch_switches), side, name in zip(branches, sides, merge.input):
+                regions[side] |= nodes
+                outputs[side].append(name)
+                switches |= {switch for switch, _ in branch_switches}
+        preds = {self._nodes[name].input[1] for name in switches}
+        if len(preds) != 1:
+            raise ValueError("Merge {} has not one predicate".format(merges[0].name))
+        pred = preds.pop()
+
+        # constants used outside of a branch stay in the outer graph
+        merge_names = {merge.name for merge in merges}
+        for side in [True, False]:
+            for name in list(regions[side]):
+                node = self._nodes[name]
+                if name not in regions[not side] and \
+                        all(c.name in regions[side] | merge_names for o in node.output for c in self._consumers[o]):
+                    continue
+                if not node.is_const():
+                    raise ValueError("{} is used outside of its branch".format(name))
+                regions[side].discard(name)
+        mapping = {}
+        for name in switches:
+            switch = self._nodes[name]
+            for port, output in enumerate(switch.output):
+                if any(c.name not in regions[bool(port)] | merge_names for c in self._consumers[output]):
+                    raise ValueError("{} is used outside of the branch".format(output))
+                mapping[output] = switch.input[0]
+
+        # validate before anything changes, making the branches renames inputs in the subgraphs of nested nodes
+        removed = regions[True] | regions[False] | switches | merge_names
+        gone = {name for node in removed for name in self._nodes[node].output} - {m.output[0] for m in merges}
+        for name in [pred] + list(mapping.values()):
+            if name in gone:
+                raise ValueError("{} is computed inside the cond".format(name))
+        for node in g.get_nodes():
+            if node.name in removed:
+                continue
+            for name in node.input + node.get_implicit_inputs():
+                if name in gone:
+                    raise ValueError("{} is used outside of the cond by {}".format(name, node.name))
+
+        if_name = utils.make_name(merges[0].name.rsplit("/", 1)[0] + "_If")
+        if_outputs = [utils.port_name(if_name, i) for i in range(len(merges))]
+        if_node = Node(helper.make_node("If", [pred], if_outputs, name=if_name), g, skip_conversion=True)
+        for side, attr_name in [(True, "then_branch"), (False, "else_branch")]:
+            branch, output_names = self._make_branch(regions[side], outputs[side], mapping)
+            if_node.set_body_graph_as_attr(attr_name, branch, [], output_names)
+        # an Identity named like the Merge keeps its output name
+        identities = []
+        for merge, name in zip(merges, if_outputs):
+            self._copy_type(merge.output[0], name)
+            identities.append(Node(helper.make_node("Identity", [name], [merge.output[0]], name=merge.name), g,
+                                   skip_conversion=True))
+
+        ops = [n for n in g.get_nodes() if n.name not in removed] + [if_node] + identities
+        g.set_nodes(ops)
+        log.debug("converted cond %s with %d output(s)", if_name, len(merges))
+        return ops
+
+
+def _remove_pivots(g, ops):
+    """Remove the Switch(pred, pred) tf.cond uses for the control dependencies of the branches."""
+    used = collections.Counter(i for node in ops for i in node.input + node.get_implicit_inputs())
+    removed = set()
+    for node in ops:
+        if node.type != "Switch" or node.input[0] != node.input[1]:
+            continue
+        pivots = [n for n in ops if n.type == "Identity" and n.input[0] in node.output]
+        if any(used[o] for pivot in pivots for o in pivot.output) or \
+                sum(used[o] for o in node.output) != len(pivots):
+            continue
+        removed |= {node.name} | {pivot.name for pivot in pivots}
+    return [node for node in ops if node.name not in removed]
+
+
+def rewrite_cond(g, ops):
+    """Rewrite the tf.cond of the graph into onnx If, inner conds first.
+    A cond that can't be converted is left alone, mapping then fails for its Switch and Merge as before.
+    """
+    # the rewriter works on the graph, start from the nodes we were given
+    g.set_nodes(ops)
+    while True:
+        rewriter = CondRewriter(g)
+        groups = rewriter.groups()
+        converted = False
+        for group in groups:
+            try:
+                rewriter.rewrite(group)
+                converted = True
+                break
+            except ValueError as ex:
+                log.debug("cond %s not converted: %s", group[0][0].name, ex)
+                # forget the nodes the failed attempt created
+                g.set_nodes(g.get_nodes())
+        if not converted:
+            for group in groups:
+                log.warning("can't convert cond %s", group[0][0].name)
+            return _remove_pivots(g, g.get_nodes())
@@ -0,0 +1,339 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+"""
+tf2onnx.rewriter.loop_rewriter - convert tensorflow while loops to onnx Loop
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import logging
+
+import numpy as np
+from onnx import helper, onnx_pb
+
+from tf2onnx import utils
+from tf2onnx.graph import Graph, Node
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.rewriter.loop_rewriter")
+
+# pylint: disable=missing-docstring
+
+# ops of the while loop frame itself, they are replaced by the Loop node
+_FRAME_OPS = ["Enter", "Exit", "LoopCond", "Merge", "NextIteration", "Switch"]
+
+_LoopVar = collections.namedtuple("LoopVar", "enter merge switch next_iteration exit")
+
+
+def _is_tensor_array(node):
+    return node.type.startswith("TensorArray")
+
+
+def copy_node(node, graph, name=None, inputs=None, outputs=None):
+    """Copy of node in graph, with all attributes and subgraphs."""
+    onnx_node = helper.make_node(node.type, node.input if inputs is None else inputs,
+                                 node.output if outputs is None else outputs, name=name or node.name)
+    if node.domain:
+        onnx_node.domain = node.domain
+    onnx_node.attribute.extend(node.attr.values())
+    new_node = Node(onnx_node, graph, skip_conversion=node.need_skip())
+    new_node.get_body_graphs().update(node.get_body_graphs())
+    return new_node
+
+
+class LoopRewriter(object):
+    """Rewrite one while loop frame into an onnx Loop.
+
+    Every loop variable (Enter -> Merge -> Switch -> body -> NextIteration) becomes a loop carried value, every
+    constant Enter a loop carried value the body passes on unchanged. The condition is copied twice, once in
+    front of the Loop for the initial values and once at the end of the body for the next iteration.
+    A TensorArray unstacked before the loop and read in the body becomes a Gather of the unstacked tensor, a
+    TensorArray written once per iteration and stacked after the loop becomes a scan output of the Loop.
+    """
+
+    def __init__(self, g, enters):
+        self._g = g
+        self._enters = enters
+        self._nodes = {node.name: node for node in g.get_nodes()}
+        self._producers = {}
+        self._consumers = collections.defaultdict(list)
+        for node in g.get_nodes():
+            for name in node.output:
+                self._producers[name] = node
+            for name in node.input + node.get_implicit_inputs():
+                self._consumers[name].append(node)
+
+    def _single_consumer(self, name, op_type):
+        consumers = [n for n in self._consumers[name] if n.type == op_type]
+        if len(consumers) != 1:
+            raise ValueError("{} has {} {} consumers".format(name, len(consumers), op_type))
+        return consumers[0]
+
+    def _region(self, outputs, boundary):
+        """Nodes computing outputs from the boundary tensors, in graph order."""
+        found = set()
+        stack = [name for name in outputs if name not in boundary]
+        while stack:
+            name = stack.pop()
+            node = self._producers.get(name)
+            if node is None:
+                raise ValueError("{} is not computed inside the loop".format(name))
+            if node.name in found:
+                continue
+            if node.type in _FRAME_OPS or node.type == "Placeholder":
+                raise ValueError("{} {} is inside the loop, nested frame?".format(node.type, node.name))
+            found.add(node.name)
+            stack.extend(i for i in node.input + node.get_implicit_inputs() if i and i not in boundary)
+        return [n for n in self._g.get_nodes() if n.name in found]
+
+    def _copy_type(self, name, new_name, graph=None):
+        g = self._g
+        graph = graph or g
+        if g.get_dtype(name):
+            graph.set_dtype(new_name, g.get_dtype(name))
+        if g.get_shape(name) is not None:
+            graph.set_shape(new_name, list(g.get_shape(name)))
+
+    def _clone(self, nodes, mapping, graph):
+        """Copy nodes with new names into graph, inputs are renamed by mapping which gets the new outputs."""
+        ret = []
+        for node in nodes:
+            name = utils.make_name(node.name)
+            outputs = [utils.port_name(name, i) for i in range(len(node.output))]
+            ret.append(copy_node(node, graph, name, [mapping.get(i, i) for i in node.input], outputs))
+            for old, new in zip(node.output, outputs):
+                mapping[old] = new
+                self._copy_type(old, new, graph)
+        return ret
+
+    def _loop_vars(self):
+        loop_vars = []
+        invariants = []
+        loop_cond = None
+        for enter in self._enters:
+            is_constant = enter.get_attr("is_constant")
+            if is_constant is not None and is_constant.i:
+                invariants.append(enter)
+                continue
+            merge = self._single_consumer(enter.output[0], "Merge")
+            next_iterations = [self._producers.get(i) for i in merge.input if i != enter.output[0]]
+            if len(next_iterations) != 1 or next_iterations[0] is None \
+                    or next_iterations[0].type != "NextIteration":
+                raise ValueError("Merge {} has no NextIteration input".format(merge.name))
+            switch = self._single_consumer(merge.output[0], "Switch")
+            cond = self._producers.get(switch.input[1])
+            if cond is None or cond.type != "LoopCond" or loop_cond not in [None, cond]:
+                raise ValueError("Switch {} is not controlled by the LoopCond of the frame".format(switch.name))
+            loop_cond = cond
+            exits = [n for n in self._consumers[switch.output[0]] if n.type == "Exit"]
+            loop_vars.append(_LoopVar(enter, merge, switch, next_iterations[0], exits[0] if exits else None))
+        if loop_cond is None:
+            raise ValueError("no loop variable")
+        return loop_vars, invariants, loop_cond
+
+    def _unstacked_source(self, read):
+        """The tensor a TensorArray read in the body was unstacked from."""
+        handle_enter = self._producers.get(read.input[0])
+        if handle_enter is None or handle_enter.type != "Enter":
+            raise ValueError("TensorArray of {} is not created outside the loop".format(read.name))
+        scatters = [n for n in self._consumers[handle_enter.input[0]] if n.type == "TensorArrayScatterV3"]
+        if len(scatters) != 1:
+            raise ValueError("TensorArray of {} is not filled by one scatter".format(read.name))
+        indices = self._producers.get(scatters[0].input[1])
+        if indices is None or indices.type != "Range" or not indices.inputs[0].is_const() \
+                or not indices.inputs[2].is_const() \
+                or np.array(indices.inputs[0].get_tensor_value()).flatten().tolist() != [0] \
+                or np.array(indices.inputs[2].get_tensor_value()).flatten().tolist() != [1]:
+            raise ValueError("TensorArray of {} is not an unstacked tensor".format(read.name))
+        return scatters[0].input[2]
+
+    def _remove_dead(self, ops, removed):
+        """Drop the nodes that only fed removed nodes, like the TensorArray setup in front of the loop."""
+        candidates = {self._producers[i].name for name in removed for i in self._nodes[name].input
+                      if i in self._producers}
+        used = collections.Counter(i for node in ops for i in node.input + node.get_implicit_inputs())
+        while True:
+            dead = [n for n in ops if n.name in candidates and not any(used[o] for o in n.output)]
+            if not dead:
+                return ops
+            for node in dead:
+                for name in node.input + node.get_implicit_inputs():
+                    used[name] -= 1
+                    if name in self._producers:
+                        candidates.add(self._producers[name].name)
+            dead_names = {n.name for n in dead}
+            ops = [n for n in ops if n.name not in dead_names]
+
+    def rewrite(self):
+        g = self._g
+        loop_vars, invariants, loop_cond = self._loop_vars()
+
+        # loop variables holding the flow of a TensorArray written in the body become scan outputs
+        carried = []
+        scans = []
+        for var in loop_vars:
+            writer = self._producers.get(var.next_iteration.input[0])
+            if writer is None or writer.type != "TensorArrayWriteV3":
+                carried.append(var)
+                continue
+            consumers = self._consumers[var.exit.output[0]] if var.exit else []
+            gathers = [n for n in consumers if n.type == "TensorArrayGatherV3"]
+            # the size is used for the indices of the gather, anything else is caught when the frame is removed
+            if any(n.type not in ["TensorArrayGatherV3", "TensorArraySizeV3"] for n in consumers):
+                raise ValueError("TensorArray written by {} is not only stacked".format(writer.name))
+            scans.append((var, writer, gathers))
+        # TensorArray handles and flows don't go into the loop
+        ta_enters = [e for e in invariants if all(_is_tensor_array(n) for n in self._consumers[e.output[0]])]
+        invariants = [e for e in invariants if e not in ta_enters]
+
+        body_inputs = {var.switch.output[1] for var in carried} | {e.output[0] for e in invariants}
+        scan_values = [writer.input[2] for _, writer, _ in scans]
+        body_nodes = self._region([var.next_iteration.input[0] for var in carried] + scan_values,
+                                  body_inputs | {e.output[0] for e in ta_enters})
+        reads = [n for n in body_nodes if n.type == "TensorArrayReadV3"]
+        body_nodes = [n for n in body_nodes if n not in reads]
+        if any(_is_tensor_array(n) for n in body_nodes):
+            raise ValueError("unsupported TensorArray use in the loop body")
+        read_sources = [self._unstacked_source(read) for read in reads]
+        cond_nodes = self._region([loop_cond.input[0]],
+                                  {var.merge.output[0] for var in carried} | {e.output[0] for e in invariants})
+
+        # condition for the initial values, in front of the loop
+        mapping = {var.merge.output[0]: var.enter.input[0] for var in carried}
+        mapping.update({e.output[0]: e.input[0] for e in invariants})
+        outer_nodes = self._clone(cond_nodes, mapping, g)
+        cond_init = mapping.get(loop_cond.input[0], loop_cond.input[0])
+
+        # the body, its inputs are iteration number, condition, loop variables and invariants
+        body = Graph([], output_shapes={}, dtypes={}, target=list(g.target), opset=g.opset,
+                     extra_opset=g.extra_opset)
+        iter_name = utils.port_name(utils.make_name(loop_cond.name + "_iter"))
+        cond_name = utils.port_name(utils.make_name(loop_cond.name + "_cond"))
+        input_names = [iter_name, cond_name] + [var.switch.output[1] for var in carried] + \
+                      [e.output[0] for e in invariants]
+        input_types = [(onnx_pb.TensorProto.INT64, []), (onnx_pb.TensorProto.BOOL, [])]
+        input_types.extend((g.get_dtype(name), g.get_shape(name)) for name in input_names[2:])
+        body_ops = []
+        for name, (dtype, shape) in zip(input_names, input_types):
+            node = Node(helper.make_node("Placeholder", [], [name], name=utils.node_name(name)), body)
+            node.dtype = dtype
+            body.set_dtype(name, dtype)
+            if shape is not None:
+                body.set_shape(name, list(shape))
+            body_ops.append(node)
+        for node in body_nodes:
+            body_ops.append(copy_node(node, body))
+            for name in node.output:
+                self._copy_type(name, name, body)
+        for read, name in zip(reads, read_sources):
+            # TensorArrayReadV3(handle, index, flow) is one slice of the unstacked tensor, the body reads the
+            # unstacked tensor from the outer graph
+            gather = Node(helper.make_node("Gather", [name, read.input[1]], [read.output[0]], name=read.name), body,
+                          skip_conversion=True)
+            self._copy_type(name, name, body)
+            self._copy_type(read.output[0], read.output[0], body)
+            body_ops.append(gather)
+        mapping = {var.merge.output[0]: var.next_iteration.input[0] for var in carried}
+        body_ops.extend(self._clone(cond_nodes, mapping, body))
+        output_names = [mapping.get(loop_cond.input[0], loop_cond.input[0])]
+        for name in [var.next_iteration.input[0] for var in carried] + [e.output[0] for e in invariants] + \
+                scan_values:
+            if name in input_names or name in output_names:
+                # a body output needs its own name
+                identity_name = utils.make_name(utils.node_name(name) + "_out")
+                identity = Node(helper.make_node("Identity", [name], [utils.port_name(identity_name)],
+                                                 name=identity_name), body, skip_conversion=True)
+                body.set_dtype(identity.output[0], body.get_dtype(name))
+                body_ops.append(identity)
+                name = identity.output[0]
+            output_names.append(name)
+        body.set_nodes(body_ops)
+        body.topological_sort(body.get_nodes())
+
+        # the Loop, an Identity named like the Exit keeps the name of a loop variable
+        loop_name = utils.make_name(loop_cond.name.rsplit("/", 1)[0] + "_Loop")
+        outputs = []
+        exits = []
+        for var in carried:
+            name = utils.port_name(loop_name, len(outputs))
+            self._copy_type(var.switch.output[1], name)
+            outputs.append(name)
+            if var.exit:
+                exits.append(Node(helper.make_node("Identity", [name], [var.exit.output[0]], name=var.exit.name), g,
+                                  skip_conversion=True))
+        for enter in invariants:
+            name = utils.port_name(loop_name, len(outputs))
+            self._copy_type(enter.output[0], name)
+            outputs.append(name)
+        renames = {}
+        for _, writer, gathers in scans:
+            name = utils.port_name(loop_name, len(outputs))
+            outputs.append(name)
+            g.set_dtype(name, g.get_dtype(writer.input[2]))
+            shape = g.get_shape(writer.input[2])
+            if shape is not None:
+                g.set_shape(name, [-1] + list(shape))
+            for gather in gathers:
+                renames[gather.output[0]] = name
+        inputs = ["", cond_init] + [var.enter.input[0] for var in carried] + [e.input[0] for e in invariants]
+        loop = Node(helper.make_node("Loop", inputs, outputs, name=loop_name), g, skip_conversion=True)
+        loop.set_body_graph_as_attr("body", body, input_names, output_names)
+
+        # drop the frame and what only fed it
+        removed = {n.name for n in body_nodes + cond_nodes + reads + self._enters + [loop_cond]}
+        for var in loop_vars:
+            removed |= {var.merge.name, var.switch.name, var.next_iteration.name}
+            if var.exit:
+                removed.add(var.exit.name)
+        for _, writer, gathers in scans:
+            removed |= {writer.name} | {n.name for n in gathers}
+        ops = [n for n in g.get_nodes() if n.name not in removed] + outer_nodes + [loop] + exits
+        ops = self._remove_dead(ops, removed)
+        gone = {name for node in removed for name in self._nodes[node].output} - {n.output[0] for n in exits}
+        for node in ops:
+            for name in node.input + node.get_implicit_inputs():
+                if renames.get(name, name) in gone:
+                    raise ValueError("{} is used outside of the loop by {}".format(name, node.name))
+        for old, new in renames.items():
+            g.replace_all_inputs(ops, old, new)
+        g.set_nodes(ops)
+        log.debug("converted while loop %s with %d loop variable(s) and %d scan output(s)", loop_name,
+                  len(carried), len(scans))
+        return ops
+
+
+def _frames(g):
+    """Frame name -> list of Enter nodes."""
+    frames = collections.OrderedDict()
+    for node in g.get_nodes():
+        if node.type == "Enter":
+            frames.setdefault(node.get_attr("frame_name").s, []).append(node)
+    return frames
+
+
+def rewrite_loops(g, ops):
+    """Rewrite the while loops of the graph into onnx Loop, inner loops first.
+    A loop that can't be converted is left alone, mapping then fails for its frame ops as before.
+    """
+    # the rewriter works on the graph, start from the nodes we were given
+    g.set_nodes(ops)
+    while True:
+        frames = _frames(g)
+        converted = False
+        for name, enters in frames.items():
+            try:
+                LoopRewriter(g, enters).rewrite()
+                converted = True
+                break
+            except ValueError as ex:
+                # an outer loop can't be converted while an inner loop is in its body
+                log.debug("while loop %s not converted: %s", name, ex)
+                # forget the nodes the failed attempt created
+                g.set_nodes(g.get_nodes())
+        if not converted:
+            for name in frames:
+                log.warning("can't convert while loop %s", name)
+            return g.get_nodes()
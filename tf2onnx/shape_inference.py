@@ -0,0 +1,744 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+"""
+tf2onnx.shape_inference - symbolic shape inference on the internal graph
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import logging
+
+import numpy as np
+from onnx import helper, numpy_helper
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("tf2onnx.shape_inference")
+
+# pylint: disable=unused-argument,missing-docstring
+
+# Shapes used by the rules are lists of dims. A dim is an int for a known dimension, a str naming a
+# symbolic dimension or None if nothing is known about it. A shape of None means the rank is unknown.
+
+
+def _attr(node, name, default=None):
+    attr = node.get_attr(name)
+    if attr is None:
+        return default
+    val = helper.get_attribute_value(attr)
+    if isinstance(val, bytes):
+        val = val.decode("utf-8")
+    return val
+
+
+# prefix of the names given to unknown dims, names given by the user win over those
+AUTO_SYMBOL_PREFIX = "unk__"
+
+
+def _auto_symbol(name, i):
+    return "{}{}_{}".format(AUTO_SYMBOL_PREFIX, name, i)
+
+
+def _is_auto_symbol(dim):
+    return dim.startswith(AUTO_SYMBOL_PREFIX)
+
+
+def _is_int(dim):
+    return isinstance(dim, (int, np.integer)) and not isinstance(dim, bool)
+
+
+def _prod(dims):
+    ret = 1
+    for d in dims:
+        ret *= d
+    return ret
+
+
+def _normalize_axis(axis, rank):
+    return axis + rank if axis < 0 else axis
+
+
+def _same_as_input(ctx, node, inputs):
+    return [inputs[0]]
+
+
+def _broadcast_shapes(ctx, shapes):
+    if any(s is None for s in shapes):
+        return None
+    rank = max(len(s) for s in shapes)
+    ret = []
+    for i in range(rank):
+        dims = [s[i - rank + len(s)] for s in shapes if i - rank + len(s) >= 0]
+        ret.append(ctx.broadcast_dims(dims))
+    return ret
+
+
+def _broadcast(ctx, node, inputs):
+    if node.get_attr("axis") is not None:
+        # legacy broadcast along an axis before opset 7
+        return None
+    shape = _broadcast_shapes(ctx, inputs)
+    return [shape] if shape is not None else None
+
+
+def _matmul(ctx, node, inputs):
+    a, b = inputs[0], inputs[1]
+    if a is None or b is None or len(a) < 2 or len(b) < 2:
+        return None
+    if _attr(node, "transpose_a", 0) or _attr(node, "adj_x", 0):
+        a = a[:-2] + [a[-1], a[-2]]
+    if _attr(node, "transpose_b", 0) or _attr(node, "adj_y", 0):
+        b = b[:-2] + [b[-1], b[-2]]
+    ctx.unify(a[-1], b[-2])
+    batch = _broadcast_shapes(ctx, [a[:-2], b[:-2]])
+    return [batch + [a[-2], b[-1]]]
+
+
+def _gemm(ctx, node, inputs):
+    a, b = inputs[0], inputs[1]
+    if a is None or b is None or len(a) != 2 or len(b) != 2:
+        return None
+    if _attr(node, "transA", 0):
+        a = [a[1], a[0]]
+    if _attr(node, "transB", 0):
+        b = [b[1], b[0]]
+    ctx.unify(a[1], b[0])
+    return [[a[0], b[1]]]
+
+
+def _conv_dim(in_dim, kernel, stride, dilation, pads, same):
+    """Output size of a convolution or pooling along one axis."""
+    if same:
+        if stride == 1:
+            return in_dim
+        return -(-in_dim // stride) if _is_int(in_dim) else None
+    if kernel is None:
+        return None
+    extent = (kernel - 1) * dilation + 1
+    if stride == 1 and pads == extent - 1:
+        # output has the size of the input
+        return in_dim
+    if not _is_int(in_dim):
+        return None
+    return (in_dim + pads - extent) // stride + 1
+
+
+def _spatial(ctx, node, x, kernel_shape, strides, dilations, pads, same):
+    """Spatial output dims for nchw input x."""
+    spatial = len(x) - 2
+    ret = []
+    for i in range(spatial):
+        pad = pads[i] + pads[i + spatial] if pads else 0
+        ret.append(_conv_dim(x[i + 2], kernel_shape[i] if kernel_shape else None,
+                             strides[i] if strides else 1, dilations[i] if dilations else 1, pad, same))
+    return ret
+
+
+def _tf_conv(ctx, node, inputs):
+    """Conv2D, DepthwiseConv2dNative, MaxPool and AvgPool in tensorflow layout."""
+    x = inputs[0]
+    if x is None or len(x) != 4:
+        return None
+    nhwc = node.is_nhwc()
+    if nhwc:
+        x = [x[0], x[3], x[1], x[2]]
+
+    def to_nchw(vals):
+        if vals is None or len(vals) != 4:
+            return vals
+        return [vals[0], vals[3], vals[1], vals[2]] if nhwc else vals
+
+    strides = to_nchw(_attr(node, "strides"))
+    dilations = to_nchw(_attr(node, "dilations"))
+    same = _attr(node, "padding") == "SAME"
+    if node.type in ["MaxPool", "AvgPool"]:
+        ksize = to_nchw(_attr(node, "ksize"))
+        kernel_shape = ksize[2:] if ksize else None
+        channels = x[1]
+    else:
+        w = inputs[1]
+        if w is None or len(w) != 4:
+            return None
+        # kernel is hwio for all data formats
+        kernel_shape = w[:2]
+        ctx.unify(x[1], w[2])
+        if node.type == "DepthwiseConv2dNative":
+            channels = x[1] * w[3] if _is_int(x[1]) and _is_int(w[3]) else None
+        else:
+            channels = w[3]
+    if any(not _is_int(k) for k in kernel_shape or [None]):
+        kernel_shape = None
+    spatial = _spatial(ctx, node, x, kernel_shape, strides[2:] if strides else None,
+                       dilations[2:] if dilations else None, None, same)
+    out = [x[0], channels] + spatial
+    if nhwc:
+        out = [out[0], out[2], out[3], out[1]]
+    return [out]
+
+
+def _onnx_conv(ctx, node, inputs):
+    """onnx Conv, MaxPool and AveragePool, always nchw."""
+    if not ctx.mapped:
+        return _tf_conv(ctx, node, inputs) if node.type in ["MaxPool"] else None
+    x = inputs[0]
+    if x is None or len(x) < 3:
+        return None
+    kernel_shape = _attr(node, "kernel_shape")
+    if node.type == "Conv":
+        w = inputs[1]
+        if w is None or len(w) != len(x):
+            return None
+        if kernel_shape is None and all(_is_int(k) for k in w[2:]):
+            kernel_shape = w[2:]
+        channels = w[0]
+        if _attr(node, "group", 1) == 1:
+            ctx.unify(x[1], w[1])
+    else:
+        channels = x[1]
+    auto_pad = _attr(node, "auto_pad", "NOTSET")
+    if auto_pad == "VALID":
+        auto_pad = "NOTSET"
+    if _attr(node, "ceil_mode", 0):
+        return None
+    spatial = _spatial(ctx, node, x, kernel_shape, _attr(node, "strides"), _attr(node, "dilations"),
+                       _attr(node, "pads"), auto_pad in ["SAME_UPPER", "SAME_LOWER"])
+    return [[x[0], channels] + spatial]
+
+
+def _global_pool(ctx, node, inputs):
+    x = inputs[0]
+    if x is None:
+        return None
+    return [x[:2] + [1] * (len(x) - 2)]
+
+
+def _transpose(ctx, node, inputs):
+    x = inputs[0]
+    if x is None:
+        return None
+    perm = _attr(node, "perm")
+    if perm is None and len(node.input) > 1:
+        perm = ctx.const_value(node.input[1])
+    if perm is None:
+        if ctx.mapped:
+            perm = list(reversed(range(len(x))))
+        else:
+            return None
+    if len(perm) != len(x):
+        return None
+    return [[x[i] for i in perm]]
+
+
+def _reshape(ctx, node, inputs):
+    x = inputs[0]
+    shape = _attr(node, "shape")
+    if shape is None and len(node.input) > 1:
+        shape = ctx.const_value(node.input[1])
+    if shape is None:
+        return None
+    shape = [int(d) for d in shape]
+    if ctx.mapped and x is not None:
+        # in onnx 0 copies the dimension of the input
+        shape = [x[i] if d == 0 and i < len(x) else d for i, d in enumerate(shape)]
+    if -1 not in shape:
+        return [shape]
+    if x is None:
+        return [[None if d == -1 else d for d in shape]]
+    known_out = _prod([d for d in shape if d != -1 and _is_int(d)])
+    in_ints = [d for d in x if _is_int(d)]
+    in_other = [d for d in x if not _is_int(d)]
+    out_other = [d for d in shape if d != -1 and not _is_int(d)]
+    # symbolic dims copied by 0 cancel out with the same symbol of the input
+    for d in out_other:
+        if d in in_other:
+            in_other.remove(d)
+        else:
+            return [[None if v == -1 else v for v in shape]]
+    if not in_other:
+        rest = _prod(in_ints) // known_out if known_out else None
+    elif len(in_other) == 1 and in_other[0] is not None and _prod(in_ints) == known_out:
+        rest = in_other[0]
+    else:
+        rest = None
+    return [[rest if d == -1 else d for d in shape]]
+
+
+def _flatten(ctx, node, inputs):
+    x = inputs[0]
+    if x is None:
+        return None
+    axis = _attr(node, "axis", 1)
+    left, right = x[:axis], x[axis:]
+    dims = []
+    for part in [left, right]:
+        if all(_is_int(d) for d in part):
+            dims.append(_prod(part))
+        elif len(part) == 1:
+            dims.append(part[0])
+        elif len([d for d in part if d != 1]) == 1:
+            dims.append([d for d in part if d != 1][0])
+        else:
+            dims.append(None)
+    return [dims]
+
+
+def _squeeze(ctx, node, inputs):
+    x = inputs[0]
+    if x is None:
+        return None
+    axes = _attr(node, "axes")
+    if axes is None:
+        axes = _attr(node, "squeeze_dims")
+    if not axes:
+        if any(not _is_int(d) for d in x):
+            return None
+        return [[d for d in x if d != 1]]
+    axes = [_normalize_axis(a, len(x)) for a in axes]
+    return [[d for i, d in enumerate(x) if i not in axes]]
+
+
+def _unsqueeze(ctx, node, inputs):
+    x = inputs[0]
+    if x is None:
+        return None
+    if node.type == "ExpandDims":
+        axes = ctx.const_value(node.input[1])
+        if axes is None:
+            return None
+        axes = [_normalize_axis(int(np.array(axes).flatten()[0]), len(x) + 1)]
+    else:
+        axes = _attr(node, "axes")
+    ret = list(x)
+    for axis in sorted(axes):
+        ret.insert(axis, 1)
+    return [ret]
+
+
+def _concat(ctx, node, inputs):
+    if ctx.mapped:
+        axis = _attr(node, "axis")
+        shapes = inputs
+    elif node.type == "ConcatV2":
+        axis = ctx.const_value(node.input[-1])
+        shapes = inputs[:-1]
+    else:
+        axis = ctx.const_value(node.input[0])
+        shapes = inputs[1:]
+    if axis is None or any(s is None for s in shapes):
+        return None
+    axis = int(np.array(axis).flatten()[0])
+    rank = len(shapes[0])
+    if any(len(s) != rank for s in shapes):
+        return None
+    axis = _normalize_axis(axis, rank)
+    ret = list(shapes[0])
+    for s in shapes[1:]:
+        for i in range(rank):
+            if i != axis:
+                ret[i] = ctx.unify(ret[i], s[i])
+    dims = [s[axis] for s in shapes]
+    ret[axis] = sum(dims) if all(_is_int(d) for d in dims) else None
+    return [ret]
+
+
+def _pack(ctx, node, inputs):
+    if any(s is None for s in inputs):
+        return None
+    ret = list(inputs[0])
+    for s in inputs[1:]:
+        if len(s) != len(ret):
+            return None
+        ret = [ctx.unify(a, b) for a, b in zip(ret, s)]
+    ret.insert(_normalize_axis(_attr(node, "axis", 0), len(ret) + 1), len(inputs))
+    return [ret]
+
+
+def _shape(ctx, node, inputs):
+    if inputs[0] is None:
+        return None
+    return [[len(inputs[0])]]
+
+
+def _size(ctx, node, inputs):
+    return [[]]
+
+
+def _gather(ctx, node, inputs):
+    data, indices = inputs[0], inputs[1]
+    if data is None or indices is None:
+        return None
+    if node.type == "GatherV2":
+        axis = ctx.const_value(node.input[2])
+        if axis is None:
+            return None
+        axis = int(np.array(axis).flatten()[0])
+    else:
+        axis = _attr(node, "axis", 0)
+    axis = _normalize_axis(axis, len(data))
+    return [data[:axis] + indices + data[axis + 1:]]
+
+
+def _pad(ctx, node, inputs):
+    x = inputs[0]
+    if x is None:
+        return None
+    pads = _attr(node, "pads")
+    if pads is None:
+        if ctx.mapped or len(node.input) < 2:
+            return None
+        paddings = ctx.const_value(node.input[1])
+        if paddings is None:
+            return None
+        paddings = np.array(paddings).reshape((-1, 2))
+        pads = list(paddings[:, 0]) + list(paddings[:, 1])
+    rank = len(x)
+    if len(pads) != 2 * rank:
+        return None
+    ret = []
+    for i, d in enumerate(x):
+        total = int(pads[i] + pads[i + rank])
+        if total == 0:
+            ret.append(d)
+        else:
+            ret.append(d + total if _is_int(d) else None)
+    return [ret]
+
+
+def _reduce(ctx, node, inputs):
+    x = inputs[0]
+    if x is None:
+        return None
+    if ctx.mapped:
+        axes = _attr(node, "axes")
+        keepdims = _attr(node, "keepdims", 1)
+    else:
+        axes = ctx.const_value(node.input[1])
+        keepdims = _attr(node, "keep_dims", 0)
+    if axes is None:
+        if not ctx.mapped:
+            return None
+        axes = range(len(x))
+    axes = [_normalize_axis(int(a), len(x)) for a in np.array(axes).flatten()]
+    if keepdims:
+        return [[1 if i in axes else d for i, d in enumerate(x)]]
+    return [[d for i, d in enumerate(x) if i not in axes]]
+
+
+def _argminmax(ctx, node, inputs):
+    x = inputs[0]
+    if x is None:
+        return None
+    if ctx.mapped:
+        axis = _attr(node, "axis", 0)
+        keepdims = _attr(node, "keepdims", 1)
+    else:
+        axis = ctx.const_value(node.input[1])
+        if axis is None:
+            return None
+        axis = int(np.array(axis).flatten()[0])
+        keepdims = 0
+    axis = _normalize_axis(axis, len(x))
+    if keepdims:
+        return [[1 if i == axis else d for i, d in enumerate(x)]]
+    return [[d for i, d in enumerate(x) if i != axis]]
+
+
+def _split(ctx, node, inputs):
+    if ctx.mapped:
+        x = inputs[0]
+        axis = _attr(node, "axis", 0)
+        split = _attr(node, "split")
+    elif node.type == "Split":
+        x = inputs[1]
+        axis = ctx.const_value(node.input[0])
+        split = None
+    else:
+        x = inputs[0]
+        split = ctx.const_value(node.input[1])
+        axis = ctx.const_value(node.input[2])
+    if x is None or axis is None:
+        return None
+    axis = _normalize_axis(int(np.array(axis).flatten()[0]), len(x))
+    num = len(node.output)
+    if split is None:
+        if not _is_int(x[axis]):
+            return None
+        split = [x[axis] // num] * num
+    split = [int(s) for s in split]
+    if -1 in split:
+        return None
+    ret = []
+    for s in split:
+        shape = list(x)
+        shape[axis] = s
+        ret.append(shape)
+    return ret
+
+
+def _reduce_or_broadcast(ctx, node, inputs):
+    # Max, Min, Mean and Sum are reductions in tensorflow but elementwise ops in onnx
+    if ctx.mapped:
+        return _broadcast(ctx, node, inputs)
+    return _reduce(ctx, node, inputs)
+
+
+def _batchnorm(ctx, node, inputs):
+    # only the first output is used for inference
+    return [inputs[0]]
+
+
+_UNARY_OPS = [
+    "Abs", "BiasAdd", "Cast", "Ceil", "Clip", "Cos", "Elu", "Erf", "Exp", "Floor", "Identity", "LRN",
+    "LeakyRelu", "Log", "LogSoftmax", "LogicalNot", "Neg", "Not", "Reciprocal", "Relu", "Relu6", "Round",
+    "Rsqrt", "Selu", "Sigmoid", "Sign", "Sin", "Softmax", "Softplus", "Softsign", "Sqrt", "Square", "Tan",
+    "Tanh", "ThresholdedRelu",
+]
+
+_BROADCAST_OPS = [
+    "Add", "And", "Div", "Equal", "FloorDiv", "Greater", "GreaterEqual", "Less", "LessEqual", "LogicalAnd",
+    "LogicalOr", "Maximum", "Minimum", "Mul", "NotEqual", "Or", "Pow", "RealDiv", "SquaredDifference", "Sub",
+]
+
+_RULES = {
+    "ArgMax": _argminmax,
+    "ArgMin": _argminmax,
+    "AvgPool": _tf_conv,
+    "AveragePool": _onnx_conv,
+    "BatchMatMul": _matmul,
+    "BatchNormalization": _batchnorm,
+    "Concat": _concat,
+    "ConcatV2": _concat,
+    "Conv": _onnx_conv,
+    "Conv2D": _tf_conv,
+    "DepthwiseConv2dNative": _tf_conv,
+    "Dropout": _batchnorm,
+    "ExpandDims": _unsqueeze,
+    "Flatten": _flatten,
+    "FusedBatchNorm": _batchnorm,
+    "Gather": _gather,
+    "GatherV2": _gather,
+    "Gemm": _gemm,
+    "GlobalAveragePool": _global_pool,
+    "GlobalMaxPool": _global_pool,
+    "MatMul": _matmul,
+    "Max": _reduce_or_broadcast,
+    "MaxPool": _onnx_conv,
+    "Mean": _reduce_or_broadcast,
+    "Min": _reduce_or_broadcast,
+    "Pack": _pack,
+    "Pad": _pad,
+    "Prod": _reduce,
+    "ReduceMax": _reduce,
+    "ReduceMean": _reduce,
+    "ReduceMin": _reduce,
+    "ReduceProd": _reduce,
+    "ReduceSum": _reduce,
+    "Reshape": _reshape,
+    "Shape": _shape,
+    "Size": _size,
+    "Split": _split,
+    "SplitV": _split,
+    "Squeeze": _squeeze,
+    "Sum": _reduce_or_broadcast,
+    "Transpose": _transpose,
+    "Unsqueeze": _unsqueeze,
+}
+_RULES.update({op: _same_as_input for op in _UNARY_OPS})
+_RULES.update({op: _broadcast for op in _BROADCAST_OPS})
+
+
+class ShapeInference(object):
+    """Infer shapes on the internal graph and track unknown dims by name.
+
+    Unknown dims are given a name (a symbol). When an op shows that two unknown dims are equal (for
+    example both inputs of a MatMul) the symbols are merged, when an op shows the value of a symbol
+    all dims with that symbol become known. Only unknown dims are filled in, known dims are never changed.
+    """
+
+    def __init__(self, graph, mapped):
+        """Create shape inference.
+        Args:
+            graph: the Graph
+            mapped: True if the graph has onnx ops, False while it still has tensorflow ops
+        """
+        self._g = graph
+        self.mapped = mapped
+        self.opset = graph.opset
+        # union find over symbols, a root symbol may have a value
+        self._parent = {}
+        self._values = {}
+        self._changed = 0
+
+    def _find(self, sym):
+        root = sym
+        while self._parent.get(root, root) != root:
+            root = self._parent[root]
+        while sym != root:
+            self._parent[sym], sym = root, self._parent[sym]
+        return root
+
+    def _resolve(self, dim):
+        if isinstance(dim, str):
+            root = self._find(dim)
+            return self._values.get(root, root)
+        return dim
+
+    def unify(self, a, b):
+        """Record that dims a and b are equal, returns the merged dim.
+        If both are symbols the name of a is kept unless only b was named by the user.
+        """
+        a, b = self._resolve(a), self._resolve(b)
+        if a is None:
+            return b
+        if b is None or a == b:
+            return a
+        if isinstance(a, str) and isinstance(b, str):
+            if _is_auto_symbol(a) and not _is_auto_symbol(b):
+                a, b = b, a
+            self._parent[b] = a
+            return a
+        if isinstance(a, str):
+            self._values[a] = b
+            return b
+        if isinstance(b, str):
+            self._values[b] = a
+            return a
+        log.debug("conflicting dims %s and %s", a, b)
+        return a
+
+    def broadcast_dims(self, dims):
+        """Result of broadcasting dims against each other."""
+        dims = [self._resolve(d) for d in dims]
+        known = [d for d in dims if _is_int(d) and d != 1]
+        if known:
+            return known[0]
+        others = [d for d in dims if d != 1]
+        if not others:
+            return 1
+        if len(set(others)) == 1:
+            return others[0]
+        # two different unknown dims, either one can be 1
+        return None
+
+    def const_value(self, name):
+        """Value of a constant input or None."""
+        g = self._g
+        if g.is_initializer(name):
+            return numpy_helper.to_array(g.get_initializer(name))
+        node = g.get_node_by_name(name)
+        if node is not None and node.is_const():
+            try:
+                return np.array(node.get_tensor_value())
+            except ValueError:
+                return None
+        return None
+
+    def get_shape(self, name):
+        """Symbolic shape of a tensor, symbols are created for unknown dims."""
+        g = self._g
+        if g.is_initializer(name):
+            return list(g.get_initializer(name).dims)
+        node = g.get_node_by_name(name)
+        if node is not None and node.is_const() and node.get_attr("value") is not None:
+            return list(node.get_attr("value").t.dims)
+        shape = g.get_shape(name)
+        if not shape:
+            # unknown rank or scalar, we can't tell
+            return None
+        symbolic = g.get_symbolic_shape(name)
+        if symbolic is None or len(symbolic) != len(shape):
+            symbolic = [None] * len(shape)
+        ret = []
+        new_symbol = False
+        for i, d in enumerate(shape):
+            if d is not None and d >= 0:
+                ret.append(d)
+            elif isinstance(symbolic[i], str):
+                ret.append(self._resolve(symbolic[i]))
+            else:
+                ret.append(_auto_symbol(name, i))
+                new_symbol = True
+        if new_symbol:
+            g.set_symbolic_shape(name, ret)
+        return ret
+
+    def _merge(self, name, inferred):
+        """Merge the inferred shape into what is known for name."""
+        g = self._g
+        inferred = [self._resolve(d) for d in inferred]
+        existing = self.get_shape(name)
+        if existing is None:
+            if inferred or g.get_shape(name) is None:
+                merged = [d if d is not None else _auto_symbol(name, i) for i, d in enumerate(inferred)]
+                self._set(name, merged)
+            return
+        if len(existing) != len(inferred):
+            log.debug("rank of %s is %d but inferred %d", name, len(existing), len(inferred))
+            return
+        merged = []
+        for e, i in zip(existing, inferred):
+            if _is_int(e) and _is_int(i) and e != i:
+                log.debug("dim of %s is %d but inferred %d", name, e, i)
+                merged.append(e)
+            else:
+                # prefer the inferred symbol so the names of the inputs are traced through the graph
+                merged.append(self.unify(i, e))
+        self._set(name, merged)
+
+    def _set(self, name, dims):
+        g = self._g
+        old = g.get_shape(name)
+        numeric = [d if _is_int(d) else -1 for d in dims]
+        if old != numeric:
+            self._changed += 1
+            g.set_shape(name, numeric)
+        g.set_symbolic_shape(name, dims)
+
+    def _finalize(self):
+        """Replace symbols by their root and assign the values found for symbols."""
+        g = self._g
+        for name, dims in list(g.symbolic_shapes.items()):
+            dims = [self._resolve(d) for d in dims]
+            g.set_symbolic_shape(name, dims)
+            shape = g.get_shape(name)
+            if shape and len(shape) == len(dims):
+                numeric = [d if _is_int(d) else s for d, s in zip(dims, shape)]
+                if numeric != shape:
+                    self._changed += 1
+                    g.set_shape(name, numeric)
+
+    def infer(self):
+        """Run inference over all nodes, returns the number of shapes that changed."""
+        for node in self._g.get_nodes():
+            if node.is_deleted() or node.domain:
+                continue
+            rule = _RULES.get(node.type)
+            if rule is None:
+                continue
+            try:
+                inputs = [self.get_shape(i) if i else None for i in node.input]
+                outputs = rule(self, node, inputs)
+            except Exception as ex:  # pylint: disable=broad-except
+                log.debug("shape inference failed for %s: %s", node.name, ex)
+                continue
+            if outputs is None:
+                continue
+            for name, shape in zip(node.output, outputs):
+                if shape is not None:
+                    self._merge(name, shape)
+        self._finalize()
+        return self._changed
+
+
+def infer_shapes(g, mapped=True):
+    """Fill in unknown shapes of graph g.
+    Args:
+        g: the Graph
+        mapped: True if the graph has onnx ops, False while it still has tensorflow ops
+    Returns:
+        number of shapes that changed
+    """
+    changed = ShapeInference(g, mapped).infer()
+    log.debug("shape inference changed %d shape(s)", changed)
+    return changed
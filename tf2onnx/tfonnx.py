@@ -10,20 +10,29 @@ from __future__ import print_function
 
 import collections
 import logging
+import os
 import sys
 import traceback
 
 import numpy as np
 from onnx import helper, onnx_pb, numpy_helper
 
-from tensorflow.python.framework import graph_util
+import tensorflow as tf
+from tensorflow.core.framework import graph_pb2
+from tensorflow.python.framework import graph_util, op_def_registry
 from tensorflow.tools.graph_transforms import TransformGraph
 
 import tf2onnx
-from tf2onnx import utils
+from tf2onnx import checkpoint, utils
+from tf2onnx.dtype_inference import infer_dtypes
 from tf2onnx.graph import Node, Graph
 from tf2onnx.graph_matcher import OpTypePattern, GraphMatcher
+from tf2onnx.graph_validator import GraphValidator
+from tf2onnx.optimizer.peephole_optimizer import PeepholeOptimizer
+from tf2onnx.rewriter.cond_rewriter import rewrite_cond, rewrite_constant_switch
+from tf2onnx.rewriter.loop_rewriter import rewrite_loops
 from tf2onnx.rewriter.rnn import rewrite_single_direction_lstm, rewrite_bi_direction_lstm
+from tf2onnx.shape_inference import infer_shapes
 from tf2onnx.utils import port_name
 
 logging.basicConfig(level=logging.INFO)
@@ -258,7 +267,7 @@ def reduce_op(ctx, node, name, args):
 def placeholder_op(ctx, node, name, args):
     input_node = helper.make_tensor_value_info(node.output[0],
                                                node.dtype,
-                                               utils.make_onnx_shape(ctx.get_shape(node.output[0])))
+                                               ctx.get_onnx_shape(node.output[0]))
     ctx.add_model_input(input_node.name, input_node)
     return None
 
@@ -1672,25 +1681,10 @@ def rewrite_incomplete_type_support(g, ops):
         new_ops.append(op)
 
     if needs_pass2:
-        # possible that we inserted casts that don't annything ... get rid of them
-        ops = new_ops
-        new_ops = []
-        for op in ops:
-            if op.type != "Cast":
-                new_ops.append(op)
-                continue
-            dtype_in = g.get_dtype(op.input[0])
-            dtype_out = g.get_dtype(op.output[0])
-            if dtype_in != dtype_out:
-                new_ops.append(op)
-                continue
-
-            # input and output have the same dtype ... remove the cast
-            output_name = op.output[0]
-            for node in ops:
-                for i, input_name in enumerate(node.input):
-                    if output_name == input_name:
-                        node.input[i] = op.input[0]
+        # possible that we inserted casts that don't do anything ... get rid of them
+        g.set_nodes(new_ops)
+        PeepholeOptimizer(g).optimize()
+        new_ops = g.get_nodes()
 
     return new_ops
 
@@ -1752,6 +1746,14 @@ def tensorflow_onnx_mapping(g, continue_on_error, custom_op_handlers):
 
     g.set_nodes(onnx_nodes)
 
+    # subgraphs, like the body of Loop, are mapped with the same handlers
+    for node in onnx_nodes:
+        for body, _, _ in node.get_body_graphs().values():
+            body_mapped_op, body_unmapped_op = tensorflow_onnx_mapping(body, continue_on_error, custom_op_handlers)
+            mapped_op += body_mapped_op
+            unmapped_op += body_unmapped_op
+            body.topological_sort(body.get_nodes())
+
     return mapped_op, unmapped_op
 
 
@@ -1780,12 +1782,154 @@ def transpose_inputs(ctx, inputs_as_nchw):
     ctx.set_nodes(ops)
 
 
+# ops tf_fold_constants never evaluates, control flow is left to the rewriters
+_TF_NO_FOLD_OPS = ["Enter", "Exit", "LoopCond", "Merge", "NextIteration", "Placeholder", "PlaceholderV2",
+                   "PlaceholderWithDefault", "RefEnter", "RefExit", "RefMerge", "RefSwitch", "Switch"]
+
+# ops whose value only depends on the static shape of their input
+_TF_SHAPE_OPS = ["Rank", "Shape", "Size"]
+
+
+def _tf_static_shape_value(op):
+    """Value of a Shape, Size or Rank op if the shape of its input is known, else None."""
+    shape = op.inputs[0].get_shape()
+    if shape.ndims is None:
+        return None
+    if op.type == "Rank":
+        return np.array(shape.ndims, dtype=np.int32)
+    if not shape.is_fully_defined():
+        return None
+    dtype = op.get_attr("out_type").as_numpy_dtype
+    if op.type == "Size":
+        return np.array(shape.num_elements(), dtype=dtype)
+    return np.array(shape.as_list(), dtype=dtype)
+
+
+def tf_fold_constants(graph_def, inputs, outputs):
+    """Replace every maximal subgraph of graph_def that only depends on constants by Const nodes.
+    Shape, Size and Rank of tensors with a static shape count as constants. All subgraphs are evaluated
+    with a single Session.run, tensors that fail to evaluate stay as they are.
+    Nodes that are no longer used are not removed, extract_sub_graph() does that.
+    """
+    with tf.Graph().as_default() as tf_graph:
+        tf.import_graph_def(graph_def, name="")
+    registered_ops = op_def_registry.get_registered_ops()
+    nodes = {node.name: node for node in graph_def.node}
+    input_names = set(utils.node_name(i) for i in inputs)
+    feed = {}
+    constant = {}
+
+    def deps(node):
+        return [utils.node_name(i[1:] if i.startswith("^") else i) for i in node.input]
+
+    def is_source(node):
+        """True or False if node is constant regardless of its inputs, None if that depends on the inputs."""
+        op_def = registered_ops.get(node.op)
+        if node.name in input_names or node.op in _TF_NO_FOLD_OPS or op_def is None or op_def.is_stateful:
+            return False
+        if node.op in _TF_SHAPE_OPS:
+            value = _tf_static_shape_value(tf_graph.get_operation_by_name(node.name))
+            if value is not None:
+                feed[port_name(node.name)] = value
+                return True
+        if not node.input:
+            return node.op == "Const"
+        return None
+
+    for start in nodes:
+        stack = [start]
+        while stack:
+            name = stack[-1]
+            if name in constant:
+                stack.pop()
+                continue
+            node = nodes[name]
+            source = is_source(node)
+            if source is not None:
+                constant[name] = source
+                stack.pop()
+                continue
+            pending = [d for d in deps(node) if d not in constant]
+            if pending:
+                stack.extend(pending)
+                continue
+            constant[name] = all(constant[d] for d in deps(node))
+            stack.pop()
+
+    # tensors where a constant subgraph meets the rest of the graph
+    fetch = []
+    consumed = [i for node in graph_def.node if not constant[node.name] for i in node.input if i[0] != "^"]
+    for name in consumed + list(outputs):
+        name = name if ":" in name else port_name(name)
+        op_name = utils.node_name(name)
+        if constant.get(op_name) and nodes[op_name].op != "Const" and name not in fetch:
+            fetch.append(name)
+    if not fetch:
+        return graph_def
+
+    with tf.Session(graph=tf_graph) as sess:
+        try:
+            values = dict(zip(fetch, sess.run(fetch, feed_dict=feed)))
+        except Exception as ex:
+            log.debug("batched constant folding failed, folding one by one: %s", ex)
+            values = {}
+            for name in fetch:
+                try:
+                    values[name] = sess.run(name, feed_dict=feed)
+                except Exception as err:
+                    log.debug("can't fold %s: %s", name, err)
+
+    replaced = {}
+    renames = {}
+    new_nodes = []
+    for name, value in values.items():
+        tensor = tf_graph.get_tensor_by_name(name)
+        try:
+            tensor_proto = tf.make_tensor_proto(value, dtype=tensor.dtype)
+        except Exception as ex:
+            log.debug("can't fold %s: %s", name, ex)
+            continue
+        op_name = utils.node_name(name)
+        if len(tensor.op.outputs) == 1:
+            const_name = op_name
+        elif name in outputs:
+            # the output name has to stay
+            continue
+        else:
+            const_name = utils.make_name(op_name + "_folded")
+            renames[name] = const_name
+            if name.endswith(":0"):
+                renames[op_name] = const_name
+        const = graph_pb2.NodeDef(name=const_name, op="Const", device=nodes[op_name].device)
+        const.attr["dtype"].type = tensor.dtype.as_datatype_enum
+        const.attr["value"].tensor.CopyFrom(tensor_proto)
+        if const_name == op_name:
+            replaced[op_name] = const
+        else:
+            new_nodes.append(const)
+
+    ret = graph_pb2.GraphDef()
+    ret.versions.CopyFrom(graph_def.versions)
+    ret.library.CopyFrom(graph_def.library)
+    for node in graph_def.node:
+        if node.name in replaced:
+            ret.node.extend([replaced[node.name]])
+            continue
+        new_node = ret.node.add()
+        new_node.CopyFrom(node)
+        if not constant[node.name]:
+            for i, name in enumerate(new_node.input):
+                new_node.input[i] = renames.get(name, name)
+    ret.node.extend(new_nodes)
+    log.info("folded %d tensorflow constant subgraph(s)", len(replaced) + len(new_nodes))
+    return ret
+
+
 def tf_optimize(inputs, outputs, graph_def, fold_constant=None):
     """Optimize tensorflow graph for inference."""
     transforms = []
     if fold_constant:
         transforms.extend([
-            "fold_constants(ignore_errors=true)",
             "remove_attribute(attribute_name=_class)", # remove node colocation attributes
         ])
 
@@ -1795,16 +1939,39 @@ def tf_optimize(inputs, outputs, graph_def, fold_constant=None):
     ])
     needed_names = [utils.node_name(i) for i in inputs] + [utils.node_name(i) for i in outputs]
     graph_def = graph_util.extract_sub_graph(graph_def, needed_names)
+    if fold_constant:
+        graph_def = tf_fold_constants(graph_def, inputs, outputs)
+        graph_def = graph_util.extract_sub_graph(graph_def, needed_names)
     graph_def = TransformGraph(graph_def, inputs, outputs, transforms)
     return graph_def
 
 
+def tf_specialize_shapes(graph_def, shape_override):
+    """Set the shape of the placeholders in graph_def to the static shapes given in shape_override.
+    Tensorflow propagates those shapes through the graph when it is imported.
+    """
+    for node in graph_def.node:
+        if node.op != "Placeholder":
+            continue
+        shape = shape_override.get(port_name(node.name))
+        if shape is None:
+            continue
+        if any(not isinstance(d, int) or d < 0 for d in shape):
+            raise ValueError("shape {} of {} is not static".format(shape, node.name))
+        shape_attr = node.attr["shape"].shape
+        shape_attr.Clear()
+        for d in shape:
+            shape_attr.dim.add().size = d
+    return graph_def
+
+
 def process_tf_graph(tf_graph, continue_on_error=False, verbose=False, target=None,
                      opset=None, custom_op_handlers=None, custom_rewriter=None,
-                     extra_opset=None, shape_override=None, inputs_as_nchw=None):
+                     extra_opset=None, shape_override=None, inputs_as_nchw=None, validate_graph=False,
+                     checkpoint_dir=None, checkpoint_phases=None, resume_from=None, output_names=None):
     """Convert tensorflow graph to onnx graph.
         Args:
-            tf_graph: tensorflow graph
+            tf_graph: tensorflow graph, can be None if resume_from is given
             continue_on_error: if an op can't be processed (aka there is no mapping), continue
             verbose: print summary stats
             target: list of workarounds applied to help certain platforms
@@ -1812,8 +1979,13 @@ def process_tf_graph(tf_graph, continue_on_error=False, verbose=False, target=No
             custom_op_handlers: dictionary of custom ops handlers
             custom_rewriter: list of custom graph rewriters
             extra_opset: list of extra opset's, for example the opset's used by custom ops
-            shape_override: dict with inputs that override the shapes given by tensorflow
+            shape_override: dict with inputs that override the shapes given by tensorflow, dims can be names
             inputs_as_nchw: transpose inputs in list from nchw to nchw
+            validate_graph: debug option, validate the graph after each rewriter
+            checkpoint_dir: save the graph after each phase in checkpoint_phases into a sub directory of this
+            checkpoint_phases: list of phases to save, default is all of checkpoint.PHASES
+            resume_from: directory of a saved checkpoint, conversion continues after the saved phase
+            output_names: list of model outputs, if not given redundant Identity nodes are kept
         Return:
             onnx graph
     """
@@ -1833,44 +2005,97 @@ def process_tf_graph(tf_graph, continue_on_error=False, verbose=False, target=No
         inputs_as_nchw = []
     if target is None:
         target = DEFAULT_TARGET
+    if checkpoint_phases is None:
+        checkpoint_phases = checkpoint.PHASES
+
+    resumed_phase = None
+    op_cnt, attr_cnt = collections.Counter(), collections.Counter()
+    mapped_op, unmapped_op = collections.Counter(), collections.Counter()
+    if resume_from:
+        g, resumed_phase = checkpoint.load_graph(resume_from)
+        target = g.target
+    else:
+        # named dims are unknown for the numeric shapes, the names are used by shape inference
+        numeric_override = {k: [-1 if isinstance(d, str) else d for d in v] for k, v in shape_override.items()}
+        onnx_nodes, op_cnt, attr_cnt, output_shapes, dtypes = tensorflow_to_onnx(tf_graph, numeric_override)
+        g = Graph(onnx_nodes, output_shapes, dtypes, target, opset, extra_opset)
+        for k, v in shape_override.items():
+            if any(isinstance(d, str) for d in v):
+                g.set_symbolic_shape(k, v)
+
+    validator = GraphValidator(g) if validate_graph else None
+
+    def validate(phase):
+        if validator:
+            log.debug("validate graph after %s", phase)
+            validator.check(output_names, incremental=True)
+
+    def need_phase(phase):
+        return resumed_phase is None or checkpoint.PHASES.index(phase) > checkpoint.PHASES.index(resumed_phase)
+
+    def save_phase(phase):
+        if checkpoint_dir and phase in checkpoint_phases:
+            checkpoint.save_graph(g, os.path.join(checkpoint_dir, phase), phase)
+
+    if need_phase("import"):
+        validate("import")
+        if inputs_as_nchw:
+            transpose_inputs(g, inputs_as_nchw)
+        infer_shapes(g, mapped=False)
+        save_phase("import")
+
+    if need_phase("rewrite"):
+        # pre-processing graph rewrites
+        rewriters = [rewrite_constant_switch, rewrite_transpose, rewrite_flatten, rewrite_random_uniform,
+                     rewrite_random_normal, rewrite_dropout,
+                     rewrite_single_direction_lstm, rewrite_bi_direction_lstm, rewrite_cond, rewrite_loops]
+
+        if custom_rewriter is not None:
+            rewriters.extend(custom_rewriter)
 
-    onnx_nodes, op_cnt, attr_cnt, output_shapes, dtypes = tensorflow_to_onnx(tf_graph, shape_override)
-
-    g = Graph(onnx_nodes, output_shapes, dtypes, target, opset, extra_opset)
-    if inputs_as_nchw:
-        transpose_inputs(g, inputs_as_nchw)
-
-    # pre-processing graph rewrites
-    rewriters = [rewrite_transpose, rewrite_flatten, rewrite_random_uniform,
-                 rewrite_random_normal, rewrite_dropout,
-                 rewrite_single_direction_lstm, rewrite_bi_direction_lstm]
-
-    if custom_rewriter is not None:
-        rewriters.extend(custom_rewriter)
-
-    ops = g.get_nodes()
-    for rewrite in rewriters:
-        ops = rewrite(g, ops)
-        g.set_nodes(ops)
-    topological_sort(g.get_nodes())
-
-    if custom_op_handlers is None:
-        custom_op_handlers = {}
-    mapped_op, unmapped_op = tensorflow_onnx_mapping(g, continue_on_error, custom_op_handlers)
-
-    # post-processing rewriters
-    late_rewriters = []
-    if TARGET_RS5 in target:
-        late_rewriters.append(rewrite_incomplete_type_support)
-    if late_rewriters:
-        topological_sort(g.get_nodes())
         ops = g.get_nodes()
-        for rewrite in late_rewriters:
+        for rewrite in rewriters:
             ops = rewrite(g, ops)
             g.set_nodes(ops)
-
-    # onnx requires topological sorting
-    topological_sort(g.get_nodes())
+            validate(rewrite.__name__)
+            # rewriters often add nodes without shapes
+            infer_shapes(g, mapped=False)
+        topological_sort(g.get_nodes())
+        save_phase("rewrite")
+
+    if need_phase("mapping"):
+        if custom_op_handlers is None:
+            custom_op_handlers = {}
+        mapped_op, unmapped_op = tensorflow_onnx_mapping(g, continue_on_error, custom_op_handlers)
+        validate("tensorflow_onnx_mapping")
+        infer_shapes(g, mapped=True)
+        infer_dtypes(g)
+        save_phase("mapping")
+
+    if need_phase("final"):
+        # post-processing rewriters
+        late_rewriters = []
+        if TARGET_RS5 in target:
+            late_rewriters.append(rewrite_incomplete_type_support)
+        if late_rewriters:
+            topological_sort(g.get_nodes())
+            ops = g.get_nodes()
+            for rewrite in late_rewriters:
+                ops = rewrite(g, ops)
+                g.set_nodes(ops)
+                validate(rewrite.__name__)
+                infer_shapes(g, mapped=True)
+                infer_dtypes(g)
+
+        # remove redundant Identity, Cast and Transpose nodes left by the handlers and rewriters,
+        # the tensors subgraphs use must stay as they are
+        peephole_outputs = list(output_names) + g.get_subgraph_inputs() if output_names is not None else None
+        PeepholeOptimizer(g, output_names=peephole_outputs).optimize()
+        validate("peephole optimizer")
+
+        # onnx requires topological sorting
+        topological_sort(g.get_nodes())
+        save_phase("final")
 
     g.update_proto()
 
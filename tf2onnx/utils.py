@@ -85,7 +85,7 @@ ONNX_VALID_ATTRIBUTES = {
     'dtype', 'output_shape', 'spatial', 'split', 'input_forget', 'keepdims', 'transA', 'auto_pad', 'border', 'low',
     'linear_before_reset', 'height_scale', 'output_padding', 'shape', 'kernel_shape', 'epsilon', 'size', 'starts',
     'direction', 'max', 'clip', 'across_channels', 'value', 'strides', 'extra_shape', 'scales', 'k', 'sample_size',
-    'blocksize', 'epsilon', 'momentum'
+    'blocksize', 'epsilon', 'momentum', 'body', 'then_branch', 'else_branch'
 }
 
 
@@ -100,6 +100,13 @@ def make_name(name):
     return "{}__{}".format(name, INTERNAL_NAME)
 
 
+def _parse_dim(dim):
+    try:
+        return int(dim)
+    except ValueError:
+        return dim
+
+
 def split_nodename_and_shape(name):
     """input name with shape into name and shape."""
     # pattern for a node name
@@ -107,13 +114,14 @@ def split_nodename_and_shape(name):
     shapes = {}
     # input takes in most cases the format name:0, where 0 is the output number
     # in some cases placeholders don't have a rank which onnx can't handle so we let uses override the shape
-    # by appending the same, ie : [1,28,28,3]
-    name_pattern = r"(?:([\w\d/\-\._:]+)(\[[\-\d,]+\])?),?"
+    # by appending the same, ie : [1,28,28,3]. Dims can be given a name, ie: [N,28,28,3], to tell that
+    # they are unknown but the same for all inputs using the name.
+    name_pattern = r"(?:([\w\d/\-\._:]+)(\[[\w\-,]+\])?),?"
     splits = re.split(name_pattern, name)
     for i in range(1, len(splits), 3):
         inputs.append(splits[i])
         if splits[i + 1] is not None:
-            shapes[splits[i]] = [int(n) for n in splits[i + 1][1:-1].split(",")]
+            shapes[splits[i]] = [_parse_dim(n) for n in splits[i + 1][1:-1].split(",")]
     if not shapes:
         shapes = None
     return inputs, shapes
@@ -0,0 +1,125 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+"""
+Simple tool to measure the effect of fusing MatMul + Add into Gemm.
+
+For every dense layer (MatMul + BiasAdd) of a frozen tensorflow model it builds the onnx graph
+the converter produces without the Gemm fusion (MatMul + Add) and with it (Gemm), runs both
+in onnxruntime and prints the op count, the latency and the max difference of the results.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+import onnxruntime as ort
+import tensorflow as tf
+from onnx import helper, numpy_helper, TensorProto
+from tensorflow.python.framework import tensor_util
+
+ACTIVATIONS = ["Relu", "Sigmoid", "Tanh"]
+OPT_LEVELS = [("ort-disabled", ort.GraphOptimizationLevel.ORT_DISABLE_ALL),
+              ("ort-all", ort.GraphOptimizationLevel.ORT_ENABLE_ALL)]
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infile", nargs="+", help="frozen tensorflow models")
+    parser.add_argument("--batch", type=int, nargs="+", default=[1, 64], help="batch sizes")
+    parser.add_argument("--runs", type=int, default=5, help="number of runs, the best one is reported")
+    parser.add_argument("--iterations", type=int, default=200, help="iterations per run")
+    return parser.parse_args()
+
+
+def get_layers(path):
+    """Get weight, bias and activation of the dense layers of a frozen model."""
+    graph_def = tf.GraphDef()
+    with tf.gfile.FastGFile(path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    nodes = {n.name: n for n in graph_def.node}
+
+    def get_const(name):
+        node = nodes[name]
+        while node.op == "Identity":
+            node = nodes[node.input[0]]
+        return tensor_util.MakeNdarray(node.attr["value"].tensor)
+
+    layers = []
+    for node in graph_def.node:
+        if node.op != "BiasAdd" or nodes[node.input[0]].op != "MatMul":
+            continue
+        matmul = nodes[node.input[0]]
+        act = [n.op for n in graph_def.node if node.name in n.input and n.op in ACTIVATIONS]
+        layers.append((get_const(matmul.input[1]), get_const(node.input[1]), act[0] if act else None))
+    return layers
+
+
+def make_model(layers, fused):
+    """Make the onnx model for the layers, with Gemm if fused or else with MatMul + Add."""
+    nodes = []
+    initializers = []
+    x = "X"
+    for i, (w, b, act) in enumerate(layers):
+        w_name = "w{}".format(i)
+        b_name = "b{}".format(i)
+        initializers.append(numpy_helper.from_array(w, w_name))
+        initializers.append(numpy_helper.from_array(b, b_name))
+        if fused:
+            nodes.append(helper.make_node("Gemm", [x, w_name, b_name], ["gemm{}".format(i)]))
+        else:
+            nodes.append(helper.make_node("MatMul", [x, w_name], ["matmul{}".format(i)]))
+            nodes.append(helper.make_node("Add", ["matmul{}".format(i), b_name], ["gemm{}".format(i)]))
+        x = "gemm{}".format(i)
+        if act:
+            nodes.append(helper.make_node(act, [x], ["act{}".format(i)]))
+            x = "act{}".format(i)
+    inputs = [helper.make_tensor_value_info("X", TensorProto.FLOAT, [None, layers[0][0].shape[0]])]
+    outputs = [helper.make_tensor_value_info(x, TensorProto.FLOAT, None)]
+    graph = helper.make_graph(nodes, "gemm_bench", inputs, outputs, initializer=initializers)
+    return helper.make_model(graph, opset_imports=[helper.make_opsetid("", 9)], ir_version=4)
+
+
+def run(model, x, level, runs, iterations):
+    """Get the best latency in us and the result of the model."""
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = level
+    opts.intra_op_num_threads = 1
+    sess = ort.InferenceSession(model.SerializeToString(), opts, providers=["CPUExecutionProvider"])
+    for _ in range(iterations):
+        sess.run(None, {"X": x})
+    best = None
+    for _ in range(runs):
+        start = time.time()
+        for _ in range(iterations):
+            sess.run(None, {"X": x})
+        latency = (time.time() - start) / iterations * 1e6
+        best = latency if best is None else min(best, latency)
+    return best, sess.run(None, {"X": x})[0]
+
+
+def main():
+    args = get_args()
+    for path in args.infile:
+        layers = get_layers(path)
+        if not layers:
+            print("{}: no dense layers".format(path))
+            continue
+        unfused = make_model(layers, False)
+        fused = make_model(layers, True)
+        print("{}: layers {}, ops {} -> {}".format(path, [w.shape for w, _, _ in layers],
+                                                   len(unfused.graph.node), len(fused.graph.node)))
+        for batch in args.batch:
+            x = np.linspace(0, 1, batch * layers[0][0].shape[0], dtype=np.float32).reshape(batch, -1)
+            for name, level in OPT_LEVELS:
+                t0, y0 = run(unfused, x, level, args.runs, args.iterations)
+                t1, y1 = run(fused, x, level, args.runs, args.iterations)
+                print("  batch {} {}: MatMul+Add {:.1f} us, Gemm {:.1f} us ({:+.1f}%), max diff {:.2g}".format(
+                    batch, name, t0, t1, (t1 - t0) / t0 * 100, np.abs(y0 - y1).max()))
+
+
+if __name__ == "__main__":
+    main()